@@ -0,0 +1,146 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+
+from app.config import settings
+from app.database import engine
+from app.exceptions import ServiceOverloadedException
+
+# Классы запросов: интерактивные обслуживаются раньше массовых
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+
+class AdmissionController:
+    """
+    Ограничитель одновременных запросов к БД с приоритетной очередью.
+    Если ожидание в очереди превышает целевую задержку, запрос сразу получает 503,
+    вместо того чтобы ждать соединение из пула до pool_timeout.
+    """
+
+    def __init__(self, limit: int, target_wait: float, max_queue: int):
+        self.limit = limit
+        self.target_wait = target_wait
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._waiters: list = []
+        self._counter = itertools.count()
+        # Сглаженные время ожидания в очереди и время обслуживания запроса
+        self.avg_wait = 0.0
+        self.avg_service = 0.05
+        self.stats = {"admitted": 0, "rejected": 0}
+
+    def _retry_after(self) -> int:
+        # Примерное время, за которое очередь рассосётся
+        backlog = len(self._waiters) + 1
+        return max(1, math.ceil(backlog * self.avg_service / max(self.limit, 1)))
+
+    def _reject(self):
+        self.stats["rejected"] += 1
+        raise ServiceOverloadedException(self._retry_after())
+
+    def _max_wait(self, priority: int) -> float:
+        # Массовые запросы ждут меньше и первыми попадают под отсечение
+        return self.target_wait if priority == PRIORITY_INTERACTIVE else self.target_wait / 2
+
+    async def acquire(self, priority: int) -> float:
+        """
+        Получение слота
+        :param priority: Класс запроса
+        :return: Момент получения слота для учёта времени обслуживания
+        :raises ServiceOverloadedException: Если очередь перегружена
+        """
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            self.stats["admitted"] += 1
+            return time.monotonic()
+
+        max_wait = self._max_wait(priority)
+        if len(self._waiters) >= self.max_queue or self.avg_wait > max_wait:
+            self._reject()
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._counter), future]
+        heapq.heappush(self._waiters, entry)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), max_wait)
+        except BaseException as e:
+            # Истечение ожидания или отмена запроса (например, клиент отключился)
+            self._discard(entry)
+            if future.done() and not future.cancelled():
+                # Слот был передан одновременно с выходом из ожидания - возвращаем его
+                self.release(time.monotonic())
+            else:
+                future.cancel()
+            self._observe_wait(time.monotonic() - started)
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject()
+            raise
+        self._observe_wait(time.monotonic() - started)
+        self.stats["admitted"] += 1
+        return time.monotonic()
+
+    def _discard(self, entry: list):
+        # Ожидающий, получивший слот, уже извлечён из очереди в release
+        try:
+            self._waiters.remove(entry)
+        except ValueError:
+            return
+        heapq.heapify(self._waiters)
+
+    def _observe_wait(self, waited: float):
+        self.avg_wait = 0.8 * self.avg_wait + 0.2 * waited
+
+    def release(self, acquired_at: float):
+        """
+        Освобождение слота: он передаётся следующему ожидающему с наивысшим приоритетом
+        :param acquired_at: Значение, возвращённое acquire
+        """
+        self.avg_service = 0.9 * self.avg_service + 0.1 * (time.monotonic() - acquired_at)
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+        if not self._waiters:
+            # Очередь пуста, перестаём отсекать по прошлой задержке
+            self.avg_wait = 0.0
+
+    @asynccontextmanager
+    async def slot(self, priority: int):
+        acquired_at = await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(acquired_at)
+
+
+def _pool_capacity() -> int:
+    pool = engine.sync_engine.pool
+    size = getattr(pool, "size", lambda: 0)()
+    overflow = max(getattr(pool, "_max_overflow", 0), 0)
+    return size + overflow or 10
+
+
+admission = AdmissionController(
+    limit=settings.ADMISSION_LIMIT or _pool_capacity(),
+    target_wait=settings.ADMISSION_TARGET_WAIT,
+    max_queue=settings.ADMISSION_MAX_QUEUE,
+)
+
+
+async def admit_interactive():
+    # Зависимость FastAPI для интерактивных запросов (отправка, история)
+    async with admission.slot(PRIORITY_INTERACTIVE):
+        yield
+
+
+async def admit_bulk():
+    # Зависимость FastAPI для массовых запросов (поиск, выгрузка)
+    async with admission.slot(PRIORITY_BULK):
+        yield
@@ -0,0 +1,175 @@
+import time
+from collections import OrderedDict, deque
+from app.config import settings
+
+
+class HotTailCache:
+    """
+    Кэш последних сообщений чатов в памяти процесса.
+    Для каждого чата хранится кольцевой буфер сериализованных сообщений,
+    чаты вытесняются целиком по принципу LRU при превышении лимита памяти.
+    Кэш у каждого процесса свой, поэтому запись хранит номер последнего события
+    чата (Chat.last_seq) на момент снимка: изменения из других процессов видны
+    по расхождению номера. Изменения без события в журнале (доставка, вложения)
+    становятся видны не позже чем через ttl секунд.
+    """
+
+    def __init__(self, tail_size: int, max_bytes: int, ttl: float):
+        self.tail_size = tail_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_bytes = 0
+        # chat_id -> [буфер сообщений, хранит ли буфер всю историю чата,
+        #             номер последнего учтённого события, время снимка]
+        self._chats: OrderedDict[int, list] = OrderedDict()
+        # chat_id -> счётчик изменений, чтобы не сохранить устаревший снимок из БД
+        self._versions: dict[int, int] = {}
+
+    @staticmethod
+    def _row_size(row: dict) -> int:
+        # Грубая оценка занимаемой памяти без повторной сериализации
+        return 256 + len(row["content"]) * 2 + 128 * len(row["files"])
+
+    def version(self, chat_id: int) -> int:
+        return self._versions.get(chat_id, 0)
+
+    def get(self, chat_id: int, limit: int | None = None, seq: int | None = None) -> list[dict] | None:
+        """
+        Возвращает последние сообщения чата из кэша
+        :param chat_id: ID чата
+        :param limit: Количество последних сообщений, None - вся история
+        :param seq: Текущий номер последнего события чата в БД; запись с другим номером устарела
+        :return: Список сообщений или None, если кэш не может ответить
+        """
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            return None
+        buffer, complete, entry_seq, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl or (seq is not None and seq != entry_seq):
+            self._drop(chat_id)
+            return None
+        if limit is None:
+            if not complete:
+                return None
+            rows = list(buffer)
+        else:
+            if limit > len(buffer) and not complete:
+                return None
+            rows = list(buffer)[-limit:] if limit else []
+        self._chats.move_to_end(chat_id)
+        return rows
+
+    def store(self, chat_id: int, rows: list[dict], complete: bool, version: int, seq: int = 0):
+        """
+        Заполняет кэш чата снимком из БД
+        :param chat_id: ID чата
+        :param rows: Последние сообщения чата в порядке возрастания ID
+        :param complete: Содержит ли снимок всю историю чата
+        :param version: Версия чата на момент чтения из БД
+        :param seq: Номер последнего события чата, прочитанный до снимка
+        """
+        if version != self.version(chat_id):
+            return
+        self._drop(chat_id)
+        if len(rows) > self.tail_size:
+            rows = rows[-self.tail_size:]
+            complete = False
+        buffer = deque(rows, maxlen=self.tail_size)
+        self._chats[chat_id] = [buffer, complete, seq, time.monotonic()]
+        self.size_bytes += sum(self._row_size(row) for row in buffer)
+        self._evict()
+
+    def append(self, chat_id: int, row: dict, seq: int | None = None):
+        """
+        Добавляет новое сообщение в буфер чата, если чат есть в кэше
+        :param seq: Номер события, записанного вместе с сообщением
+        """
+        self._bump(chat_id)
+        entry = self._advance(chat_id, seq)
+        if entry is None:
+            return
+        buffer = entry[0]
+        if len(buffer) == buffer.maxlen:
+            self.size_bytes -= self._row_size(buffer[0])
+            entry[1] = False
+        buffer.append(row)
+        self.size_bytes += self._row_size(row)
+        self._chats.move_to_end(chat_id)
+        self._evict()
+
+    def update(self, chat_id: int, message_id: int, seq: int | None = None, **values):
+        """
+        Изменяет закэшированное сообщение на месте
+        :param seq: Номер события, если изменение записано в журнал чата
+        """
+        self._bump(chat_id)
+        entry = self._advance(chat_id, seq)
+        if entry is None:
+            return
+        for row in entry[0]:
+            if row["id"] == message_id:
+                self.size_bytes -= self._row_size(row)
+                row.update(values)
+                self.size_bytes += self._row_size(row)
+                break
+
+    def remove(self, chat_id: int, message_id: int, seq: int | None = None):
+        """
+        Удаляет сообщение из буфера чата
+        :param seq: Номер события удаления
+        """
+        self._bump(chat_id)
+        entry = self._advance(chat_id, seq)
+        if entry is None:
+            return
+        buffer, complete = entry[0], entry[1]
+        for row in buffer:
+            if row["id"] == message_id:
+                buffer.remove(row)
+                self.size_bytes -= self._row_size(row)
+                break
+        if not complete:
+            # Буфер стал короче хвоста чата, старое сообщение в него уже не вернуть
+            self._drop(chat_id)
+
+    def advance(self, chat_id: int, seq: int):
+        """
+        Учитывает событие чата, не меняющее закэшированные сообщения
+        """
+        self._advance(chat_id, seq)
+
+    def _advance(self, chat_id: int, seq: int | None):
+        # Запись продолжает быть актуальной, только если событие следует сразу за
+        # последним учтённым: иначе между ними были изменения из другого процесса
+        entry = self._chats.get(chat_id)
+        if entry is None or seq is None:
+            return entry
+        if seq != entry[2] + 1:
+            self._drop(chat_id)
+            return None
+        entry[2] = seq
+        return entry
+
+    def invalidate(self, chat_id: int):
+        self._bump(chat_id)
+        self._drop(chat_id)
+
+    def _bump(self, chat_id: int):
+        self._versions[chat_id] = self._versions.get(chat_id, 0) + 1
+
+    def _drop(self, chat_id: int):
+        entry = self._chats.pop(chat_id, None)
+        if entry is not None:
+            self.size_bytes -= sum(self._row_size(row) for row in entry[0])
+
+    def _evict(self):
+        while self.size_bytes > self.max_bytes and self._chats:
+            chat_id = next(iter(self._chats))
+            self._drop(chat_id)
+
+
+hot_tail_cache = HotTailCache(
+    tail_size=settings.HOT_TAIL_SIZE,
+    max_bytes=settings.HOT_TAIL_MAX_BYTES,
+    ttl=settings.HOT_TAIL_TTL,
+)
@@ -0,0 +1,304 @@
+"""
+Возобновляемая загрузка больших вложений частями.
+
+Клиент создаёт сессию, отправляет части по смещениям (в любом порядке и параллельно),
+может запросить уже полученные диапазоны и завершает загрузку контрольной суммой.
+Части пишутся сразу на своё место в заранее выделенный временный файл,
+при завершении файл переименовывается в каталог загрузок без копирования.
+Части одной загрузки могут приходить в разные процессы, поэтому состояние в файле
+рядом с временным файлом перечитывается и сливается под файловой блокировкой.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+from dataclasses import dataclass, field, asdict
+from typing import AsyncIterator, Dict, List
+
+from fastapi import HTTPException
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка между процессами недоступна
+    fcntl = None
+
+from app.config import settings
+
+UPLOAD_DIR = "uploads"
+PARTIAL_DIR = os.path.join(UPLOAD_DIR, ".partial")
+
+
+@dataclass
+class UploadSession:
+    id: str
+    user_id: int
+    chat_id: int
+    recipient_id: int | None
+    filename: str
+    size: int
+    created_at: float
+    # Полученные диапазоны байт [начало, конец), отсортированные и не пересекающиеся
+    received: List[List[int]] = field(default_factory=list)
+    # Момент последней полученной части; брошенные сессии удаляются по нему
+    updated_at: float = 0.0
+
+    def __post_init__(self):
+        self.updated_at = self.updated_at or self.created_at
+
+    @property
+    def path(self) -> str:
+        return os.path.join(PARTIAL_DIR, self.id)
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.join(PARTIAL_DIR, f"{self.id}.json")
+
+    @property
+    def lock_path(self) -> str:
+        return os.path.join(PARTIAL_DIR, f"{self.id}.lock")
+
+    @property
+    def received_bytes(self) -> int:
+        return sum(end - start for start, end in self.received)
+
+    @property
+    def complete(self) -> bool:
+        return self.received == [[0, self.size]] or self.size == 0
+
+    def add_range(self, start: int, end: int):
+        # Вставка диапазона со слиянием соседних и пересекающихся
+        merged = []
+        for current in sorted(self.received + [[start, end]]):
+            if merged and current[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], current[1])
+            else:
+                merged.append(list(current))
+        self.received = merged
+
+    def status(self) -> dict:
+        return {
+            "upload_id": self.id,
+            "filename": self.filename,
+            "size": self.size,
+            "chunk_size": settings.UPLOAD_CHUNK_SIZE,
+            "received": self.received,
+            "received_bytes": self.received_bytes,
+            "complete": self.complete,
+        }
+
+
+def _stored_name(session: UploadSession) -> str:
+    # ID сессии делает имя уникальным, одноимённые загрузки не перезаписывают друг друга
+    safe_name = re.sub(r"[^\w.-]", "_", session.filename).lstrip(".") or "file"
+    return f"{session.id}_{safe_name}"
+
+
+def _preallocate(path: str, size: int):
+    with open(path, "wb") as f:
+        if size and hasattr(os, "posix_fallocate"):
+            # Место на диске резервируется сразу, части не фрагментируют файл
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            f.truncate(size)
+
+
+def _pwrite(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_meta(session: UploadSession):
+    temp = f"{session.meta_path}.tmp"
+    with open(temp, "w", encoding="utf-8") as f:
+        json.dump(asdict(session), f)
+    os.replace(temp, session.meta_path)
+
+
+def _read_meta(path: str) -> UploadSession | None:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return UploadSession(**json.load(f))
+    except (FileNotFoundError, ValueError, TypeError):
+        return None
+
+
+def _merge(session: UploadSession, stored: UploadSession):
+    for start, end in stored.received:
+        session.add_range(start, end)
+    session.updated_at = max(session.updated_at, stored.updated_at)
+
+
+def _merge_and_write_meta(session: UploadSession) -> bool:
+    """
+    Слияние состояния с сохранённым другими процессами и запись под файловой блокировкой
+    :return: False, если файла состояния уже нет (загрузка завершена или удалена)
+    """
+    with open(session.lock_path, "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        stored = _read_meta(session.meta_path)
+        if stored is None:
+            return False
+        _merge(session, stored)
+        session.updated_at = max(session.updated_at, time.time())
+        _write_meta(session)
+        return True
+
+
+class ChunkedUploads:
+    """
+    Сессии загрузки частями. Состояние хранится в памяти и дублируется в файл
+    рядом с временным файлом, поэтому загрузку можно продолжить после перезапуска.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        # ttl отсчитывается от последней полученной части, а не от создания сессии
+        self.max_size = max_size
+        self.ttl = ttl
+        self._sessions: Dict[str, UploadSession] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def create(self, user_id: int, chat_id: int, recipient_id: int | None,
+                     filename: str, size: int) -> UploadSession:
+        """
+        Создание сессии и временного файла нужного размера
+        """
+        if size < 0 or size > self.max_size:
+            raise HTTPException(status_code=413, detail=f"Размер файла должен быть не больше {self.max_size} байт")
+        filename = os.path.basename(filename)
+        if not filename:
+            raise HTTPException(status_code=400, detail="Некорректное имя файла")
+        session = UploadSession(uuid.uuid4().hex, user_id, chat_id, recipient_id, filename, size, time.time())
+        os.makedirs(PARTIAL_DIR, exist_ok=True)
+        await asyncio.to_thread(_preallocate, session.path, size)
+        await asyncio.to_thread(_write_meta, session)
+        self._sessions[session.id] = session
+        return session
+
+    def get(self, upload_id: str, user_id: int) -> UploadSession:
+        """
+        Сессия пользователя по ID. Состояние перечитывается из файла: части
+        могли быть приняты другим процессом, а загрузка - завершена в нём же
+        :raises HTTPException: 404, если сессии нет или она чужая
+        """
+        stored = _read_meta(os.path.join(PARTIAL_DIR, f"{upload_id}.json")) if upload_id.isalnum() else None
+        session = self._sessions.get(upload_id)
+        if stored is None:
+            self._sessions.pop(upload_id, None)
+            session = None
+        elif session is None:
+            session = self._sessions[upload_id] = stored
+        else:
+            _merge(session, stored)
+        if session is None or session.user_id != user_id:
+            raise HTTPException(status_code=404, detail="Сессия загрузки не найдена")
+        return session
+
+    async def write_chunk(self, session: UploadSession, offset: int, chunks: AsyncIterator[bytes]) -> int:
+        """
+        Запись части по смещению прямо из потока тела запроса
+        :param session: Сессия загрузки
+        :param offset: Смещение части в файле
+        :param chunks: Поток байт части
+        :return: Количество записанных байт
+        """
+        if offset < 0 or offset > session.size:
+            raise HTTPException(status_code=416, detail="Смещение за пределами файла")
+        written = 0
+        fd = os.open(session.path, os.O_WRONLY)
+        try:
+            async for data in chunks:
+                if offset + written + len(data) > session.size:
+                    raise HTTPException(status_code=416, detail="Часть выходит за пределы файла")
+                await asyncio.to_thread(_pwrite, fd, data, offset + written)
+                written += len(data)
+        finally:
+            os.close(fd)
+            # Даже оборванная часть засчитывается в той длине, что успела записаться
+            if written:
+                session.add_range(offset, offset + written)
+                await self._save(session)
+        return written
+
+    async def _save(self, session: UploadSession):
+        # Запись состояния под блокировкой: внутри процесса - asyncio, между процессами -
+        # блокировкой файла, с перечитыванием и слиянием диапазонов, принятых другими процессами
+        lock = self._locks.setdefault(session.id, asyncio.Lock())
+        async with lock:
+            await asyncio.to_thread(_merge_and_write_meta, session)
+
+    async def finish(self, session: UploadSession, sha256: str) -> str:
+        """
+        Проверка полноты и контрольной суммы, перенос файла в каталог загрузок
+        :param session: Сессия загрузки
+        :param sha256: Ожидаемая контрольная сумма SHA-256 в hex
+        :return: Путь к итоговому файлу
+        :raises HTTPException: 409, если загрузка неполная или уже завершена
+        """
+        lock = self._locks.setdefault(session.id, asyncio.Lock())
+        async with lock:
+            # Параллельный запрос завершения ждёт блокировку и застаёт сессию уже закрытой
+            if self._sessions.get(session.id) is not session:
+                raise HTTPException(status_code=409, detail="Загрузка уже завершена")
+            if not session.complete:
+                raise HTTPException(status_code=409, detail="Получены не все части файла")
+            actual = await asyncio.to_thread(_sha256, session.path)
+            if actual != sha256.lower():
+                raise HTTPException(status_code=422, detail="Контрольная сумма не совпадает")
+            file_location = f"{UPLOAD_DIR}/{_stored_name(session)}"
+            try:
+                await asyncio.to_thread(os.replace, session.path, file_location)
+            except FileNotFoundError:
+                # Загрузку успел завершить другой процесс
+                self._sessions.pop(session.id, None)
+                raise HTTPException(status_code=409, detail="Загрузка уже завершена")
+            await self.abort(session)
+        return file_location
+
+    async def abort(self, session: UploadSession):
+        """
+        Удаление сессии и её временных файлов
+        """
+        self._sessions.pop(session.id, None)
+        self._locks.pop(session.id, None)
+        for path in (session.path, session.meta_path, session.lock_path):
+            try:
+                await asyncio.to_thread(os.remove, path)
+            except FileNotFoundError:
+                pass
+
+    async def cleanup_expired(self) -> int:
+        """
+        Удаление брошенных сессий, в которые ttl секунд не приходило частей
+        :return: Количество удалённых сессий
+        """
+        if not os.path.isdir(PARTIAL_DIR):
+            return 0
+        cutoff = time.time() - self.ttl
+        names = await asyncio.to_thread(os.listdir, PARTIAL_DIR)
+        removed = 0
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            session = _read_meta(os.path.join(PARTIAL_DIR, name))
+            if session is not None and session.updated_at < cutoff:
+                await self.abort(session)
+                removed += 1
+        return removed
+
+
+chunked_uploads = ChunkedUploads(max_size=settings.UPLOAD_MAX_SIZE, ttl=settings.UPLOAD_SESSION_TTL)
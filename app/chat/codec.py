@@ -0,0 +1,82 @@
+import json
+from fastapi import WebSocket, WebSocketDisconnect
+from app.chat.schemas import socket_action_adapter
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack необязателен, остаётся JSON
+    msgpack = None
+
+
+async def _receive_frame(websocket: WebSocket, kind: str):
+    """
+    Следующий кадр нужного типа: "text" или "bytes"
+    :raises ValueError: Если пришёл кадр другого типа
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    data = message.get(kind)
+    if data is None:
+        expected = "текстовый" if kind == "text" else "бинарный"
+        raise ValueError(f"Ожидался {expected} кадр")
+    return data
+
+
+class JsonCodec:
+    """
+    Текстовые JSON-кадры, используются по умолчанию
+    """
+    subprotocol = "bittalk.json"
+
+    @staticmethod
+    def encode(message: dict) -> str:
+        return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    async def send(websocket: WebSocket, data: str):
+        await websocket.send_text(data)
+
+    @staticmethod
+    async def receive(websocket: WebSocket):
+        # Разбор и валидация выполняются за один проход в pydantic-core
+        return socket_action_adapter.validate_json(await _receive_frame(websocket, "text"))
+
+
+class MsgpackCodec:
+    """
+    Бинарные кадры MessagePack
+    """
+    subprotocol = "bittalk.msgpack"
+
+    @staticmethod
+    def encode(message: dict) -> bytes:
+        return msgpack.packb(message, use_bin_type=True)
+
+    @staticmethod
+    async def send(websocket: WebSocket, data: bytes):
+        await websocket.send_bytes(data)
+
+    @staticmethod
+    async def receive(websocket: WebSocket):
+        data = msgpack.unpackb(await _receive_frame(websocket, "bytes"), raw=False)
+        return socket_action_adapter.validate_python(data)
+
+
+# Поддерживаемые подпротоколы в порядке предпочтения сервера
+CODECS = {JsonCodec.subprotocol: JsonCodec}
+if msgpack is not None:
+    CODECS[MsgpackCodec.subprotocol] = MsgpackCodec
+
+
+def negotiate_codec(websocket: WebSocket):
+    """
+    Выбор формата кадров по заголовку Sec-WebSocket-Protocol.
+    Сжатие permessage-deflate согласуется самим uvicorn на уровне рукопожатия.
+    :param websocket: Вебсокет-соединение до вызова accept
+    :return: Кодек и выбранный подпротокол (None, если клиент его не указал)
+    """
+    for subprotocol in websocket.scope.get("subprotocols", []):
+        if subprotocol in CODECS:
+            return CODECS[subprotocol], subprotocol
+    return JsonCodec, None
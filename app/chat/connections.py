@@ -0,0 +1,184 @@
+import asyncio
+import random
+from typing import Callable, Dict, List, Set
+from fastapi import WebSocket, status
+from app.chat.codec import JsonCodec
+from app.config import settings
+
+
+class ConnectionManager:
+    """
+    Реестр вебсокет-соединений, проиндексированный по чатам и по пользователям.
+    Одно соединение пользователя может быть подписано на несколько чатов.
+    """
+
+    def __init__(self, send_timeout: float = 5.0):
+        # Сколько секунд ждать отправки одному соединению, прежде чем отключить его как медленное
+        self.send_timeout = send_timeout
+        # chat_id -> соединения, подписанные на чат
+        self.by_chat: Dict[int, Set[WebSocket]] = {}
+        # user_id -> соединения пользователя
+        self.by_user: Dict[int, Set[WebSocket]] = {}
+        # соединение -> (user_id, чаты, на которые оно подписано)
+        self.subscriptions: Dict[WebSocket, tuple[int, Set[int]]] = {}
+        # соединение -> кодек, согласованный при рукопожатии
+        self.codecs: Dict[WebSocket, type] = {}
+        # Процесс останавливается, новые соединения не принимаются
+        self.draining = False
+        # Обработчики появления первого и закрытия последнего соединения пользователя
+        self.presence_listeners: List[Callable[[int, bool], None]] = []
+        self.stats = {"slow_dropped": 0}
+
+    def connect(self, websocket: WebSocket, user_id: int, codec: type = JsonCodec):
+        """
+        Регистрация нового соединения пользователя
+        """
+        first = user_id not in self.by_user
+        self.by_user.setdefault(user_id, set()).add(websocket)
+        self.subscriptions[websocket] = (user_id, set())
+        self.codecs[websocket] = codec
+        if first:
+            self._notify_presence(user_id, True)
+
+    def disconnect(self, websocket: WebSocket):
+        """
+        Удаление соединения из всех индексов
+        """
+        self.codecs.pop(websocket, None)
+        entry = self.subscriptions.pop(websocket, None)
+        if entry is None:
+            return
+        user_id, chat_ids = entry
+        for chat_id in chat_ids:
+            self._discard(self.by_chat, chat_id, websocket)
+        self._discard(self.by_user, user_id, websocket)
+        if user_id not in self.by_user:
+            self._notify_presence(user_id, False)
+
+    def _notify_presence(self, user_id: int, online: bool):
+        for listener in self.presence_listeners:
+            listener(user_id, online)
+
+    def subscribe(self, websocket: WebSocket, chat_id: int):
+        """
+        Подписка соединения на события чата
+        """
+        self.subscriptions[websocket][1].add(chat_id)
+        self.by_chat.setdefault(chat_id, set()).add(websocket)
+
+    def unsubscribe(self, websocket: WebSocket, chat_id: int):
+        """
+        Отписка соединения от событий чата
+        """
+        entry = self.subscriptions.get(websocket)
+        if entry is not None:
+            entry[1].discard(chat_id)
+        self._discard(self.by_chat, chat_id, websocket)
+
+    def subscribe_user(self, user_id: int, chat_id: int):
+        """
+        Подписка всех соединений пользователя на чат, например после создания чата
+        """
+        for websocket in self.by_user.get(user_id, ()):
+            self.subscribe(websocket, chat_id)
+
+    def chat_connections(self, chat_id: int) -> list[WebSocket]:
+        return list(self.by_chat.get(chat_id, ()))
+
+    def chat_subscribers(self, chat_id: int) -> Set[int]:
+        """
+        Пользователи, у которых в этом процессе есть соединение, подписанное на чат
+        """
+        return {self.subscriptions[websocket][0] for websocket in self.by_chat.get(chat_id, ())}
+
+    def user_connections(self, user_id: int) -> list[WebSocket]:
+        return list(self.by_user.get(user_id, ()))
+
+    async def broadcast(self, chat_id: int, message: dict):
+        """
+        Отправка события всем соединениям, подписанным на чат
+        """
+        await self._send_all(self.chat_connections(chat_id), message)
+
+    async def send_to_user(self, user_id: int, message: dict):
+        """
+        Отправка события всем соединениям пользователя
+        """
+        await self._send_all(self.user_connections(user_id), message)
+
+    async def send(self, websocket: WebSocket, message: dict):
+        """
+        Отправка события одному соединению в его формате кадров
+        """
+        codec = self.codecs.get(websocket, JsonCodec)
+        await codec.send(websocket, codec.encode(message))
+
+    async def _send_all(self, connections: list[WebSocket], message: dict):
+        # Событие кодируется один раз для каждого используемого формата
+        encoded = {}
+        for connection in connections:
+            codec = self.codecs.get(connection, JsonCodec)
+            if codec not in encoded:
+                encoded[codec] = codec.encode(message)
+        # Соединения получают событие параллельно, и каждое ждёт не дольше send_timeout:
+        # медленный клиент не задерживает рассылку остальным и не занимает фоновый обработчик
+        await asyncio.gather(*(
+            self._send_or_drop(connection, self.codecs.get(connection, JsonCodec), encoded)
+            for connection in connections
+        ))
+
+    async def _send_or_drop(self, connection: WebSocket, codec: type, encoded: dict):
+        try:
+            await asyncio.wait_for(codec.send(connection, encoded[codec]), self.send_timeout)
+        except asyncio.TimeoutError:
+            # Клиент не успевает читать: отключаем его, пропущенное он догрузит
+            # после переподключения через журнал изменений чата
+            self.stats["slow_dropped"] += 1
+            self.disconnect(connection)
+            try:
+                await asyncio.wait_for(connection.close(code=status.WS_1013_TRY_AGAIN_LATER),
+                                       self.send_timeout)
+            except Exception:
+                pass
+        except Exception:
+            # Соединение уже закрыто, убираем его из реестра
+            self.disconnect(connection)
+
+    async def drain(self, max_jitter: float, grace: float):
+        """
+        Плавное отключение клиентов перед остановкой процесса: каждому соединению
+        отправляется подсказка переподключиться со случайной задержкой, чтобы клиенты
+        не пришли на новый процесс одновременно, затем соединения закрываются.
+        :param max_jitter: Максимальная задержка переподключения в секундах
+        :param grace: Сколько секунд ждать перед закрытием соединений
+        """
+        self.draining = True
+        connections = list(self.subscriptions)
+        for connection in connections:
+            try:
+                await self.send(connection, {
+                    "action": "reconnect",
+                    "retry_after_ms": int(random.uniform(0, max_jitter) * 1000),
+                })
+            except Exception:
+                pass
+        if connections:
+            await asyncio.sleep(grace)
+        for connection in connections:
+            try:
+                await connection.close(code=status.WS_1012_SERVICE_RESTART)
+            except Exception:
+                pass
+            self.disconnect(connection)
+
+    @staticmethod
+    def _discard(index: Dict[int, Set[WebSocket]], key: int, websocket: WebSocket):
+        connections = index.get(key)
+        if connections is None:
+            return
+        connections.discard(websocket)
+        if not connections:
+            del index[key]
+
+
+manager = ConnectionManager(send_timeout=settings.WS_SEND_TIMEOUT)
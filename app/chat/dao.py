@@ -1,13 +1,22 @@
+import asyncio
+import json
 import os
 from datetime import datetime
 from fastapi import HTTPException, UploadFile, File
 from app.chat.schemas import MessageStatus
 from app.dao.base import BaseDAO
-from app.chat.models import Message, Chat
-from app.database import async_session_maker
+from app.chat.models import Message, Chat, ChatEvent, chat_user_association, PendingNotification, NotificationDigest, \
+    MessageIdempotencyKey
+from app.database import async_session_maker, read_session_maker
 from app.users.models import User
-from sqlalchemy import select
+from sqlalchemy import bindparam, values, select, lambda_stmt, and_, or_, column, func, distinct, cast, Integer, String, insert as sqlalchemy_insert, update as sqlalchemy_update, delete as sqlalchemy_delete
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm.attributes import set_committed_value
 from app.chat.models import File
+from app.chat.cache import hot_tail_cache
+from app.chat.membership import membership
+from app.chat.shards import shard_map
 
 
 class MessagesDAO(BaseDAO):
@@ -21,18 +30,285 @@ class MessagesDAO(BaseDAO):
         :param chat_id: ID чата
         :return: Список сообщений
         """
-        async with async_session_maker() as session:
+        session_maker = await shard_map.session_maker(chat_id, read=True)
+        async with session_maker() as session:
+            # Лямбда-запрос строится один раз, chat_id подставляется как параметр
+            query = lambda_stmt(lambda: select(Message).where(Message.chat_id == chat_id).order_by(Message.id))
+            result = await session.execute(query)
+            messages = result.scalars().all()
+            return messages or []
+
+    @classmethod
+    async def get_history_rows(cls, chat_id: int, limit: int | None = None, replica: bool = True,
+                               before_id: int | None = None):
+        """
+        Быстрое получение истории чата без загрузки ORM-объектов.
+        Выбираются только нужные столбцы, вложения подтягиваются
+        одним запросом на всю выборку.
+        :param chat_id: ID чата
+        :param limit: Количество последних сообщений, None - вся история
+        :param replica: Разрешить чтение с реплики
+        :param before_id: Только сообщения с ID меньше этого (постраничная загрузка старой истории)
+        :return: Список словарей в формате MessageRead без recipient_id
+        """
+        session_maker = await shard_map.session_maker(chat_id, read=replica)
+        async with session_maker() as session:
+            messages_query = (
+                select(cls.model.id, cls.model.sender_id,
+                       cls.model.content, cls.model.status)
+                .where(cls.model.chat_id == chat_id)
+            )
+            files_query = (
+                select(File.message_id, File.id, File.filename, File.file_path)
+                .join(cls.model, File.message_id == cls.model.id)
+                .where(cls.model.chat_id == chat_id)
+                .order_by(File.id)
+            )
+            if before_id is not None:
+                messages_query = messages_query.where(cls.model.id < before_id)
+                files_query = files_query.where(File.message_id < before_id)
+            if limit is None:
+                message_rows = (await session.execute(
+                    messages_query.order_by(cls.model.id))).all()
+            else:
+                message_rows = (await session.execute(
+                    messages_query.order_by(cls.model.id.desc()).limit(limit))).all()
+                message_rows.reverse()
+                if message_rows:
+                    files_query = files_query.where(File.message_id >= message_rows[0][0])
+            file_rows = (await session.execute(files_query)).all() if message_rows else []
+
+        files_by_message: dict[int, list[dict]] = {}
+        for message_id, file_id, filename, file_path in file_rows:
+            files_by_message.setdefault(message_id, []).append({
+                "id": file_id,
+                "filename": filename,
+                "file_path": file_path,
+                "chat_id": chat_id,
+            })
+
+        return [
+            cls.history_row(message_id, chat_id, sender_id, content, status,
+                            files_by_message.get(message_id, []))
+            for message_id, sender_id, content, status in message_rows
+        ]
+
+    @staticmethod
+    def history_row(message_id: int, chat_id: int, sender_id: int, content: str,
+                    status: str, files: list[dict] = None) -> dict:
+        """
+        Представление сообщения в истории чата
+        :return: Словарь в формате MessageRead без recipient_id
+        """
+        return {
+            "chat_id": chat_id,
+            "sender_id": sender_id,
+            "content": content,
+            "status": status,
+            "id": message_id,
+            "read_by": [],
+            "files": files or [],
+        }
+
+    @classmethod
+    async def get_history(cls, chat_id: int, recipient_id: int, limit: int | None = None,
+                          before_id: int | None = None):
+        """
+        Получение истории чата: сначала из кэша последних сообщений,
+        затем из БД с прогревом кэша
+        :param chat_id: ID чата
+        :param recipient_id: ID пользователя, запрашивающего историю
+        :param limit: Количество последних сообщений, None - вся история
+        :param before_id: Только сообщения с ID меньше этого; такие страницы читаются мимо кэша
+        :return: Список словарей в формате MessageRead
+        """
+        if before_id is not None:
+            rows = await cls.get_history_rows(chat_id, limit, before_id=before_id)
+            return [{**row, "recipient_id": recipient_id} for row in rows]
+        # Номер последнего события читается до снимка: запись, успевшая между ними,
+        # только сделает снимок новее номера, и следующее чтение его перечитает
+        seq = (await ChatEventsDAO.last_seqs([chat_id])).get(chat_id, 0)
+        rows = hot_tail_cache.get(chat_id, limit, seq)
+        if rows is None:
+            version = hot_tail_cache.version(chat_id)
+            # Результат попадает в общий кэш, поэтому читаем с основной БД:
+            # отстающая реплика оставила бы в кэше дыру в истории
+            rows = await cls.get_history_rows(chat_id, limit, replica=False)
+            complete = limit is None or len(rows) < limit
+            hot_tail_cache.store(chat_id, rows, complete, version, seq)
+        return [{**row, "recipient_id": recipient_id} for row in rows]
+
+    @classmethod
+    async def get_recent_rows(cls, chat_ids: list[int], limit: int) -> dict[int, list[dict]]:
+        """
+        Последние сообщения нескольких чатов: на каждом шарде один запрос сообщений
+        с оконной функцией и один запрос вложений, шарды опрашиваются параллельно.
+        Читается основная БД, так как результат попадает в кэш.
+        :param chat_ids: ID чатов
+        :param limit: Количество последних сообщений каждого чата
+        :return: chat_id -> список словарей в формате MessageRead без recipient_id
+        """
+        placement = await shard_map.shards_for(chat_ids)
+        by_shard: dict[str, list[int]] = {}
+        for chat_id in chat_ids:
+            by_shard.setdefault(placement[chat_id], []).append(chat_id)
+
+        async def fetch(shard: str, shard_chat_ids: list[int]):
+            async with shard_map.maker(shard)() as session:
+                ranked = (
+                    select(cls.model.id, cls.model.chat_id, cls.model.sender_id,
+                           cls.model.content, cls.model.status,
+                           func.row_number().over(partition_by=cls.model.chat_id,
+                                                  order_by=cls.model.id.desc()).label("position"))
+                    .where(cls.model.chat_id.in_(shard_chat_ids))
+                    .subquery()
+                )
+                message_rows = (await session.execute(
+                    select(ranked.c.id, ranked.c.chat_id, ranked.c.sender_id,
+                           ranked.c.content, ranked.c.status)
+                    .where(ranked.c.position <= limit)
+                    .order_by(ranked.c.chat_id, ranked.c.id)
+                )).all()
+                file_rows = (await session.execute(
+                    select(File.message_id, File.id, File.filename, File.file_path)
+                    .where(File.message_id.in_([row[0] for row in message_rows]))
+                    .order_by(File.id)
+                )).all() if message_rows else []
+                return message_rows, file_rows
+
+        rows: dict[int, list[dict]] = {chat_id: [] for chat_id in chat_ids}
+        for message_rows, file_rows in await asyncio.gather(
+                *(fetch(shard, ids) for shard, ids in by_shard.items())):
+            files_by_message: dict[int, list[dict]] = {}
+            for message_id, file_id, filename, file_path in file_rows:
+                files_by_message.setdefault(message_id, []).append({
+                    "id": file_id,
+                    "filename": filename,
+                    "file_path": file_path,
+                })
+            for message_id, chat_id, sender_id, content, status in message_rows:
+                files = [{**file, "chat_id": chat_id} for file in files_by_message.get(message_id, [])]
+                rows[chat_id].append(cls.history_row(message_id, chat_id, sender_id, content, status, files))
+        return rows
+
+    @classmethod
+    async def get_recent_history(cls, chat_ids: list[int], recipient_id: int, limit: int):
+        """
+        Последние сообщения нескольких чатов: из кэша, а промахи - одной выборкой на шард
+        с прогревом кэша
+        :param chat_ids: ID чатов
+        :param recipient_id: ID пользователя, запрашивающего историю
+        :param limit: Количество последних сообщений каждого чата
+        :return: chat_id -> список словарей в формате MessageRead
+        """
+        history = {}
+        versions = {}
+        seqs = await ChatEventsDAO.last_seqs(chat_ids)
+        for chat_id in chat_ids:
+            rows = hot_tail_cache.get(chat_id, limit, seqs.get(chat_id, 0))
+            if rows is None:
+                versions[chat_id] = hot_tail_cache.version(chat_id)
+            else:
+                history[chat_id] = rows
+        if versions:
+            fetched = await cls.get_recent_rows(list(versions), limit)
+            for chat_id, rows in fetched.items():
+                hot_tail_cache.store(chat_id, rows, len(rows) < limit, versions[chat_id],
+                                     seqs.get(chat_id, 0))
+                history[chat_id] = rows
+        return {
+            chat_id: [{**row, "recipient_id": recipient_id} for row in history[chat_id]]
+            for chat_id in chat_ids
+        }
+
+    @classmethod
+    async def get_inbox_stats(cls, chat_ids: list[int], user_id: int) -> dict[int, tuple[int, str, int]]:
+        """
+        Последнее сообщение и количество непрочитанных для каждого чата пользователя:
+        два запроса на шард, шарды опрашиваются параллельно
+        :param chat_ids: ID чатов пользователя
+        :param user_id: ID пользователя
+        :return: chat_id -> (ID последнего сообщения, его текст, количество непрочитанных);
+            чатов без сообщений в результате нет
+        """
+        placement = await shard_map.shards_for(chat_ids)
+        by_shard: dict[str, list[int]] = {}
+        for chat_id in chat_ids:
+            by_shard.setdefault(placement[chat_id], []).append(chat_id)
+        read_marks = await ChatDAO.get_read_marks(chat_ids, user_id)
+
+        async def fetch(shard: str, shard_chat_ids: list[int]):
+            async with shard_map.maker(shard, read=True)() as session:
+                totals = (
+                    select(cls.model.chat_id, func.max(cls.model.id).label("last_id"))
+                    .where(cls.model.chat_id.in_(shard_chat_ids))
+                    .group_by(cls.model.chat_id)
+                    .subquery()
+                )
+                last = await session.execute(
+                    select(totals.c.chat_id, totals.c.last_id, cls.model.content)
+                    .join(cls.model, cls.model.id == totals.c.last_id)
+                )
+                # Непрочитанные - сообщения после отметки участника: по диапазону
+                # индекса (chat_id, id) на каждый чат, без просмотра всей истории
+                marks = values(column("chat_id", Integer), column("last_read_id", Integer), name="marks").data(
+                    [(chat_id, read_marks.get(chat_id, 0)) for chat_id in shard_chat_ids]
+                )
+                unread = await session.execute(
+                    select(cls.model.chat_id, func.count())
+                    .join(marks, and_(cls.model.chat_id == marks.c.chat_id, cls.model.id > marks.c.last_read_id))
+                    .where(cls.model.sender_id != user_id)
+                    .group_by(cls.model.chat_id)
+                )
+                return last.all(), dict(unread.all())
+
+        stats = {}
+        for rows, unread_counts in await asyncio.gather(*(fetch(shard, ids) for shard, ids in by_shard.items())):
+            for chat_id, last_id, content in rows:
+                stats[chat_id] = (last_id, content, unread_counts.get(chat_id, 0))
+        return stats
+
+    @classmethod
+    async def stream_export(cls, chat_id: int, after_id: int = 0, batch_size: int = 1000):
+        """
+        Потоковая выгрузка сообщений чата через серверный курсор.
+        В памяти одновременно находится не больше одной пачки сообщений.
+        :param chat_id: ID чата
+        :param after_id: ID сообщения, после которого продолжить выгрузку
+        :param batch_size: Размер пачки
+        :return: Асинхронный генератор списков словарей с сообщениями и вложениями
+        """
+        session_maker = await shard_map.session_maker(chat_id, read=True)
+        async with session_maker() as session:
             query = (
                 select(cls.model)
-                .filter(cls.model.chat_id == chat_id)
+                .where(cls.model.chat_id == chat_id, cls.model.id > after_id)
                 .order_by(cls.model.id)
+                .execution_options(yield_per=batch_size)
             )
-            result = await session.execute(query)
-            messages = result.scalars().all()
-            for message in messages:
-                message.chat_id = chat_id
-
-            return messages or []
+            result = await session.stream_scalars(query)
+            async for messages in result.partitions():
+                yield [
+                    {
+                        "id": message.id,
+                        "chat_id": message.chat_id,
+                        "sender_id": message.sender_id,
+                        "recipient_id": message.recipient_id,
+                        "content": message.content,
+                        "status": message.status,
+                        "read_by": message.read_by,
+                        "is_file": message.is_file,
+                        "created_at": message.created_at.isoformat() if message.created_at else None,
+                        "edited_at": message.edited_at.isoformat() if message.edited_at else None,
+                        "files": [
+                            {"id": file.id, "filename": file.filename, "file_path": file.file_path}
+                            for file in message.files
+                        ],
+                    }
+                    for message in messages
+                ]
+                # Отпускаем выгруженные объекты, чтобы память не росла с размером чата
+                session.expunge_all()
 
     @classmethod
     async def add_message(cls, chat_id: int, sender_id: int, recipient_id: int, content: str,
@@ -48,9 +324,13 @@ class MessagesDAO(BaseDAO):
         :param is_file: ...
         :return: Сообщение
         """
-        async with async_session_maker() as session:
+        session_maker = await shard_map.session_maker(chat_id)
+        # При шардировании ID выдаёт основная БД, иначе сама таблица
+        message_id = await shard_map.next_id(Message)
+        async with session_maker() as session:
             async with session.begin():
                 new_message = cls.model(
+                    id=message_id,
                     chat_id=chat_id,
                     sender_id=sender_id,
                     recipient_id = recipient_id,
@@ -60,20 +340,126 @@ class MessagesDAO(BaseDAO):
                     is_file = is_file
                 )
                 session.add(new_message)
-                await session.commit()
-                return new_message
+                await session.flush()
+                row = cls.history_row(new_message.id, chat_id, sender_id, content, status)
+                await ChatEventsDAO.record(
+                    session, new_message, chat_id, "new", new_message.id, sender_id, row)
+                await ChatEventsDAO.commit(session)
+            hot_tail_cache.append(chat_id, row, new_message.seq)
+            return new_message
+
+    @classmethod
+    async def add_message_once(cls, chat_id: int, sender_id: int, recipient_id: int, content: str,
+                               status: str, client_id: str, read_by: str = '', is_file: bool = False):
+        """
+        Добавление сообщения с ключом идемпотентности: повторная отправка с тем же
+        client_id возвращает уже сохранённое сообщение без новой вставки
+        :param client_id: ID сообщения, сгенерированный клиентом
+        :return: Пара (сообщение, True, если сообщение создано этим вызовом);
+                 (None, False), если client_id уже занят рассылкой по вебсокету без записи
+        """
+        session_maker = await shard_map.session_maker(chat_id)
+        message_id = await shard_map.next_id(Message)
+        key_id = await shard_map.next_id(MessageIdempotencyKey)
+        key_values = {"id": key_id} if key_id is not None else {}
+        async with session_maker() as session:
+            async with session.begin():
+                new_message = cls.model(
+                    id=message_id,
+                    chat_id=chat_id,
+                    sender_id=sender_id,
+                    recipient_id=recipient_id,
+                    content=content,
+                    status=status,
+                    read_by=read_by,
+                    is_file=is_file
+                )
+                session.add(new_message)
+                await session.flush()
+                # Параллельный повтор ждёт на уникальном индексе до фиксации первой вставки
+                claimed = (await session.execute(
+                    pg_insert(MessageIdempotencyKey)
+                    .values(sender_id=sender_id, client_id=client_id, message_id=new_message.id, **key_values)
+                    .on_conflict_do_nothing(index_elements=["sender_id", "client_id"])
+                    .returning(MessageIdempotencyKey.id)
+                )).scalar()
+                if claimed is None:
+                    await session.rollback()
+                else:
+                    row = cls.history_row(new_message.id, chat_id, sender_id, content, status)
+                    await ChatEventsDAO.record(
+                        session, new_message, chat_id, "new", new_message.id, sender_id, row)
+                    await ChatEventsDAO.commit(session)
+            if claimed is not None:
+                hot_tail_cache.append(chat_id, row, new_message.seq)
+                return new_message, True
+
+            # ID в ключе, записанном рассылкой по вебсокету, прислал клиент,
+            # поэтому сообщение должно быть его собственным и из этого же чата
+            message = (await session.execute(
+                select(cls.model)
+                .join(MessageIdempotencyKey, MessageIdempotencyKey.message_id == cls.model.id)
+                .where(MessageIdempotencyKey.sender_id == sender_id,
+                       MessageIdempotencyKey.client_id == client_id,
+                       cls.model.sender_id == sender_id,
+                       cls.model.chat_id == chat_id)
+            )).scalar_one_or_none()
+            return message, False
+
+    @staticmethod
+    async def claim_client_id(chat_id: int, sender_id: int, client_id: str, message_id: int = 0) -> bool:
+        """
+        Отметка отправки, которая только рассылается по вебсокету, в том же уникальном индексе,
+        что и у add_message_once, чтобы повтор через другой процесс не разослался второй раз
+        :param message_id: ID сохранённого сообщения, если клиент его передал; 0 - записи нет
+        :return: False, если отправка с этим client_id уже была
+        """
+        session_maker = await shard_map.session_maker(chat_id)
+        key_id = await shard_map.next_id(MessageIdempotencyKey)
+        key_values = {"id": key_id} if key_id is not None else {}
+        async with session_maker() as session:
+            async with session.begin():
+                claimed = (await session.execute(
+                    pg_insert(MessageIdempotencyKey)
+                    .values(sender_id=sender_id, client_id=client_id, message_id=message_id, **key_values)
+                    .on_conflict_do_nothing(index_elements=["sender_id", "client_id"])
+                    .returning(MessageIdempotencyKey.id)
+                )).scalar()
+        return claimed is not None
+
+    @staticmethod
+    async def delete_idempotency_keys(created_before: datetime) -> int:
+        """
+        Удаление ключей идемпотентности, повтор с которыми уже невозможен
+        :param created_before: Удаляются ключи старше этого момента
+        :return: Количество удалённых ключей
+        """
+        deleted = 0
+        for session_maker in shard_map.makers().values():
+            async with session_maker() as session:
+                async with session.begin():
+                    result = await session.execute(
+                        sqlalchemy_delete(MessageIdempotencyKey)
+                        .where(MessageIdempotencyKey.created_at < created_before)
+                    )
+                    deleted += result.rowcount
+        return deleted
 
     @classmethod
-    async def mark_message_as_read(cls, message_id: int, user_id: int):
+    async def mark_message_as_read(cls, message_id: int, user_id: int, chat_id: int | None = None):
         """
         Отметка сообщения как прочитанное
         :param message_id: ID сообщения
         :param user_id: ID пользователя
+        :param chat_id: ID чата, если он известен: шард берётся по нему, сообщения других чатов не ищутся
         :return: Сообщение, если оно было найдено, иначе None
         """
-        async with async_session_maker() as session:
+        session_maker = await shard_map.session_maker_for_message(message_id, chat_id)
+        async with session_maker() as session:
             async with session.begin():
                 message = await session.get(cls.model, message_id)
+                if message and chat_id is not None and message.chat_id != chat_id:
+                    message = None
                 if message:
                     read_by_ids = []
                     if message.read_by:
@@ -84,13 +470,24 @@ class MessagesDAO(BaseDAO):
                         read_by_ids.append(str(user_id))
                         # преобразуем обратно в строку
                         message.read_by = ",".join(read_by_ids)
-                        await session.commit()
+                        await ChatEventsDAO.record(
+                            session, message, message.chat_id, "read", message_id, user_id)
+                        await ChatEventsDAO.commit(session)
+                        hot_tail_cache.advance(message.chat_id, message.seq)
+                    await ChatDAO.advance_read_mark(message.chat_id, user_id, message.id)
                     return message
                 return None
 
     @classmethod
     async def delete_message(cls, message_id: int, user_id: int):
-        async with async_session_maker() as session:
+        """
+        Удаление сообщения отправителем
+        :param message_id: ID сообщения
+        :param user_id: ID пользователя
+        :return: Удалённое сообщение
+        """
+        session_maker = await shard_map.session_maker_for_message(message_id)
+        async with session_maker() as session:
             async with session.begin():
                 message = await session.get(Message, message_id)
                 if not message:
@@ -98,13 +495,117 @@ class MessagesDAO(BaseDAO):
 
                 if message.sender_id != user_id:
                     raise HTTPException(status_code = 403, detail = "Невозможно удалить данное сообщение")
+                # ORM обнуляет message_id у вложений, записи и файлы на диске
+                # затем удаляет сборщик мусора (app/chat/uploads_gc.py)
                 await session.delete(message)
-                await session.commit()
-                return True
+                await ChatEventsDAO.record(
+                    session, message, message.chat_id, "delete", message_id, user_id)
+                await ChatEventsDAO.commit(session)
+            hot_tail_cache.remove(message.chat_id, message_id, message.seq)
+            return message
+
+    @classmethod
+    async def mark_delivered(cls, acks: list[tuple[int, int, int, list[int]]]):
+        """
+        Отметка подтверждённых сообщений как доставленных одним UPDATE на шард для всех его чатов.
+        Обновляются только сообщения в статусе "отправлено" от других отправителей,
+        поэтому прочитанные сообщения не откатываются в "доставлено".
+        :param acks: Список (chat_id, user_id, after_id, message_ids): пользователь подтвердил
+            получение message_ids, все сообщения чата до after_id уже учтены ранее
+        :return: Пара: список (ID сообщения, ID чата, ID отправителя) изменённых сообщений и
+            новые отметки {(chat_id, user_id): ID}, до которых доставлены все сообщения без пропусков
+        """
+        if not acks:
+            return [], {}
+        placement = await shard_map.shards_for({ack[0] for ack in acks})
+        by_shard: dict[str, list[tuple[int, int, int, list[int]]]] = {}
+        for ack in acks:
+            by_shard.setdefault(placement[ack[0]], []).append(ack)
+        # Одна пара запросов на шард, шарды обновляются параллельно
+        results = await asyncio.gather(*(
+            cls._mark_delivered_on(shard_map.maker(shard), shard_acks)
+            for shard, shard_acks in by_shard.items()
+        ))
+        delivered = [row for rows, _ in results for row in rows]
+        watermarks = {key: up_to for _, marks in results for key, up_to in marks.items()}
+        for message_id, chat_id, _ in delivered:
+            hot_tail_cache.update(chat_id, message_id, status=MessageStatus.DELIVERED.value)
+        return delivered, watermarks
+
+    @staticmethod
+    def _unnest(name: str, **columns: list[int]):
+        """
+        Набор строк из параллельных массивов: unnest($1::int[], $2::int[], ...) AS name(...).
+        Каждый столбец - один параметр запроса, поэтому число параметров не зависит
+        от числа строк и не упирается в предел протокола PostgreSQL (32767)
+        """
+        return (
+            func.unnest(*(bindparam(None, data, type_=ARRAY(Integer)) for data in columns.values()))
+            .table_valued(*(column(key, Integer) for key in columns))
+            .render_derived(name=name)
+        )
+
+    @classmethod
+    def _delivered_queries(cls, acks: list[tuple[int, int, int, list[int]]]):
+        acked_rows = [(chat_id, user_id, message_id)
+                      for chat_id, user_id, _, message_ids in acks for message_id in message_ids]
+        acked = cls._unnest(
+            "acked",
+            chat_id=[row[0] for row in acked_rows],
+            user_id=[row[1] for row in acked_rows],
+            message_id=[row[2] for row in acked_rows],
+        )
+        bounds = cls._unnest(
+            "bounds",
+            chat_id=[ack[0] for ack in acks],
+            user_id=[ack[1] for ack in acks],
+            after_id=[ack[2] for ack in acks],
+            up_to=[max(ack[3]) for ack in acks],
+        )
+        update_query = (
+            sqlalchemy_update(cls.model)
+            .where(
+                cls.model.chat_id == acked.c.chat_id,
+                cls.model.id == acked.c.message_id,
+                cls.model.sender_id != acked.c.user_id,
+                cls.model.status == MessageStatus.SENT.value,
+            )
+            .values(status=MessageStatus.DELIVERED.value)
+            .returning(cls.model.id, cls.model.chat_id, cls.model.sender_id)
+            .execution_options(synchronize_session=False)
+        )
+        # Отметка продвигается только до первого неподтверждённого сообщения:
+        # подтверждение, пришедшее не по порядку, не засчитывает пропущенные
+        gaps_query = (
+            select(bounds.c.chat_id, bounds.c.user_id, bounds.c.up_to, func.min(cls.model.id))
+            .select_from(bounds.outerjoin(cls.model, and_(
+                cls.model.chat_id == bounds.c.chat_id,
+                cls.model.id > bounds.c.after_id,
+                cls.model.id <= bounds.c.up_to,
+                cls.model.sender_id != bounds.c.user_id,
+                cls.model.status == MessageStatus.SENT.value,
+            )))
+            .group_by(bounds.c.chat_id, bounds.c.user_id, bounds.c.up_to)
+        )
+        return update_query, gaps_query
+
+    @classmethod
+    async def _mark_delivered_on(cls, session_maker, acks: list[tuple[int, int, int, list[int]]]):
+        update_query, gaps_query = cls._delivered_queries(acks)
+        async with session_maker() as session:
+            async with session.begin():
+                delivered = (await session.execute(update_query)).all()
+                gaps = await session.execute(gaps_query)
+                watermarks = {
+                    (chat_id, user_id): up_to if first_gap is None else first_gap - 1
+                    for chat_id, user_id, up_to, first_gap in gaps.all()
+                }
+                return delivered, watermarks
 
     @classmethod
     async def get_chat_id_for_message(cls, message_id: int):
-        async with async_session_maker() as session:
+        session_maker = await shard_map.session_maker_for_message(message_id)
+        async with session_maker() as session:
             query = select(cls.model.chat_id).where(cls.model.id == message_id)
             result = await session.execute(query)
             if not result:
@@ -114,27 +615,36 @@ class MessagesDAO(BaseDAO):
 
     @classmethod
     async def get_message_by_id(cls, message_id: int):
-        async with async_session_maker() as session:
+        session_maker = await shard_map.session_maker_for_message(message_id)
+        async with session_maker() as session:
             message = await session.get(cls.model, message_id)
             return message
 
     @classmethod
     async def update_message(cls, message_id: int, new_content: str):
-        async with async_session_maker() as session:
+        session_maker = await shard_map.session_maker_for_message(message_id)
+        async with session_maker() as session:
             async with session.begin():
                 message = await session.get(cls.model, message_id)
                 if message:
                     message.content = new_content
                     message.edited_at = datetime.utcnow()
-                    await session.commit()
+                    await ChatEventsDAO.record(
+                        session, message, message.chat_id, "edit", message_id, message.sender_id,
+                        {"content": new_content, "edited_at": message.edited_at.isoformat()})
+                    await ChatEventsDAO.commit(session)
+                    hot_tail_cache.update(message.chat_id, message_id, message.seq, content=new_content)
                     return message
                 raise HTTPException(status_code=404, detail="Сообщение не найдено")
 
     @classmethod
     async def forward_message(cls, original_message: Message, target_chat_id: int, sender_id: int):
-        async with async_session_maker() as session:
+        session_maker = await shard_map.session_maker(target_chat_id)
+        message_id = await shard_map.next_id(Message)
+        async with session_maker() as session:
             async with session.begin():
                 forwarded_message = cls.model(
+                    id = message_id,
                     chat_id = target_chat_id,
                     sender_id = sender_id,
                     recipient_id = None,
@@ -142,8 +652,194 @@ class MessagesDAO(BaseDAO):
                     status = MessageStatus.SENT
                 )
                 session.add(forwarded_message)
-                await session.commit()
-                return forwarded_message
+                await session.flush()
+                row = cls.history_row(forwarded_message.id, target_chat_id, sender_id,
+                                      forwarded_message.content, forwarded_message.status)
+                await ChatEventsDAO.record(
+                    session, forwarded_message, target_chat_id, "new", forwarded_message.id, sender_id, row)
+                await ChatEventsDAO.commit(session)
+            hot_tail_cache.append(target_chat_id, row, forwarded_message.seq)
+            return forwarded_message
+
+
+class ChatEventsDAO:
+    """DAO для журнала изменений чатов, используемого для догрузки пропущенных событий"""
+
+    @classmethod
+    async def record(cls, session, target, chat_id: int, kind: str, message_id: int = None,
+                     user_id: int = None, payload: dict = None):
+        """
+        Запись события в журнал чата вместе с изменением, сделанным в сессии.
+        Журнал и счётчик Chat.last_seq лежат в основной БД и всегда пишутся одной
+        транзакцией, поэтому в номерах нет пропусков. Если сообщения чата лежат в той же БД,
+        событие входит в транзакцию сессии. Для чата на отдельном шарде атомарной фиксации
+        двух БД нет: событие откладывается и пишется в основную БД после фиксации шарда
+        в ChatEventsDAO.commit, так что событие без сообщения появиться не может.
+        Номер события записывается в seq сообщения target
+        :param session: Сессия с открытой транзакцией
+        :param target: Сообщение, которому присваивается номер события
+        :param chat_id: ID чата
+        :param kind: Тип события: new, edit, delete или read
+        :param message_id: ID сообщения
+        :param user_id: ID пользователя, вызвавшего событие
+        :param payload: Дополнительные данные события
+        """
+        event = (chat_id, kind, message_id, user_id, payload)
+        if session.get_bind(Message) is session.get_bind(ChatEvent):
+            target.seq = await cls._write(session, *event)
+        else:
+            session.info.setdefault("chat_events", []).append((target, event))
+
+    @classmethod
+    async def commit(cls, session):
+        """
+        Фиксация сессии и отложенных событий журнала: сначала шард, затем основная БД,
+        затем номер события проставляется сообщению на шарде отдельным UPDATE.
+        Если после фиксации шарда запись журнала не удалась, изменение остаётся без события
+        (клиент увидит его при полной загрузке истории), а у сообщения - прежний номер
+        :param session: Сессия, в которой вызывался record
+        """
+        events = session.info.pop("chat_events", [])
+        await session.commit()
+        if not events:
+            return
+        for attempt in range(2):
+            try:
+                async with async_session_maker() as main_session:
+                    async with main_session.begin():
+                        seqs = [await cls._write(main_session, *event) for _, event in events]
+                break
+            except SQLAlchemyError as e:
+                if attempt:
+                    print(f"Не удалось записать события чата {events[0][1][0]} в журнал: {e!r}")
+                    return
+        # Транзакция сессии уже закрыта, номер проставляется новой сессией шарда чата
+        async with (await shard_map.session_maker(events[0][1][0]))() as shard_session:
+            async with shard_session.begin():
+                for (target, _), seq in zip(events, seqs):
+                    set_committed_value(target, "seq", seq)
+                    # Параллельные изменения сообщения могут прийти не по порядку номеров
+                    await shard_session.execute(
+                        sqlalchemy_update(Message)
+                        .where(Message.id == target.id, Message.seq < seq)
+                        .values(seq=seq)
+                        .execution_options(synchronize_session=False)
+                    )
+
+    @staticmethod
+    async def _write(session, chat_id: int, kind: str, message_id: int = None,
+                     user_id: int = None, payload: dict = None) -> int:
+        # Атомарный инкремент счётчика блокирует строку чата до конца транзакции,
+        # поэтому номера внутри чата выдаются строго по порядку
+        seq = (await session.execute(
+            sqlalchemy_update(Chat)
+            .where(Chat.id == chat_id)
+            .values(last_seq=Chat.last_seq + 1)
+            .returning(Chat.last_seq)
+        )).scalar_one()
+        session.add(ChatEvent(
+            chat_id=chat_id,
+            seq=seq,
+            kind=kind,
+            message_id=message_id,
+            user_id=user_id,
+            payload=json.dumps(payload, ensure_ascii=False) if payload else None,
+        ))
+        return seq
+
+    @staticmethod
+    async def last_seqs(chat_ids: list[int]) -> dict[int, int]:
+        """
+        Номера последних событий чатов по основной БД
+        :param chat_ids: ID чатов
+        :return: chat_id -> номер последнего события; несуществующих чатов в результате нет
+        """
+        async with async_session_maker() as session:
+            result = await session.execute(
+                select(Chat.id, Chat.last_seq).where(Chat.id.in_(chat_ids))
+            )
+            return dict(result.all())
+
+    @staticmethod
+    def _event_dict(event) -> dict:
+        return {
+            "chat_id": event.chat_id,
+            "seq": event.seq,
+            "kind": event.kind,
+            "message_id": event.message_id,
+            "user_id": event.user_id,
+            "data": json.loads(event.payload) if event.payload else None,
+        }
+
+    @classmethod
+    async def get_changes(cls, chat_id: int, since: int, limit: int = 500):
+        """
+        Получение событий чата после указанного курсора
+        :param chat_id: ID чата
+        :param since: Последний известный клиенту номер события
+        :param limit: Максимальное количество событий
+        :return: Словарь с событиями, новым курсором и признаком продолжения
+        """
+        async with read_session_maker() as session:
+            result = await session.execute(
+                select(ChatEvent.chat_id, ChatEvent.seq, ChatEvent.kind,
+                       ChatEvent.message_id, ChatEvent.user_id, ChatEvent.payload)
+                .where(ChatEvent.chat_id == chat_id, ChatEvent.seq > since)
+                .order_by(ChatEvent.seq)
+                .limit(limit + 1)
+            )
+            events = [cls._event_dict(event) for event in result.all()]
+        has_more = len(events) > limit
+        events = events[:limit]
+        return {
+            "chat_id": chat_id,
+            "cursor": events[-1]["seq"] if events else since,
+            "has_more": has_more,
+            "events": events,
+        }
+
+    @classmethod
+    async def get_changes_for_user(cls, user_id: int, cursors: dict[int, int], limit: int = 1000):
+        """
+        Получение изменений по всем чатам пользователя относительно курсоров клиента
+        :param user_id: ID пользователя
+        :param cursors: Известные клиенту курсоры в виде {chat_id: seq}
+        :param limit: Максимальное количество событий
+        :return: Словарь с событиями, новыми курсорами и новыми для клиента чатами
+        """
+        async with read_session_maker() as session:
+            chats = (await session.execute(
+                select(Chat.id, Chat.last_seq)
+                .join(chat_user_association, chat_user_association.c.chat_id == Chat.id)
+                .where(chat_user_association.c.user_id == user_id)
+            )).all()
+            new_chats = [chat_id for chat_id, _ in chats if chat_id not in cursors]
+            stale = [
+                and_(ChatEvent.chat_id == chat_id, ChatEvent.seq > cursors[chat_id])
+                for chat_id, last_seq in chats
+                if chat_id in cursors and last_seq > cursors[chat_id]
+            ]
+            events = []
+            if stale:
+                result = await session.execute(
+                    select(ChatEvent.chat_id, ChatEvent.seq, ChatEvent.kind,
+                           ChatEvent.message_id, ChatEvent.user_id, ChatEvent.payload)
+                    .where(or_(*stale))
+                    .order_by(ChatEvent.chat_id, ChatEvent.seq)
+                    .limit(limit + 1)
+                )
+                events = [cls._event_dict(event) for event in result.all()]
+        has_more = len(events) > limit
+        events = events[:limit]
+        new_cursors = {chat_id: cursors[chat_id] for chat_id, _ in chats if chat_id in cursors}
+        for event in events:
+            new_cursors[event["chat_id"]] = event["seq"]
+        return {
+            "cursors": new_cursors,
+            "has_more": has_more,
+            "new_chats": new_chats,
+            "events": events,
+        }
 
 
 class ChatDAO:
@@ -164,8 +860,11 @@ class ChatDAO:
                         new_chat.participants.append(user)
                 session.add(new_chat)
                 await session.flush()
+                new_chat.shard = shard_map.place(new_chat.id)
                 await session.commit()
-                return new_chat
+            shard_map.remember(new_chat.id, new_chat.shard)
+            membership.set_members(new_chat.id, [user.id for user in new_chat.participants])
+            return new_chat
 
     @classmethod
     async def get_chat(cls, chat_id):
@@ -174,11 +873,11 @@ class ChatDAO:
         :param chat_id: ID чата
         :return: Список сообщений
         """
-        async with async_session_maker() as session:
+        async with read_session_maker() as session:
             chat = await session.get(Chat, chat_id)
             if chat is None:
                 raise HTTPException(status_code=404, detail="Chat not found")
-            messages = await MessagesDAO.get_messages_between_users(chat_id)
+            messages = await MessagesDAO.get_history(chat_id, recipient_id=None)
             return {
                 "chat": chat,
                 "messages": messages,
@@ -214,7 +913,7 @@ class ChatDAO:
 
     @staticmethod
     async def get_chats_for_user(user_id: int):
-        async with async_session_maker() as session:
+        async with read_session_maker() as session:
             result = await session.execute(
                 select(Chat)
                 .join(Chat.participants)
@@ -229,8 +928,7 @@ class ChatDAO:
                     continue
                 setter_chats.add(chat.id)
 
-                other_users = [user for user in chat.participants if user.id != user_id]
-                name = other_users[0].name if len(other_users) == 1 else chat.name
+                name = ChatDAO.display_name(chat, user_id)
 
                 # Получаем последнее сообщение для чата
                 last_message = await ChatDAO.get_last_message_for_chat(chat.id)
@@ -240,10 +938,84 @@ class ChatDAO:
                     "id": chat.id,
                     "name": name,
                     "last_message_content": last_message_content,
+                    "last_seq": chat.last_seq,
                 })
 
             return chat_data
 
+    @staticmethod
+    def display_name(chat: Chat, user_id: int) -> str:
+        """
+        Название чата для пользователя: имя собеседника в личном чате
+        """
+        other_users = [user for user in chat.participants if user.id != user_id]
+        return other_users[0].name if len(other_users) == 1 else chat.name
+
+    @staticmethod
+    async def get_chats_by_ids(chat_ids: list[int]) -> dict[int, Chat]:
+        """
+        Чаты с участниками по списку ID
+        :param chat_ids: ID чатов
+        :return: chat_id -> чат
+        """
+        if not chat_ids:
+            return {}
+        async with read_session_maker() as session:
+            result = await session.execute(select(Chat).where(Chat.id.in_(chat_ids)))
+            return {chat.id: chat for chat in result.scalars().all()}
+
+    @staticmethod
+    async def get_read_marks(chat_ids: list[int], user_id: int) -> dict[int, int]:
+        """
+        Отметки прочитанного пользователя в чатах
+        :param chat_ids: ID чатов
+        :param user_id: ID пользователя
+        :return: chat_id -> ID последнего прочитанного сообщения
+        """
+        if not chat_ids:
+            return {}
+        async with read_session_maker() as session:
+            result = await session.execute(
+                select(chat_user_association.c.chat_id, chat_user_association.c.last_read_id)
+                .where(chat_user_association.c.user_id == user_id)
+                .where(chat_user_association.c.chat_id.in_(chat_ids))
+            )
+            return dict(result.all())
+
+    @staticmethod
+    async def advance_read_mark(chat_id: int, user_id: int, message_id: int):
+        """
+        Сдвиг отметки прочитанного участника вперёд; назад она не двигается,
+        поэтому прочтение старого сообщения после нового ничего не меняет
+        :param chat_id: ID чата
+        :param user_id: ID пользователя
+        :param message_id: ID прочитанного сообщения
+        """
+        async with async_session_maker() as session:
+            async with session.begin():
+                await session.execute(
+                    sqlalchemy_update(chat_user_association)
+                    .where(chat_user_association.c.chat_id == chat_id)
+                    .where(chat_user_association.c.user_id == user_id)
+                    .where(chat_user_association.c.last_read_id < message_id)
+                    .values(last_read_id=message_id)
+                )
+
+    @staticmethod
+    async def get_inbox_page(user_id: int, limit: int, offset: int = 0):
+        """
+        Страница списка чатов пользователя, отсортированного по последнему сообщению
+        :param user_id: ID пользователя
+        :param limit: Размер страницы
+        :param offset: Сколько чатов пропустить
+        :return: ID чатов страницы, статистика get_inbox_stats и общее количество чатов
+        """
+        chat_ids = list(await membership.user_chats(user_id))
+        stats = await MessagesDAO.get_inbox_stats(chat_ids, user_id)
+        # Чаты без сообщений - в конце, новые выше старых
+        ordered = sorted(chat_ids, key=lambda chat_id: (stats.get(chat_id, (0,))[0], chat_id), reverse=True)
+        return ordered[offset:offset + limit], stats, len(ordered)
+
     @staticmethod
     async def get_last_message_for_chat(chat_id: int):
         """
@@ -251,21 +1023,238 @@ class ChatDAO:
         :param chat_id: ID чата
         :return: Последнее сообщение или None
         """
-        async with async_session_maker() as session:
-            query = select(Message).filter(Message.chat_id == chat_id).order_by(Message.id.desc())
+        session_maker = await shard_map.session_maker(chat_id, read=True)
+        async with session_maker() as session:
+            query = lambda_stmt(
+                lambda: select(Message).where(Message.chat_id == chat_id).order_by(Message.id.desc()).limit(1)
+            )
             result = await session.execute(query)
             last_message = result.scalars().first()
             return last_message
 
 
-class FilesDAO:
+class FilesDAO(BaseDAO):
+    model = File
 
     @staticmethod
-    async def save_file(file: UploadFile, chat_id: int, session: async_session_maker):
-        file_location = f"uploads/{file.filename}"
+    def _write_file(file_location: str, content: bytes):
         with open(file_location, "wb") as f:
-            f.write(await file.read())
-        new_file = File(filename = file.filename, file_path = file_location, chat_id = chat_id)
+            f.write(content)
+
+    @staticmethod
+    async def save_file(file: UploadFile, chat_id: int, session: async_session_maker, message_id: int = None):
+        file_location = f"uploads/{file.filename}"
+        # Файл пишется в потоке до записи в БД: по ссылке из ответа он уже доступен
+        await asyncio.to_thread(FilesDAO._write_file, file_location, await file.read())
+        return await FilesDAO.add_file(session, file.filename, file_location, chat_id, message_id)
+
+    @staticmethod
+    async def add_file(session, filename: str, file_path: str, chat_id: int, message_id: int = None):
+        """
+        Запись о файле, уже находящемся на диске
+        :param session: Сессия БД
+        :param filename: Имя файла
+        :param file_path: Путь к файлу
+        :param chat_id: ID чата
+        :param message_id: ID сообщения с вложением
+        :return: Запись о файле
+        """
+        new_file = File(filename = filename, file_path = file_path, chat_id = chat_id,
+                        message_id = message_id)
+        new_file.id = await shard_map.next_id(File)
         session.add(new_file)
         await session.commit()
-        return new_file
\ No newline at end of file
+        if message_id is not None:
+            hot_tail_cache.update(chat_id, message_id, files=[{
+                "id": new_file.id,
+                "filename": new_file.filename,
+                "file_path": new_file.file_path,
+                "chat_id": chat_id,
+            }])
+        return new_file
+
+    @staticmethod
+    async def find_orphans(created_before: datetime, after_id: int = 0, limit: int = 500):
+        """
+        Поиск записей о файлах, не привязанных к сообщению
+        :param created_before: Учитываются только записи старше этого момента
+        :param after_id: ID, после которого продолжить поиск
+        :param limit: Размер пачки
+        :return: Список пар (ID, путь к файлу)
+        """
+        async def find(session_maker):
+            async with session_maker() as session:
+                result = await session.execute(
+                    select(File.id, File.file_path)
+                    .where(File.message_id.is_(None), File.created_at < created_before, File.id > after_id)
+                    .order_by(File.id)
+                    .limit(limit)
+                )
+                return result.all()
+
+        # ID уникальны между шардами, поэтому пачки шардов сливаются по ID
+        found = await asyncio.gather(*map(find, shard_map.makers().values()))
+        return sorted((row for rows in found for row in rows), key=lambda row: row[0])[:limit]
+
+    @staticmethod
+    async def delete_by_ids(file_ids: list[int]) -> int:
+        """
+        Удаление записей о файлах по ID
+        :param file_ids: ID записей
+        :return: Количество удалённых записей
+        """
+        deleted = 0
+        for session_maker in shard_map.makers().values():
+            async with session_maker() as session:
+                async with session.begin():
+                    result = await session.execute(sqlalchemy_delete(File).where(File.id.in_(file_ids)))
+                    deleted += result.rowcount
+        return deleted
+
+    @staticmethod
+    async def find_referenced_paths(paths: list[str]) -> set[str]:
+        """
+        Пути из списка, на которые ещё ссылаются записи о файлах
+        :param paths: Пути к файлам на диске
+        :return: Множество путей, которые используются
+        """
+        async def find(session_maker):
+            async with session_maker() as session:
+                result = await session.execute(select(File.file_path).where(File.file_path.in_(paths)))
+                return set(result.scalars().all())
+
+        return set().union(*await asyncio.gather(*map(find, shard_map.makers().values())))
+
+    @staticmethod
+    async def link_to_messages() -> int:
+        """
+        Привязка старых записей files к сообщениям. Раньше message_id не заполнялся,
+        а запись о файле создавалась сразу после сообщения is_file в том же чате,
+        поэтому файлу достаётся последнее ещё не занятое такое сообщение, созданное не позже него.
+        Без привязки сборщик мусора считает эти записи осиротевшими.
+        :return: Количество привязанных записей
+        """
+        linked = 0
+        for session_maker in shard_map.makers().values():
+            async with session_maker() as session:
+                chat_ids = (await session.execute(
+                    select(distinct(File.chat_id)).where(File.message_id.is_(None), File.chat_id.is_not(None))
+                )).scalars().all()
+            for chat_id in chat_ids:
+                async with session_maker() as session:
+                    async with session.begin():
+                        files = (await session.execute(
+                            select(File.id, File.created_at)
+                            .where(File.chat_id == chat_id, File.message_id.is_(None))
+                            .order_by(File.created_at, File.id)
+                        )).all()
+                        linked_messages = select(File.message_id).where(File.message_id.is_not(None))
+                        messages = (await session.execute(
+                            select(Message.id, Message.created_at)
+                            .where(Message.chat_id == chat_id, Message.is_file.is_(True),
+                                   Message.id.not_in(linked_messages))
+                            .order_by(Message.created_at, Message.id)
+                        )).all()
+                        links = []
+                        candidates = []
+                        position = 0
+                        for file_id, file_created_at in files:
+                            while position < len(messages) and messages[position][1] <= file_created_at:
+                                candidates.append(messages[position][0])
+                                position += 1
+                            if candidates:
+                                links.append({"id": file_id, "message_id": candidates.pop()})
+                        if links:
+                            await session.execute(sqlalchemy_update(File), links)
+                            linked += len(links)
+        return linked
+
+
+class NotificationsDAO(BaseDAO):
+    """DAO для очереди уведомлений пользователей, которые были не в сети"""
+    model = PendingNotification
+
+    @classmethod
+    async def get_for_user(cls, user_id: int):
+        """
+        Чтение всех накопившихся уведомлений и сводок пользователя без удаления:
+        удаляются они после успешной отправки через delete_taken
+        :param user_id: ID пользователя
+        :return: Пара (сводки, уведомления) в порядке поступления
+        """
+        async with async_session_maker() as session:
+            digests = (await session.execute(
+                select(NotificationDigest.id, NotificationDigest.messages_count,
+                       NotificationDigest.chat_ids, NotificationDigest.first_at,
+                       NotificationDigest.last_at)
+                .where(NotificationDigest.user_id == user_id)
+                .order_by(NotificationDigest.id)
+            )).all()
+            events = (await session.execute(
+                select(cls.model.id, cls.model.payload)
+                .where(cls.model.user_id == user_id)
+                .order_by(cls.model.id)
+            )).all()
+        return digests, events
+
+    @classmethod
+    async def delete_taken(cls, user_id: int, digest_ids: list[int], event_ids: list[int]):
+        """
+        Удаление отправленных уведомлений и сводок пользователя в одной транзакции.
+        Удаляются только переданные ID: поступившие после чтения остаются в очереди
+        :param user_id: ID пользователя
+        :param digest_ids: ID отправленных сводок
+        :param event_ids: ID отправленных уведомлений
+        """
+        async with async_session_maker() as session:
+            async with session.begin():
+                if digest_ids:
+                    await session.execute(
+                        sqlalchemy_delete(NotificationDigest)
+                        .where(NotificationDigest.user_id == user_id,
+                               NotificationDigest.id.in_(digest_ids))
+                    )
+                if event_ids:
+                    await session.execute(
+                        sqlalchemy_delete(cls.model)
+                        .where(cls.model.user_id == user_id, cls.model.id.in_(event_ids))
+                    )
+
+    @classmethod
+    async def build_digests(cls, created_before: datetime, message_kinds: list[str]) -> int:
+        """
+        Свёртка старых уведомлений в сводки: по одной записи на пользователя
+        с количеством новых сообщений и списком чатов. Свёрнутые уведомления удаляются.
+        :param created_before: Сворачиваются уведомления старше этого момента
+        :param message_kinds: Действия, которые считаются новыми сообщениями
+        :return: Количество свёрнутых уведомлений
+        """
+        async with async_session_maker() as session:
+            async with session.begin():
+                # Верхняя граница ID отсекает уведомления, добавленные во время свёртки
+                max_id = (await session.execute(
+                    select(func.max(cls.model.id)).where(cls.model.created_at < created_before)
+                )).scalar()
+                if max_id is None:
+                    return 0
+                batch = and_(cls.model.id <= max_id, cls.model.created_at < created_before)
+                is_message = cls.model.kind.in_(message_kinds)
+                messages_count = func.count().filter(is_message)
+                await session.execute(
+                    sqlalchemy_insert(NotificationDigest).from_select(
+                        ["user_id", "messages_count", "chat_ids", "first_at", "last_at"],
+                        select(
+                            cls.model.user_id,
+                            messages_count,
+                            func.string_agg(distinct(cast(cls.model.chat_id, String)), ",")
+                            .filter(is_message),
+                            func.min(cls.model.created_at),
+                            func.max(cls.model.created_at),
+                        )
+                        .where(batch)
+                        .group_by(cls.model.user_id)
+                        .having(messages_count > 0)
+                    )
+                )
+                result = await session.execute(sqlalchemy_delete(cls.model).where(batch))
+                return result.rowcount
@@ -0,0 +1,109 @@
+import asyncio
+from typing import Dict, Set
+
+from app.chat.connections import manager
+from app.chat.dao import MessagesDAO
+from app.config import settings
+from app.jobs import job_runner, PRIORITY_NORMAL
+
+
+class DeliveryTracker:
+    """
+    Подтверждения доставки сообщений. Подтверждённые ID копятся в памяти по паре
+    (чат, пользователь), повторные ack от всех соединений пользователя схлопываются.
+    Раз в interval или при накоплении batch_size пар все подтверждения записываются
+    одним UPDATE, а отправители получают по одному событию delivered на чат.
+    После записи для пары запоминается отметка "доставлено всё до ID" - только по
+    непрерывной последовательности, поэтому ack не по порядку не засчитывает пропуски.
+    """
+
+    def __init__(self, interval: float, batch_size: int, max_tracked: int = 100_000):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_tracked = max_tracked
+        # (chat_id, user_id) -> подтверждённые ID сообщений, ещё не записанные в БД
+        self._pending: Dict[tuple[int, int], Set[int]] = {}
+        # (chat_id, user_id) -> ID, до которого все сообщения уже доставлены без пропусков
+        self._persisted: Dict[tuple[int, int], int] = {}
+        self._lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+        self.stats = {"acks": 0, "flushes": 0, "delivered": 0}
+
+    def ack(self, chat_id: int, user_id: int, message_ids: list[int]):
+        """
+        Приём подтверждения от клиента
+        :param chat_id: ID чата
+        :param user_id: ID получателя
+        :param message_ids: ID полученных сообщений
+        """
+        if not message_ids:
+            return
+        self.stats["acks"] += 1
+        key = (chat_id, user_id)
+        persisted = self._persisted.get(key, 0)
+        pending = self._pending.setdefault(key, set())
+        pending.update(message_id for message_id in message_ids if message_id > persisted)
+        if not pending:
+            del self._pending[key]
+            return
+        if len(self._pending) >= self.batch_size and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self.flush())
+            self._flush_task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task: asyncio.Task):
+        self._flush_task = None
+        if not task.cancelled() and task.exception():
+            print(f"Ошибка записи подтверждений доставки: {task.exception()!r}")
+
+    async def flush(self):
+        """
+        Запись накопленных подтверждений и уведомление отправителей
+        """
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            acks = [
+                (chat_id, user_id, self._persisted.get((chat_id, user_id), 0), sorted(message_ids))
+                for (chat_id, user_id), message_ids in pending.items()
+            ]
+            try:
+                delivered, watermarks = await MessagesDAO.mark_delivered(acks)
+            except Exception:
+                # Возвращаем подтверждения, чтобы записать их при следующей попытке
+                for key, message_ids in pending.items():
+                    self._pending.setdefault(key, set()).update(message_ids)
+                raise
+            if len(self._persisted) > self.max_tracked:
+                # Без отметки следующий ack просто просмотрит чат с начала
+                self._persisted.clear()
+            for key, up_to in watermarks.items():
+                self._persisted[key] = max(up_to, self._persisted.get(key, 0))
+            self.stats["flushes"] += 1
+            self.stats["delivered"] += len(delivered)
+
+        # (отправитель, чат) -> доставленные сообщения
+        by_sender: Dict[tuple[int, int], list[int]] = {}
+        for message_id, chat_id, sender_id in delivered:
+            by_sender.setdefault((sender_id, chat_id), []).append(message_id)
+        for (sender_id, chat_id), message_ids in by_sender.items():
+            job_runner.submit(manager.send_to_user, sender_id, {
+                "action": "delivered",
+                "chat_id": chat_id,
+                "message_ids": sorted(message_ids),
+            }, priority=PRIORITY_NORMAL)
+
+    async def run_periodically(self):
+        # Запускается из lifespan приложения
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Ошибка записи подтверждений доставки: {e!r}")
+
+
+delivery_tracker = DeliveryTracker(
+    interval=settings.DELIVERY_FLUSH_INTERVAL,
+    batch_size=settings.DELIVERY_BATCH_SIZE,
+)
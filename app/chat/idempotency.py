@@ -0,0 +1,88 @@
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from app.chat.dao import MessagesDAO
+from app.config import settings
+
+
+# Длина столбца message_idempotency_keys.client_id
+CLIENT_ID_MAX_LENGTH = 64
+
+
+def normalize_client_id(client_id) -> str | None:
+    """
+    Единый вид client_id для кэша и уникального индекса на обоих путях отправки:
+    REST проверяет длину схемой, а по вебсокету приходит произвольное значение
+    :param client_id: ID сообщения, сгенерированный клиентом
+    :return: Строка не длиннее CLIENT_ID_MAX_LENGTH или None, если ключа нет
+    """
+    if client_id is None or client_id == "":
+        return None
+    return str(client_id)[:CLIENT_ID_MAX_LENGTH]
+
+
+class RecentSends:
+    """
+    Недавние отправки по ключу (отправитель, client_id) в памяти процесса.
+    Повтор, попавший в кэш, отвечает сохранённым результатом без обращения к БД;
+    промах проверяется уникальным индексом message_idempotency_keys.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # (sender_id, client_id) -> (момент записи, сохранённое сообщение в формате MessageRead
+        #                            или None для отправки, только разосланной по вебсокету)
+        self._entries: OrderedDict[tuple[int, str], tuple[float, dict | None]] = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def _fresh(self, sender_id: int, client_id: str) -> tuple[float, dict | None] | None:
+        entry = self._entries.get((sender_id, client_id))
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return None
+        return entry
+
+    def get(self, sender_id: int, client_id: str) -> dict | None:
+        """
+        Сохранённое сообщение повторяемой отправки
+        :return: Сообщение в формате MessageRead или None, если в кэше его нет
+        """
+        entry = self._fresh(sender_id, client_id)
+        if entry is None or entry[1] is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def put(self, sender_id: int, client_id: str, message: dict | None):
+        key = (sender_id, client_id)
+        self._entries[key] = (time.monotonic(), message)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def claim(self, sender_id: int, client_id: str) -> bool:
+        """
+        Атомарная в пределах цикла событий отметка рассылки по вебсокету.
+        Сообщение не сохраняется: присланное клиентом не является записью из БД,
+        и повтор через REST должен получить сообщение из БД, а не из кэша
+        :return: False, если такая отправка уже была
+        """
+        if self._fresh(sender_id, client_id) is not None:
+            return False
+        self.put(sender_id, client_id, None)
+        return True
+
+    async def run_cleanup_periodically(self, interval: float):
+        # Ключи в БД нужны, пока клиент может повторить запрос
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await MessagesDAO.delete_idempotency_keys(datetime.utcnow() - timedelta(seconds=self.ttl))
+            except Exception as e:
+                print(f"Ошибка удаления ключей идемпотентности: {e!r}")
+
+
+recent_sends = RecentSends(max_entries=settings.IDEMPOTENCY_CACHE_SIZE, ttl=settings.IDEMPOTENCY_TTL)
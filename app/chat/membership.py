@@ -0,0 +1,113 @@
+import time
+from typing import Dict, Set, Tuple
+from fastapi import HTTPException
+from sqlalchemy import select
+from app.chat.models import chat_user_association
+from app.config import settings
+from app.database import async_session_maker
+
+
+class MembershipIndex:
+    """
+    Индекс участников чатов в памяти процесса: chat_id -> user_id и обратно.
+    Заполняется лениво при первом обращении и обновляется при изменении состава
+    в этом процессе; изменения из других процессов подхватываются по истечении ttl.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # chat_id -> (момент загрузки, полный состав участников)
+        self._chat_members: Dict[int, Tuple[float, Set[int]]] = {}
+        # user_id -> (момент загрузки, полный список чатов пользователя)
+        self._user_chats: Dict[int, Tuple[float, Set[int]]] = {}
+
+    def _fresh(self, cache: Dict[int, Tuple[float, Set[int]]], key: int) -> Set[int] | None:
+        entry = cache.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return None
+        return entry[1]
+
+    async def members(self, chat_id: int) -> Set[int]:
+        """
+        Участники чата
+        :param chat_id: ID чата
+        :return: Множество ID пользователей
+        """
+        members = self._fresh(self._chat_members, chat_id)
+        if members is None:
+            async with async_session_maker() as session:
+                result = await session.execute(
+                    select(chat_user_association.c.user_id)
+                    .where(chat_user_association.c.chat_id == chat_id)
+                )
+                members = set(result.scalars().all())
+            # Пустой результат не кэшируем: чат может быть создан другим процессом
+            if members:
+                self._chat_members[chat_id] = (time.monotonic(), members)
+        return members
+
+    async def user_chats(self, user_id: int) -> Set[int]:
+        """
+        Чаты, в которых состоит пользователь
+        :param user_id: ID пользователя
+        :return: Множество ID чатов
+        """
+        chats = self._fresh(self._user_chats, user_id)
+        if chats is None:
+            async with async_session_maker() as session:
+                result = await session.execute(
+                    select(chat_user_association.c.chat_id)
+                    .where(chat_user_association.c.user_id == user_id)
+                )
+                chats = set(result.scalars().all())
+            # Пустой результат не кэшируем: пользователя могут добавить в чат в другом процессе
+            if chats:
+                self._user_chats[user_id] = (time.monotonic(), chats)
+        return chats
+
+    async def is_member(self, chat_id: int, user_id: int) -> bool:
+        return user_id in await self.members(chat_id)
+
+    async def require_member(self, chat_id: int, user_id: int):
+        """
+        Проверка доступа пользователя к чату
+        :raises HTTPException: 404, если чата нет, 403, если пользователь не участник
+        """
+        members = await self.members(chat_id)
+        if not members:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        if user_id not in members:
+            raise HTTPException(status_code=403, detail="Access denied to this chat")
+
+    def set_members(self, chat_id: int, user_ids):
+        """
+        Обновление состава чата после его создания или изменения
+        :param chat_id: ID чата
+        :param user_ids: Новый состав участников
+        """
+        new_members = set(user_ids)
+        old_members = self._chat_members.get(chat_id, (0.0, set()))[1]
+        for user_id in old_members - new_members:
+            if user_id in self._user_chats:
+                self._user_chats[user_id][1].discard(chat_id)
+        for user_id in new_members:
+            if user_id in self._user_chats:
+                self._user_chats[user_id][1].add(chat_id)
+        self._chat_members[chat_id] = (time.monotonic(), new_members)
+
+    def invalidate_user(self, user_id: int):
+        """
+        Сброс списка чатов пользователя
+        """
+        self._user_chats.pop(user_id, None)
+
+    def invalidate(self, chat_id: int):
+        """
+        Сброс состава чата, он будет перечитан из БД при следующем обращении
+        """
+        _, members = self._chat_members.pop(chat_id, (0.0, set()))
+        for user_id in members:
+            self._user_chats.pop(user_id, None)
+
+
+membership = MembershipIndex(ttl=settings.MEMBERSHIP_CACHE_TTL)
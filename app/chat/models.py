@@ -1,6 +1,6 @@
 from datetime import datetime
 from typing import List
-from sqlalchemy import Integer, Text, ForeignKey, String, Table, Column, Boolean, DateTime
+from sqlalchemy import Integer, Text, ForeignKey, String, Table, Column, Boolean, DateTime, UniqueConstraint, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship, Relationship
 from app.chat.schemas import MessageStatus
 from app.database import Base
@@ -11,6 +11,12 @@ class Message(Base):
     Класс для модели сообщения
     """
     __tablename__ = 'messages'
+    # Таблица секционирована по диапазонам id, секции создаёт и архивирует
+    # команда python -m app.chat.partitions
+    __table_args__ = (
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+        {"postgresql_partition_by": "RANGE (id)"},
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     chat_id: Mapped[int] = mapped_column(Integer, ForeignKey("chats.id"))
     sender_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"))
@@ -20,6 +26,8 @@ class Message(Base):
     read_by: Mapped[List[int]] = mapped_column(String, default=[])
     edited_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
     is_file: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
+    # Номер последнего изменения сообщения в журнале событий чата
+    seq: Mapped[int] = mapped_column(Integer, default=0, server_default="0", nullable=False)
     files: Mapped[List["File"]] = relationship("File", back_populates="message", lazy="selectin")
 
 
@@ -29,6 +37,18 @@ chat_user_association = Table(
     Base.metadata,
     Column("user_id", Integer, ForeignKey("users.id"), primary_key=True),
     Column("chat_id", Integer, ForeignKey("chats.id"), primary_key=True),
+    # ID последнего прочитанного участником сообщения чата: непрочитанные -
+    # сообщения с большим id, их считает диапазон по индексу (chat_id, id)
+    Column("last_read_id", Integer, nullable=False, default=0, server_default="0"),
+)
+
+# Счётчики ID шардированных таблиц в основной БД для СУБД без последовательностей
+# (в PostgreSQL ID выдают последовательности таблиц основной БД), см. app.chat.shards
+shard_id_counters = Table(
+    "shard_id_counters",
+    Base.metadata,
+    Column("table_name", String, primary_key=True),
+    Column("last_id", Integer, nullable=False),
 )
 
 
@@ -40,6 +60,10 @@ class Chat(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True,
                                     autoincrement=True)
     name: Mapped[str] = mapped_column(String, nullable=False)
+    # Последний выданный номер в журнале событий чата
+    last_seq: Mapped[int] = mapped_column(Integer, default=0, server_default="0", nullable=False)
+    # Шард с сообщениями и файлами чата, NULL - основная БД (см. app.chat.shards)
+    shard: Mapped[str] = mapped_column(String, nullable=True)
     files: Mapped[List["File"]] = relationship("File", back_populates = "chat")
     # Двусторонняя связь с User
     participants = Relationship("User", secondary=chat_user_association,
@@ -63,3 +87,61 @@ class File(Base):
         self.file_path = file_path
         self.chat_id = chat_id
         self.message_id = message_id
+
+
+class ChatEvent(Base):
+    """
+    Класс для модели события в журнале изменений чата
+    """
+    __tablename__ = 'chat_events'
+    __table_args__ = (UniqueConstraint("chat_id", "seq"),)
+
+    chat_id: Mapped[int] = mapped_column(Integer, ForeignKey("chats.id"), index=True)
+    seq: Mapped[int] = mapped_column(Integer, nullable=False)
+    # new, edit, delete, read
+    kind: Mapped[str] = mapped_column(String, nullable=False)
+    message_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    user_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    payload: Mapped[str] = mapped_column(Text, nullable=True)
+
+
+class PendingNotification(Base):
+    """
+    Класс для модели уведомления, ожидающего подключения получателя
+    """
+    __tablename__ = 'pending_notifications'
+
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), index=True)
+    chat_id: Mapped[int] = mapped_column(Integer, ForeignKey("chats.id"))
+    # Действие события: new_message, edit_message, delete_message, message_read...
+    kind: Mapped[str] = mapped_column(String, nullable=False)
+    payload: Mapped[str] = mapped_column(Text, nullable=False)
+
+
+class NotificationDigest(Base):
+    """
+    Класс для модели сводки по накопившимся уведомлениям пользователя
+    """
+    __tablename__ = 'notification_digests'
+
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), index=True)
+    messages_count: Mapped[int] = mapped_column(Integer, nullable=False)
+    # ID чатов с новыми сообщениями через запятую
+    chat_ids: Mapped[str] = mapped_column(String, nullable=False, default="")
+    first_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    last_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class MessageIdempotencyKey(Base):
+    """
+    Класс для модели ключа идемпотентности отправки сообщения.
+    Отдельная таблица нужна потому, что уникальный индекс секционированной
+    таблицы messages обязан включать id.
+    """
+    __tablename__ = 'message_idempotency_keys'
+    __table_args__ = (UniqueConstraint("sender_id", "client_id"),)
+
+    sender_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
+    # ID сообщения, сгенерированный клиентом
+    client_id: Mapped[str] = mapped_column(String(64), nullable=False)
+    message_id: Mapped[int] = mapped_column(Integer, nullable=False)
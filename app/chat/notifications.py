@@ -0,0 +1,102 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+from fastapi import WebSocket
+
+from app.chat.connections import manager
+from app.chat.dao import NotificationsDAO
+from app.chat.membership import membership
+from app.config import settings
+from app.jobs import job_runner, PRIORITY_NORMAL
+
+# Действия, которые в сводке считаются новыми сообщениями
+MESSAGE_ACTIONS = ["new_message", "new_file"]
+
+
+class NotificationQueue:
+    """
+    Очередь уведомлений для участников чата, до которых рассылка этого процесса не дошла.
+    Уведомления хранятся в БД и отдаются одной пачкой при подключении;
+    давно ждущие уведомления периодически сворачиваются в сводки,
+    чтобы после долгого отсутствия не проигрывать их по одному.
+    """
+
+    def __init__(self, digest_after: timedelta, interval: float):
+        self.digest_after = digest_after
+        self.interval = interval
+        self.stats = {"queued": 0, "delivered": 0, "digested": 0}
+
+    async def enqueue(self, chat_id: int, message: dict):
+        """
+        Постановка события в очередь участников чата без подписанных на него соединений.
+        Рассылка идёт только по соединениям этого процесса, поэтому в очередь попадают
+        и пользователи в сети, но не подписанные на чат, и подключённые к другим процессам
+        :param chat_id: ID чата
+        :param message: Событие, разосланное подписанным соединениям
+        """
+        sender_id = (message.get("message") or {}).get("sender_id")
+        subscribers = manager.chat_subscribers(chat_id)
+        recipients = [
+            user_id for user_id in await membership.members(chat_id)
+            if user_id != sender_id and user_id not in subscribers
+        ]
+        if not recipients:
+            return
+        payload = json.dumps(message, ensure_ascii=False, default=str)
+        rows = [
+            {"user_id": user_id, "chat_id": chat_id, "kind": message.get("action", ""), "payload": payload}
+            for user_id in recipients
+        ]
+        self.stats["queued"] += len(rows)
+        # Одна вставка на событие для всех получателей, в порядке событий чата
+        job_runner.submit(NotificationsDAO.insert_many, rows,
+                          priority=PRIORITY_NORMAL, key=("notifications", chat_id))
+
+    async def drain(self, websocket: WebSocket, user_id: int):
+        """
+        Отправка накопившихся уведомлений одним кадром после подключения.
+        Из очереди они удаляются только после успешной отправки: при обрыве
+        соединения уведомления дождутся следующего подключения
+        :param websocket: Новое соединение пользователя
+        :param user_id: ID пользователя
+        """
+        digests, events = await NotificationsDAO.get_for_user(user_id)
+        if not digests and not events:
+            return
+        digest = None
+        if digests:
+            chat_ids = sorted({
+                int(chat_id) for _, _, ids, _, _ in digests for chat_id in ids.split(",") if chat_id
+            })
+            digest = {
+                "messages_count": sum(count for _, count, _, _, _ in digests),
+                "chats_count": len(chat_ids),
+                "chat_ids": chat_ids,
+                "first_at": min(first_at for _, _, _, first_at, _ in digests).isoformat(),
+                "last_at": max(last_at for _, _, _, _, last_at in digests).isoformat(),
+            }
+        await manager.send(websocket, {
+            "action": "pending",
+            "digest": digest,
+            "events": [json.loads(payload) for _, payload in events],
+        })
+        await NotificationsDAO.delete_taken(
+            user_id, [row[0] for row in digests], [event_id for event_id, _ in events])
+        self.stats["delivered"] += len(events)
+
+    async def run_periodically(self):
+        # Запускается из lifespan приложения
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.stats["digested"] += await NotificationsDAO.build_digests(
+                    datetime.utcnow() - self.digest_after, MESSAGE_ACTIONS)
+            except Exception as e:
+                print(f"Ошибка сборки сводок уведомлений: {e!r}")
+
+
+notifications = NotificationQueue(
+    digest_after=timedelta(seconds=settings.NOTIFICATIONS_DIGEST_AFTER),
+    interval=settings.NOTIFICATIONS_DIGEST_INTERVAL,
+)
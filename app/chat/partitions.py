@@ -0,0 +1,243 @@
+"""
+Обслуживание секционированной таблицы messages.
+
+Таблица секционирована по диапазонам id (секции messages_p<начало диапазона>).
+Команду ensure нужно запускать регулярно (например, раз в сутки из cron),
+чтобы впереди всегда были свободные секции. Команды ensure и archive обслуживают
+основную БД и все шарды PostgreSQL из MESSAGES_SHARDS (архивы шардов - в подкаталогах):
+
+    python -m app.chat.partitions convert           # однократно для существующей БД
+    python -m app.chat.partitions ensure --ahead 3
+    python -m app.chat.partitions archive --older-than-days 365 [--dry-run]
+"""
+import argparse
+import asyncio
+import gzip
+import os
+import re
+import shutil
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from app.chat.shards import shard_map, DEFAULT_SHARD
+from app.config import settings
+from app.database import engine
+
+PARTITION_BOUND = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+def _parse_bound(value: str) -> int | None:
+    value = value.strip("'")
+    return None if value in ("MINVALUE", "MAXVALUE") else int(value)
+
+
+async def get_partitions(conn) -> list[tuple[str, int | None, int | None]]:
+    """
+    Список секций таблицы messages
+    :param conn: Соединение с БД
+    :return: Список (имя, нижняя граница, верхняя граница) по возрастанию id
+    """
+    result = await conn.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'messages'::regclass"
+    ))
+    partitions = []
+    for name, bound in result.all():
+        match = PARTITION_BOUND.search(bound)
+        if match:
+            partitions.append((name, _parse_bound(match.group(1)), _parse_bound(match.group(2))))
+    return sorted(partitions, key=lambda p: -1 if p[1] is None else p[1])
+
+
+async def _max_message_id(conn) -> int:
+    return (await conn.execute(text("SELECT coalesce(max(id), 0) FROM messages"))).scalar_one()
+
+
+async def convert(conn) -> bool:
+    """
+    Перевод существующей несекционированной таблицы messages в секционированную.
+    Старая таблица подключается первой секцией без копирования данных.
+    :param conn: Соединение с открытой транзакцией
+    :return: True, если таблица была преобразована
+    """
+    relkind = (await conn.execute(text(
+        "SELECT relkind FROM pg_class WHERE oid = 'messages'::regclass"
+    ))).scalar_one()
+    if relkind == "p":
+        return False
+
+    max_id = await _max_message_id(conn)
+    for statement in (
+        "ALTER TABLE messages RENAME TO messages_legacy",
+        "ALTER TABLE messages_legacy RENAME CONSTRAINT messages_pkey TO messages_legacy_pkey",
+        "CREATE TABLE messages (LIKE messages_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (id)",
+        "ALTER TABLE messages ADD PRIMARY KEY (id)",
+        f"ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO ({max_id + 1})",
+        "ALTER TABLE messages ADD FOREIGN KEY (chat_id) REFERENCES chats (id)",
+        "ALTER TABLE messages ADD FOREIGN KEY (sender_id) REFERENCES users (id)",
+        "ALTER TABLE messages ADD FOREIGN KEY (recipient_id) REFERENCES users (id)",
+        "CREATE INDEX IF NOT EXISTS ix_messages_chat_id_id ON messages (chat_id, id)",
+        # Последовательность должна пережить удаление старой секции при архивации
+        "ALTER SEQUENCE messages_id_seq OWNED BY messages.id",
+        "ALTER TABLE files DROP CONSTRAINT IF EXISTS files_message_id_fkey",
+        "ALTER TABLE files ADD CONSTRAINT files_message_id_fkey "
+        "FOREIGN KEY (message_id) REFERENCES messages (id)",
+    ):
+        await conn.execute(text(statement))
+    return True
+
+
+async def ensure_partitions(conn, ahead: int, size: int = settings.MESSAGES_PARTITION_SIZE) -> list[str]:
+    """
+    Создание секций впрок, чтобы новые сообщения всегда было куда записать
+    :param conn: Соединение с открытой транзакцией
+    :param ahead: Сколько свободных секций держать после текущего максимального id
+    :param size: Размер диапазона id одной секции
+    :return: Имена созданных секций
+    """
+    partitions = await get_partitions(conn)
+    upper = max((p[2] for p in partitions if p[2] is not None), default=0)
+    target = await _max_message_id(conn) + ahead * size
+
+    created = []
+    while upper <= target:
+        name = f"messages_p{upper}"
+        await conn.execute(text(
+            f"CREATE TABLE {name} PARTITION OF messages FOR VALUES FROM ({upper}) TO ({upper + size})"
+        ))
+        created.append(name)
+        upper += size
+    return created
+
+
+async def _copy_to_gzip(driver_conn, query: str, path: str):
+    with gzip.open(path, "wb") as archive:
+        async def write(chunk: bytes):
+            archive.write(chunk)
+
+        await driver_conn.copy_from_query(query, output=write, format="csv", header=True)
+
+
+def _postgres_shards():
+    # Секционирование есть только в PostgreSQL
+    return [(name, shard_engine) for name, shard_engine in shard_map.engines.items()
+            if shard_engine.dialect.name == "postgresql"]
+
+
+def _copy_blobs(paths: list[str], target_dir: str) -> int:
+    """
+    Копирование файлов вложений в архив с сохранением относительных путей.
+    После удаления строк files сборщик uploads удалит оригиналы, в архиве остаются копии.
+    :return: Количество скопированных файлов
+    """
+    copied = 0
+    for path in paths:
+        relative = os.path.normpath(path).lstrip(os.sep)
+        if relative.startswith(".."):
+            continue
+        target = os.path.join(target_dir, relative)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            shutil.copy2(path, target)
+        except FileNotFoundError:
+            print(f"Файл вложения {path} не найден, в архив не скопирован")
+            continue
+        copied += 1
+    return copied
+
+
+async def archive_partitions(older_than: timedelta, archive_dir: str, dry_run: bool = False,
+                             db_engine=engine):
+    """
+    Выгрузка старых секций в сжатые CSV-файлы, отключение и удаление секций.
+    Вместе с секцией выгружаются и удаляются ссылающиеся на её сообщения строки files,
+    а сами файлы вложений копируются в каталог <секция>_files архива.
+    :param older_than: Возраст самого нового сообщения секции, после которого она архивируется
+    :param archive_dir: Каталог для архивов
+    :param dry_run: Только показать, какие секции будут заархивированы
+    :param db_engine: БД с таблицей messages: основная или шард
+    :return: Имена заархивированных секций
+    """
+    cutoff = datetime.utcnow() - older_than
+    os.makedirs(archive_dir, exist_ok=True)
+
+    async with db_engine.connect() as conn:
+        partitions = await get_partitions(conn)
+        max_id = await _max_message_id(conn)
+
+    archived = []
+    for name, _, upper in partitions:
+        # Текущую и будущие секции не трогаем
+        if upper is None or upper > max_id:
+            break
+        async with db_engine.begin() as conn:
+            newest = (await conn.execute(text(f"SELECT max(created_at) FROM {name}"))).scalar_one()
+            # id растут вместе со временем, поэтому дальше секции только новее
+            if newest is not None and newest >= cutoff:
+                break
+            if dry_run:
+                print(f"{name}: последнее сообщение {newest}, будет заархивирована")
+                archived.append(name)
+                continue
+
+            paths = (await conn.execute(text(
+                f"SELECT f.file_path FROM files f JOIN {name} m ON m.id = f.message_id "
+                "WHERE f.file_path IS NOT NULL"
+            ))).scalars().all()
+            blobs = await asyncio.to_thread(_copy_blobs, paths, os.path.join(archive_dir, f"{name}_files"))
+            raw = await conn.get_raw_connection()
+            driver_conn = raw.driver_connection
+            await _copy_to_gzip(
+                driver_conn,
+                f"SELECT f.* FROM files f JOIN {name} m ON m.id = f.message_id",
+                os.path.join(archive_dir, f"{name}_files.csv.gz"),
+            )
+            await conn.execute(text(f"DELETE FROM files USING {name} m WHERE files.message_id = m.id"))
+            await _copy_to_gzip(
+                driver_conn,
+                f"SELECT * FROM {name}",
+                os.path.join(archive_dir, f"{name}.csv.gz"),
+            )
+            await conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+            await conn.execute(text(f"DROP TABLE {name}"))
+            print(f"{name}: заархивирована, файлов вложений: {blobs}")
+            archived.append(name)
+    return archived
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("convert", help="преобразовать существующую таблицу messages")
+    ensure_parser = commands.add_parser("ensure", help="создать секции впрок")
+    ensure_parser.add_argument("--ahead", type=int, default=3)
+    archive_parser = commands.add_parser("archive", help="заархивировать старые секции")
+    archive_parser.add_argument("--older-than-days", type=int, default=365)
+    archive_parser.add_argument("--archive-dir", default=settings.MESSAGES_ARCHIVE_DIR)
+    archive_parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        async with engine.begin() as conn:
+            converted = await convert(conn)
+            created = await ensure_partitions(conn, ahead=3)
+        print("Таблица преобразована" if converted else "Таблица уже секционирована",
+              f"создано секций: {len(created)}")
+    elif args.command == "ensure":
+        for name, shard_engine in _postgres_shards():
+            async with shard_engine.begin() as conn:
+                created = await ensure_partitions(conn, ahead=args.ahead)
+            print(f"{name}: создано секций: {len(created)}", *created)
+    else:
+        for name, shard_engine in _postgres_shards():
+            archive_dir = args.archive_dir if name == DEFAULT_SHARD else os.path.join(args.archive_dir, name)
+            await archive_partitions(timedelta(days=args.older_than_days), archive_dir, args.dry_run,
+                                     db_engine=shard_engine)
+    await shard_map.dispose()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,140 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Dict, Set
+
+from fastapi import WebSocket, status
+
+from app.chat.connections import ConnectionManager, manager
+from app.chat.membership import membership
+from app.config import settings
+from app.jobs import job_runner, PRIORITY_LOW
+
+
+class PresenceService:
+    """
+    Присутствие пользователей в сети. Пользователь в сети, пока у него есть хотя бы
+    одно соединение (учёт ведёт ConnectionManager). Соединения, приславшие хотя бы один
+    ping, обязуются слать его регулярно: без кадров дольше heartbeat_timeout они считаются
+    мёртвыми и закрываются. Клиенты без ping (в том числе /ws/{chat_id}/{user_id}) не
+    закрываются, обрыв TCP у них обнаруживают ping-кадры протокола в uvicorn. Изменения копятся и раз
+    в interval рассылаются одним событием только тем, кто состоит с пользователем в чате.
+    """
+
+    def __init__(self, connections: ConnectionManager, interval: float, heartbeat_timeout: float):
+        self.connections = connections
+        self.interval = interval
+        self.heartbeat_timeout = heartbeat_timeout
+        # соединение, приславшее ping -> момент последнего полученного кадра
+        self._heartbeats: Dict[WebSocket, float] = {}
+        # Состояние, которое уже разослано, и изменения с последней рассылки
+        self._published: Set[int] = set()
+        self._pending: Dict[int, bool] = {}
+        self._last_seen: Dict[int, datetime] = {}
+        self.stats = {"reaped": 0, "diffs_sent": 0}
+        connections.presence_listeners.append(self._on_change)
+
+    def _on_change(self, user_id: int, online: bool):
+        self._pending[user_id] = online
+        if not online:
+            self._last_seen[user_id] = datetime.utcnow()
+
+    def touch(self, websocket: WebSocket, ping: bool = False):
+        """
+        Отметка активности соединения, вызывается на каждый полученный кадр
+        :param ping: Кадр - ping; с него соединение начинает проверяться на таймаут
+        """
+        if ping or websocket in self._heartbeats:
+            self._heartbeats[websocket] = time.monotonic()
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self.connections.by_user
+
+    def status(self, user_ids) -> list[dict]:
+        """
+        Присутствие нескольких пользователей
+        :param user_ids: ID пользователей
+        :return: Список словарей с user_id, online и last_seen
+        """
+        result = []
+        for user_id in user_ids:
+            online = self.is_online(user_id)
+            last_seen = None if online else self._last_seen.get(user_id)
+            result.append({
+                "user_id": user_id,
+                "online": online,
+                "last_seen": last_seen.isoformat() if last_seen else None,
+            })
+        return result
+
+    async def reap(self):
+        """
+        Закрытие соединений с ping, от которых давно не было кадров
+        """
+        now = time.monotonic()
+        alive = self.connections.subscriptions
+        dead = []
+        for websocket, last in list(self._heartbeats.items()):
+            if websocket not in alive:
+                del self._heartbeats[websocket]
+            elif now - last > self.heartbeat_timeout:
+                dead.append(websocket)
+        for websocket in dead:
+            self._heartbeats.pop(websocket, None)
+            self.connections.disconnect(websocket)
+            self.stats["reaped"] += 1
+            try:
+                await asyncio.wait_for(websocket.close(code=status.WS_1001_GOING_AWAY), 1)
+            except Exception:
+                pass
+
+    async def flush(self):
+        """
+        Рассылка изменений присутствия, накопленных с прошлого вызова
+        """
+        pending, self._pending = self._pending, {}
+        changed = {
+            user_id: online for user_id, online in pending.items()
+            if online != (user_id in self._published)
+        }
+        if not changed:
+            return
+        # получатель -> (пришедшие в сеть, ушедшие из сети)
+        diffs: Dict[int, tuple[list, list]] = {}
+        for user_id, online in changed.items():
+            if online:
+                self._published.add(user_id)
+            else:
+                self._published.discard(user_id)
+            for chat_id in await membership.user_chats(user_id):
+                for member_id in await membership.members(chat_id):
+                    if member_id == user_id or not self.is_online(member_id):
+                        continue
+                    diff = diffs.setdefault(member_id, ([], []))
+                    target = diff[0] if online else diff[1]
+                    if user_id not in target:
+                        target.append(user_id)
+        for recipient_id, (online_ids, offline_ids) in diffs.items():
+            self.stats["diffs_sent"] += 1
+            job_runner.submit(self.connections.send_to_user, recipient_id, {
+                "action": "presence",
+                "online": online_ids,
+                "offline": offline_ids,
+            }, priority=PRIORITY_LOW)
+
+    async def run_periodically(self):
+        # Запускается из lifespan приложения
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reap()
+                await self.flush()
+            except Exception as e:
+                print(f"Ошибка рассылки присутствия: {e!r}")
+
+
+presence = PresenceService(
+    manager,
+    interval=settings.PRESENCE_INTERVAL,
+    heartbeat_timeout=settings.HEARTBEAT_TIMEOUT,
+)
@@ -1,19 +1,42 @@
+import csv
+import io
 import json
 from app.chat.models import Chat
-from app.chat.schemas import MessageCreate, MessageRead, ChatRead, ChatCreate, MessageStatus, FileRead
+from app.chat.schemas import MessageCreate, MessageRead, ChatRead, ChatCreate, MessageStatus, FileRead, ChangesRequest, UploadCreate, UploadComplete
 from app.database import async_session_maker
-from app.users.dependencies import auth_dependency
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Request, Depends, HTTPException, UploadFile, File
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from app.users.dependencies import Auth, auth_dependency
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Request, Depends, HTTPException, UploadFile, File, Query, status
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from typing import List, Dict
-from app.chat.dao import MessagesDAO, ChatDAO, FilesDAO
+from typing import List, Dict, Literal
+from app.chat.dao import MessagesDAO, ChatDAO, FilesDAO, ChatEventsDAO
+from app.chat.connections import manager
+from app.chat.codec import negotiate_codec
+from app.chat.membership import membership
+from app.chat.shards import shard_map
+from app.chat.typing_indicators import typing_tracker
+from app.chat.presence import presence
+from app.chat.delivery import delivery_tracker
+from app.chat.notifications import notifications
+from app.chat.chunked_uploads import chunked_uploads
+from app.chat.idempotency import normalize_client_id, recent_sends
+from app.jobs import job_runner, PRIORITY_HIGH
+from app.admission import admission, admit_interactive, PRIORITY_BULK
 from app.users.dao import UsersDAO
 from app.users.models import User
 import asyncio
+from pydantic import ValidationError
 
 router = APIRouter(prefix="/bittalk-mes", tags=["bittalk"])
-active_connections: Dict[int, List[WebSocket]] = {}
+
+
+def dump_json(payload) -> bytes:
+    """
+    Сериализация готовых словарей сразу в JSON-байты, минуя Pydantic
+    :param payload: Данные для сериализации
+    :return: JSON в кодировке UTF-8
+    """
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
 
 
 @router.get("/", response_class=JSONResponse, summary="Получение списка чатов")
@@ -27,7 +50,8 @@ async def get_chats(current_user = Depends(auth_dependency)):
 
 
 @router.post("/messages/", response_model=MessageRead,
-             summary="Отправка сообщения в чате")
+             summary="Отправка сообщения в чате",
+             dependencies=[Depends(admit_interactive)])
 async def send_message(message_create: MessageCreate,
                        current_user: User = Depends(auth_dependency)):
     """
@@ -39,16 +63,11 @@ async def send_message(message_create: MessageCreate,
     """
     chat_id = message_create.chat_id
     file_entity = None
-
-    if message_create.files:
-        file = message_create.files[0]
-        file_entity = await FilesDAO.save_file(file, chat_id = chat_id)
+    client_id = normalize_client_id(message_create.client_id)
 
     if chat_id:
-        # Если chat_id передан, пытаемся найти чат с этим chat_id
-        chat = await ChatDAO.get_chat(chat_id)
-        if not chat:
-            raise HTTPException(status_code = 404, detail = "Chat not found")
+        # Если chat_id передан, проверяем, что чат существует и пользователь в нём состоит
+        await membership.require_member(chat_id, current_user.id)
     else:
         # Если chat_id не передан, пытаемся создать новый чат
         chat = await ChatDAO.get_or_create_chat_between_users(current_user.id, message_create.recipient_id)
@@ -56,17 +75,45 @@ async def send_message(message_create: MessageCreate,
             raise HTTPException(status_code = 500, detail = "Ошибка при создании чата")
         chat_id = chat.id
 
+    # Ключ идемпотентности привязан к аутентифицированному отправителю, а не к sender_id из тела
+    if client_id:
+        # Повтор уже выполненной отправки возвращает исходное сообщение
+        cached = recent_sends.get(current_user.id, client_id)
+        if cached is not None:
+            return MessageRead(**cached)
 
     read_by = json.dumps([])  # по умолчанию список тех, кто прочитал сообщение, пустой
-    message = await MessagesDAO.add_message(
-        chat_id = chat_id,
-        sender_id = message_create.sender_id,
-        recipient_id = message_create.recipient_id,
-        content = message_create.content,
-        status = message_create.status,
-        read_by = read_by,
-        is_file = bool(file_entity)
-    )
+    created = True
+    if client_id:
+        message, created = await MessagesDAO.add_message_once(
+            chat_id = chat_id,
+            sender_id = current_user.id,
+            recipient_id = message_create.recipient_id,
+            content = message_create.content,
+            status = message_create.status,
+            client_id = client_id,
+            read_by = read_by,
+            is_file = bool(message_create.files)
+        )
+        if message is None:
+            raise HTTPException(status_code = 409, detail = "Сообщение с этим client_id уже разослано")
+    else:
+        message = await MessagesDAO.add_message(
+            chat_id = chat_id,
+            sender_id = current_user.id,
+            recipient_id = message_create.recipient_id,
+            content = message_create.content,
+            status = message_create.status,
+            read_by = read_by,
+            is_file = bool(message_create.files)
+        )
+
+    # Файл сохраняется только для нового сообщения, повтор не пишет его второй раз
+    if created and message_create.files:
+        session_maker = await shard_map.session_maker(chat_id)
+        async with session_maker() as session:
+            file_entity = await FilesDAO.save_file(message_create.files[0], chat_id = chat_id,
+                                                   session = session, message_id = message.id)
 
     message_read = MessageRead(
         id = message.id,
@@ -77,13 +124,18 @@ async def send_message(message_create: MessageCreate,
         status = message.status,
         files = [file_entity] if file_entity else []
     )
+    if client_id:
+        recent_sends.put(current_user.id, client_id, message_read.dict())
+        if not created:
+            # Сообщение уже разослано при первой отправке
+            return message_read
 
+    typing_tracker.stop(chat_id, current_user.id)
     await notify_user(chat_id, {
         "action": "new_message",
+        "seq": message.seq,
         "message": message_read.dict()
     })
-    print(
-        f"Sending message: sender_id={current_user.id}, recipient_id={message_create.recipient_id}, chat_id={chat_id}")
     return message_read
 
 
@@ -94,119 +146,268 @@ async def notify_user(chat_id: int, message: dict):
     :param message: Сообщение для уведомления
     """
     message["chat_id"] = chat_id
-    for connection in active_connections.get(chat_id, []):
-        await connection.send_json(message)
+    # Рассылка идёт в фоне; события одного чата доставляются в порядке постановки
+    job_runner.submit(manager.broadcast, chat_id, message,
+                      priority=PRIORITY_HIGH, key=("chat", chat_id))
+    # Участникам без соединений событие сохраняется до их подключения
+    await notifications.enqueue(chat_id, message)
+
+
+async def handle_socket_action(websocket: WebSocket, chat_id: int, user_id: int, data):
+    """
+    Обработка действия, пришедшего по вебсокету, в контексте чата.
+    :param websocket: Вебсокет-соединение
+    :param chat_id: Идентификатор чата
+    :param user_id: Идентификатор пользователя
+    :param data: Провалидированное действие (см. SocketAction)
+    """
+    if data.action == "new_message":
+        message = data.message
+        client_id = normalize_client_id(message.client_id)
+        if client_id is not None:
+            # Кэш отсекает повторы в этом процессе, уникальный индекс в БД - во всех.
+            # Если клиент уже сохранил сообщение через REST, в ключ пишется его ID
+            if (not recent_sends.claim(user_id, client_id)
+                    or not await MessagesDAO.claim_client_id(chat_id, user_id, client_id, message.id or 0)):
+                # Повтор уже разосланного сообщения
+                return
+        # Чат и отправителя задаёт соединение, а не содержимое кадра
+        message.chat_id = chat_id
+        message.sender_id = user_id
+        typing_tracker.stop(chat_id, user_id)
+        await notify_user(chat_id, {
+            "action": "new_message",
+            "message": message.model_dump(mode="json")
+        })
+    elif data.action == "new_file":
+        data.message.chat_id = chat_id
+        data.message.sender_id = user_id
+        await notify_user(chat_id, {
+            "action": "new_file",
+            "message": data.message.model_dump(mode="json")
+        })
+
+    elif data.action == "forward_message":
+        if not await membership.is_member(data.target_chat_id, user_id):
+            await manager.send(websocket, {"action": "error", "detail": "Access denied to this chat"})
+            return
+
+        # Пересылка сообщения
+        original_message = await MessagesDAO.get_message_by_id(data.message_id)
+        if not original_message:
+            raise HTTPException(status_code=404, detail="Message not found")
+
+        # Пересылаем сообщение в целевой чат
+        forwarded_message = await MessagesDAO.add_message(
+            chat_id=data.target_chat_id,
+            sender_id=user_id,
+            recipient_id=original_message.recipient_id,  # Можно изменить на нужного получателя
+            content=original_message.content,
+            status=MessageStatus.SENT
+        )
+
+        # Уведомление участников целевого чата
+        await notify_user(data.target_chat_id, {
+            "action": "new_message",
+            "seq": forwarded_message.seq,
+            "message": {
+                "id": forwarded_message.id,
+                "chat_id": forwarded_message.chat_id,
+                "sender_id": forwarded_message.sender_id,
+                "content": forwarded_message.content,
+                "status": forwarded_message.status
+            }
+        })
+
+    # Логика для обработки прочтения сообщения
+    elif data.action == "read_message":
+        message = await MessagesDAO.mark_message_as_read(
+            data.message_id,
+            user_id,
+            chat_id
+        )
+        await notify_user(chat_id, {
+            "action": "message_read",
+            "seq": message.seq if message else None,
+            "message_id": data.message_id,
+            "read_by": user_id,
+            "chat_id": chat_id
+        })
+
+    # Подтверждения доставки копятся и записываются пачками
+    elif data.action == "ack":
+        delivery_tracker.ack(chat_id, user_id, data.message_ids)
+
+    # Набор текста обрабатывается в памяти и рассылается пачками
+    elif data.action == "typing":
+        typing_tracker.update(chat_id, user_id, data.is_typing)
+
+    # Догрузка событий, пропущенных клиентом за время разрыва соединения
+    elif data.action == "resume":
+        changes = await ChatEventsDAO.get_changes(chat_id, data.cursor)
+        await manager.send(websocket, {"action": "changes", **changes})
+
+
+async def is_socket_user(websocket: WebSocket, user_id: int) -> bool:
+    """
+    Проверка, что ID пользователя из пути вебсокета совпадает с пользователем
+    из куки access_token (так же, как у HTTP-обработчиков через Auth)
+    :param websocket: Вебсокет-соединение
+    :param user_id: Идентификатор пользователя из пути
+    :return: True, если куки есть и принадлежат этому пользователю
+    """
+    try:
+        user = await Auth(websocket).get_current_user()
+    except HTTPException:
+        return False
+    return user.id == user_id
+
+
+async def accept_socket(websocket: WebSocket, user_id: int):
+    """
+    Согласование формата кадров и регистрация соединения.
+    :param websocket: Вебсокет-соединение
+    :param user_id: Идентификатор пользователя
+    :return: Кодек соединения или None, если соединение отклонено
+    """
+    codec, subprotocol = negotiate_codec(websocket)
+    await websocket.accept(subprotocol=subprotocol)
+    if manager.draining:
+        # Процесс останавливается: просим клиента подключиться позже к другому процессу
+        await websocket.close(code=status.WS_1012_SERVICE_RESTART)
+        return None
+    manager.connect(websocket, user_id, codec)
+    try:
+        await notifications.drain(websocket, user_id)
+    except Exception as e:
+        print(f"Не удалось отправить накопившиеся уведомления: {e!r}")
+    return codec
+
+
+async def receive_action(websocket: WebSocket, codec):
+    """
+    Получение следующего действия; невалидные кадры отклоняются сообщением об ошибке.
+    Любой кадр продлевает жизнь соединения, ping только отвечает pong
+    и включает для соединения проверку таймаута.
+    :param websocket: Вебсокет-соединение
+    :param codec: Кодек соединения
+    :return: Провалидированное действие
+    """
+    while True:
+        try:
+            data = await codec.receive(websocket)
+        except (ValidationError, ValueError) as e:
+            presence.touch(websocket)
+            await manager.send(websocket, {"action": "error", "detail": str(e)})
+            continue
+        presence.touch(websocket, ping=data.action == "ping")
+        if data.action == "ping":
+            await manager.send(websocket, {"action": "pong"})
+            continue
+        return data
 
 
 @router.websocket("/ws/{chat_id}/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, chat_id: int, user_id: int):
     """
-    Функция обработки вебсокет-соединения.
+    Функция обработки вебсокет-соединения одного чата.
     :param websocket: Вебсокет-соединение
     :param chat_id: Идентификатор чата
     :param user_id: Идентификатор пользователя
     :raises WebSocketDisconnect: Если соединение прервано
     """
-    await websocket.accept()
+    if not await is_socket_user(websocket, user_id) or not await membership.is_member(chat_id, user_id):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
 
-    if chat_id not in active_connections:
-        active_connections[chat_id] = []
-
-    active_connections[chat_id].append(websocket)
+    codec = await accept_socket(websocket, user_id)
+    if codec is None:
+        return
+    manager.subscribe(websocket, chat_id)
 
     try:
         while True:
-            data = await websocket.receive_json()
+            data = await receive_action(websocket, codec)
+            await handle_socket_action(websocket, chat_id, user_id, data)
 
-            if data["action"] == "new_message":
-                data["message"]["chat_id"] = chat_id
-                await notify_user(chat_id, {
-                    "action": "new_message",
-                    "message": data["message"]
-                })
-            elif data["action"] == "new_file":
-                await notify_user(chat_id, {
-                    "action": "new_file",
-                    "message": data["message"]
-                })
+    except WebSocketDisconnect:
+        pass
+    finally:
+        manager.disconnect(websocket)
 
-            elif data["action"] == "forward_message":
-                original_message_id = data["message_id"]
-                target_chat_id = data["target_chat_id"]
-
-                # Пересылка сообщения
-                original_message = await MessagesDAO.get_message_by_id(original_message_id)
-                if not original_message:
-                    raise HTTPException(status_code=404, detail="Message not found")
-
-                # Пересылаем сообщение в целевой чат
-                forwarded_message = await MessagesDAO.add_message(
-                    chat_id=target_chat_id,
-                    sender_id=user_id,
-                    recipient_id=original_message.recipient_id,  # Можно изменить на нужного получателя
-                    content=original_message.content,
-                    status=MessageStatus.SENT
-                )
-
-                # Уведомление участников целевого чата
-                await notify_user(target_chat_id, {
-                    "action": "new_message",
-                    "message": {
-                        "id": forwarded_message.id,
-                        "chat_id": forwarded_message.chat_id,
-                        "sender_id": forwarded_message.sender_id,
-                        "content": forwarded_message.content,
-                        "status": forwarded_message.status
-                    }
-                })
 
-            # Логика для обработки прочтения сообщения
-            elif data["action"] == "read_message":
-                await MessagesDAO.mark_message_as_read(
-                    data["message_id"],
-                    user_id
-                )
-                await notify_user(chat_id, {
-                    "action": "message_read",
-                    "message_id": data["message_id"],
-                    "read_by": user_id,
-                    "chat_id": chat_id
-                })
+@router.websocket("/ws/{user_id}")
+async def user_websocket_endpoint(websocket: WebSocket, user_id: int):
+    """
+    Единое вебсокет-соединение пользователя для всех его чатов.
+    Подписки управляются сообщениями subscribe/unsubscribe с полем chat_ids,
+    остальные действия должны содержать поле chat_id.
+    :param websocket: Вебсокет-соединение
+    :param user_id: Идентификатор пользователя
+    """
+    if not await is_socket_user(websocket, user_id):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    codec = await accept_socket(websocket, user_id)
+    if codec is None:
+        return
 
-            await asyncio.sleep(1)
+    try:
+        while True:
+            data = await receive_action(websocket, codec)
+
+            if data.action == "subscribe":
+                # Подписаться можно только на чаты, в которых пользователь состоит
+                user_chats = await membership.user_chats(user_id)
+                chat_ids = [chat_id for chat_id in data.chat_ids if chat_id in user_chats]
+                for chat_id in chat_ids:
+                    manager.subscribe(websocket, chat_id)
+                await manager.send(websocket, {
+                    "action": "subscribed",
+                    "chat_ids": chat_ids,
+                    "denied": [chat_id for chat_id in data.chat_ids if chat_id not in user_chats]
+                })
+            elif data.action == "unsubscribe":
+                for chat_id in data.chat_ids:
+                    manager.unsubscribe(websocket, chat_id)
+                await manager.send(websocket, {"action": "unsubscribed", "chat_ids": data.chat_ids})
+            elif data.chat_id is None:
+                await manager.send(websocket, {"action": "error", "detail": "chat_id is required"})
+            elif not await membership.is_member(data.chat_id, user_id):
+                await manager.send(websocket, {"action": "error", "detail": "Access denied to this chat"})
+            else:
+                await handle_socket_action(websocket, data.chat_id, user_id, data)
 
     except WebSocketDisconnect:
-        active_connections[chat_id].remove(websocket)
-        if not active_connections[chat_id]:
-            del active_connections[chat_id]
+        pass
+    finally:
+        manager.disconnect(websocket)
 
 
 @router.get("/messages/{chat_id}", response_model=List[MessageRead],
-            summary = "Получение сообщений в чате")
-async def get_messages(chat_id: int,
+            summary = "Получение сообщений в чате",
+            dependencies=[Depends(admit_interactive)])
+async def get_messages(chat_id: int, limit: int | None = Query(None, ge=1),
+                       before_id: int | None = Query(None, ge=1),
                        current_user: User = Depends(auth_dependency)):
     """
     Получение списка сообщений в определённом чате
     :param chat_id: Идентификатор чата
+    :param limit: Количество последних сообщений, по умолчанию вся история
+    :param before_id: Только сообщения с ID меньше этого: следующая страница старой истории
+        запрашивается с ID самого старого полученного сообщения
     :param current_user: Аутентифицированный пользователь
     :return: Список сообщений в чате
     """
-    messages = await MessagesDAO.get_messages_between_users(chat_id=chat_id)
-    return [
-        MessageRead(
-            id=message.id,
-            chat_id=message.chat_id,
-            sender_id=message.sender_id,
-            content=message.content,
-            status=message.status,
-            recipient_id=current_user.id,
-            files = message.files,
-        )
-        for message in messages
-    ]
+    await membership.require_member(chat_id, current_user.id)
+    rows = await MessagesDAO.get_history(chat_id=chat_id, recipient_id=current_user.id,
+                                         limit=limit, before_id=before_id)
+    return Response(content=dump_json(rows), media_type="application/json")
 
 
-@router.get("/chat/{chat_id}", summary="Получить чат между пользователями")
+@router.get("/chat/{chat_id}", summary="Получить чат между пользователями",
+            dependencies=[Depends(admit_interactive)])
 async def get_chat(chat_id: int, current_user: User = Depends(auth_dependency)):
     """
     Получение информации о чате и его сообщениях, если пользователь является участником чата.
@@ -214,18 +415,17 @@ async def get_chat(chat_id: int, current_user: User = Depends(auth_dependency)):
     :param current_user: Аутентифицированный пользователь
     :return: Информация о чате и его сообщениях
     """
+    # Проверяем, является ли текущий пользователь участником чата
+    await membership.require_member(chat_id, current_user.id)
+
     async with async_session_maker() as session:
         # Получаем чат из базы данных
         chat = await session.get(Chat, chat_id)
         if chat is None:
             raise HTTPException(status_code=404, detail="Chat not found")
 
-        # Проверяем, является ли текущий пользователь участником чата
-        if current_user.id not in [participant.id for participant in chat.participants]:
-            raise HTTPException(status_code=403, detail="Access denied to this chat")
-
-        # Получаем сообщения чата
-        messages = await MessagesDAO.get_messages_between_users(chat_id)
+        # Получаем сообщения чата (из кэша последних сообщений, если он полон)
+        messages = await MessagesDAO.get_history(chat_id, current_user.id)
 
         return {
             "chat": chat,
@@ -233,6 +433,105 @@ async def get_chat(chat_id: int, current_user: User = Depends(auth_dependency)):
         }
 
 
+@router.get("/chat/{chat_id}/changes", summary="Изменения в чате после курсора",
+            dependencies=[Depends(admit_interactive)])
+async def get_chat_changes(chat_id: int, since: int = 0, limit: int = 500,
+                           current_user: User = Depends(auth_dependency)):
+    """
+    Получение событий чата (новые, изменённые, удалённые и прочитанные сообщения),
+    произошедших после указанного курсора
+    :param chat_id: Идентификатор чата
+    :param since: Последний известный клиенту номер события
+    :param limit: Максимальное количество событий
+    :param current_user: Аутентифицированный пользователь
+    :return: События, новый курсор и признак наличия продолжения
+    """
+    await membership.require_member(chat_id, current_user.id)
+    return await ChatEventsDAO.get_changes(chat_id, since, min(limit, 1000))
+
+
+EXPORT_CSV_FIELDS = ["id", "chat_id", "sender_id", "recipient_id", "content", "status",
+                     "read_by", "is_file", "created_at", "edited_at", "files"]
+
+
+async def export_ndjson(chat_id: int, after_id: int):
+    async for batch in MessagesDAO.stream_export(chat_id, after_id):
+        yield b"".join(dump_json(row) + b"\n" for row in batch)
+
+
+class SlotStreamingResponse(StreamingResponse):
+    """
+    Потоковый ответ, удерживающий слот AdmissionController до конца отправки.
+    Слот освобождается при любом завершении ответа: успехе, ошибке отправки или обрыве
+    соединения, в том числе до того, как поток начал читаться
+    """
+
+    def __init__(self, content, acquired_at: float, **kwargs):
+        super().__init__(content, **kwargs)
+        self.acquired_at = acquired_at
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            admission.release(self.acquired_at)
+
+
+async def export_csv(chat_id: int, after_id: int):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_CSV_FIELDS)
+    writer.writeheader()
+    yield buffer.getvalue().encode()
+    buffer.seek(0)
+    buffer.truncate()
+    async for batch in MessagesDAO.stream_export(chat_id, after_id):
+        for row in batch:
+            writer.writerow({**row, "files": json.dumps(row["files"], ensure_ascii=False)})
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+@router.get("/chat/{chat_id}/export", summary="Выгрузка всех сообщений чата")
+async def export_chat(chat_id: int, format: Literal["ndjson", "csv"] = "ndjson", after_id: int = 0,
+                      current_user: User = Depends(auth_dependency)):
+    """
+    Потоковая выгрузка сообщений чата с метаданными вложений в NDJSON или CSV.
+    Прерванную выгрузку можно продолжить, передав ID последнего полученного сообщения.
+    :param chat_id: Идентификатор чата
+    :param format: Формат выгрузки: ndjson или csv
+    :param after_id: ID сообщения, после которого продолжить выгрузку
+    :param current_user: Аутентифицированный пользователь
+    :return: Потоковый ответ с сообщениями чата
+    """
+    await membership.require_member(chat_id, current_user.id)
+    # Слот удерживается, пока идёт выгрузка
+    acquired_at = await admission.acquire(PRIORITY_BULK)
+    if format == "csv":
+        content, media_type = export_csv(chat_id, after_id), "text/csv"
+    else:
+        content, media_type = export_ndjson(chat_id, after_id), "application/x-ndjson"
+    return SlotStreamingResponse(
+        content,
+        acquired_at,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="chat_{chat_id}_after_{after_id}.{format}"'},
+    )
+
+
+@router.post("/changes", summary="Изменения во всех чатах пользователя",
+             dependencies=[Depends(admit_interactive)])
+async def get_changes(changes_request: ChangesRequest,
+                      current_user: User = Depends(auth_dependency)):
+    """
+    Получение изменений по всем чатам пользователя относительно курсоров клиента
+    :param changes_request: Известные клиенту курсоры по чатам
+    :param current_user: Аутентифицированный пользователь
+    :return: События, новые курсоры и список новых для клиента чатов
+    """
+    return await ChatEventsDAO.get_changes_for_user(current_user.id, changes_request.cursors)
+
+
 @router.post("/messages/{message_id}/read",
              summary="Отметить сообщение как прочитанное")
 async def read_message(message_id: int,
@@ -267,6 +566,13 @@ async def create_chat(chat: ChatCreate):
         name=chat.name,
         participant_ids=chat.participant_ids
     )
+    # Подписываем открытые соединения участников и сообщаем им о новом чате
+    for participant in new_chat.participants:
+        manager.subscribe_user(participant.id, new_chat.id)
+        await manager.send_to_user(participant.id, {
+            "action": "new_chat",
+            "chat": {"id": new_chat.id, "name": new_chat.name}
+        })
     return new_chat
 
 
@@ -282,6 +588,70 @@ async def get_current_user_endpoint(current_user: User = Depends(auth_dependency
     return {"user": current_user}
 
 
+@router.get("/bootstrap", summary="Начальные данные клиента одним запросом",
+            dependencies=[Depends(admit_interactive)])
+async def bootstrap(limit: int = Query(default=30, ge=1, le=100),
+                    offset: int = Query(default=0, ge=0),
+                    top_chats: int = Query(default=5, ge=0, le=20),
+                    history_limit: int = Query(default=30, ge=1, le=100),
+                    current_user: User = Depends(auth_dependency)):
+    """
+    Данные для открытия приложения вместо цепочки /current_user, / и /messages/{chat_id}:
+    текущий пользователь, страница списка чатов с количеством непрочитанных
+    и последние сообщения первых чатов страницы
+    :param limit: Размер страницы списка чатов
+    :param offset: Сколько чатов пропустить
+    :param top_chats: Для скольких первых чатов страницы отдать сообщения
+    :param history_limit: Количество последних сообщений каждого из этих чатов
+    :param current_user: Аутентифицированный пользователь
+    :return: Пользователь, список чатов и сообщения
+    """
+    page, stats, total = await ChatDAO.get_inbox_page(current_user.id, limit, offset)
+    # Чаты и сообщения читаются параллельно, сообщения - одной выборкой на шард
+    chats, history = await asyncio.gather(
+        ChatDAO.get_chats_by_ids(page),
+        MessagesDAO.get_recent_history(page[:top_chats], current_user.id, history_limit),
+    )
+    inbox = []
+    for chat_id in page:
+        chat = chats.get(chat_id)
+        if chat is None:
+            continue
+        last_message_id, last_message_content, unread_count = stats.get(chat_id, (None, None, 0))
+        inbox.append({
+            "id": chat_id,
+            "name": ChatDAO.display_name(chat, current_user.id),
+            "last_message_id": last_message_id,
+            "last_message_content": last_message_content if last_message_id else "Нет сообщений",
+            "unread_count": unread_count,
+            "last_seq": chat.last_seq,
+        })
+    payload = {
+        "user": {"id": current_user.id, "name": current_user.name, "email": current_user.email},
+        "inbox": {"chats": inbox, "total": total, "offset": offset, "limit": limit},
+        "messages": [{"chat_id": chat_id, "messages": rows} for chat_id, rows in history.items()],
+    }
+    return Response(content=dump_json(payload), media_type="application/json")
+
+
+@router.get("/presence", summary="Присутствие пользователей в сети")
+async def get_presence(user_ids: List[int] = Query(default=[]),
+                       current_user: User = Depends(auth_dependency)):
+    """
+    Получение статуса в сети для списка пользователей, например для списка чатов.
+    Отдаются только пользователи, состоящие с текущим пользователем в общих чатах.
+    :param user_ids: ID пользователей, по умолчанию все собеседники
+    :param current_user: Аутентифицированный пользователь
+    :return: Список статусов пользователей
+    """
+    contacts = set()
+    for chat_id in await membership.user_chats(current_user.id):
+        contacts |= await membership.members(chat_id)
+    contacts.discard(current_user.id)
+    requested = [user_id for user_id in user_ids if user_id in contacts] if user_ids else sorted(contacts)
+    return presence.status(requested)
+
+
 @router.get("/files/{filename}", summary="Загрузка файла")
 async def download_file(filename: str):
     """
@@ -293,24 +663,27 @@ async def download_file(filename: str):
     return FileResponse(file_location)
 
 
-@router.post("/messages/file/", response_model=FileRead, summary="Отправка файла")
+@router.post("/messages/file/", response_model=FileRead, summary="Отправка файла",
+             dependencies=[Depends(admit_interactive)])
 async def send_file(
         chat_id: int,
         recipient_id: int,
         file: UploadFile = File(...),
         current_user: User = Depends(auth_dependency),
 ):
-    async with async_session_maker() as session:
-        chat = await ChatDAO.get_or_create_chat_between_users(current_user.id, recipient_id)
-        message = await MessagesDAO.add_message(
-            chat_id=chat.id,
-            sender_id=current_user.id,
-            recipient_id=recipient_id,
-            content='',
-            status=MessageStatus.SENT,
-            is_file=True
-        )
-        file_entity = await FilesDAO.save_file(file, chat_id=chat.id, session=session)
+    chat = await ChatDAO.get_or_create_chat_between_users(current_user.id, recipient_id)
+    message = await MessagesDAO.add_message(
+        chat_id=chat.id,
+        sender_id=current_user.id,
+        recipient_id=recipient_id,
+        content='',
+        status=MessageStatus.SENT,
+        is_file=True
+    )
+    # Запись о файле хранится на шарде чата вместе с сообщением
+    session_maker = await shard_map.session_maker(chat.id)
+    async with session_maker() as session:
+        file_entity = await FilesDAO.save_file(file, chat_id=chat.id, session=session, message_id=message.id)
         message_dict = {
             "id": message.id,
             "chat_id": message.chat_id,
@@ -330,13 +703,114 @@ async def send_file(
         )
 
 
+@router.post("/uploads", summary="Начало загрузки файла частями",
+             dependencies=[Depends(admit_interactive)])
+async def create_upload(upload: UploadCreate, current_user: User = Depends(auth_dependency)):
+    """
+    Создание сессии загрузки большого файла
+    :param upload: Имя, размер файла и получатель
+    :param current_user: Аутентифицированный пользователь
+    :return: ID сессии, рекомендуемый размер части и полученные диапазоны
+    """
+    if upload.chat_id is not None:
+        await membership.require_member(upload.chat_id, current_user.id)
+        chat_id = upload.chat_id
+    else:
+        chat = await ChatDAO.get_or_create_chat_between_users(current_user.id, upload.recipient_id)
+        chat_id = chat.id
+    session = await chunked_uploads.create(current_user.id, chat_id, upload.recipient_id,
+                                           upload.filename, upload.size)
+    return session.status()
+
+
+@router.put("/uploads/{upload_id}", summary="Загрузка части файла")
+async def upload_chunk(upload_id: str, offset: int, request: Request,
+                       current_user: User = Depends(auth_dependency)):
+    """
+    Запись части файла по смещению; тело запроса - байты части.
+    Части можно отправлять параллельно и повторно.
+    :param upload_id: ID сессии загрузки
+    :param offset: Смещение части в файле
+    :param request: Запрос с телом части
+    :param current_user: Аутентифицированный пользователь
+    :return: Состояние загрузки
+    """
+    session = chunked_uploads.get(upload_id, current_user.id)
+    await chunked_uploads.write_chunk(session, offset, request.stream())
+    return session.status()
+
+
+@router.get("/uploads/{upload_id}", summary="Состояние загрузки файла")
+async def get_upload(upload_id: str, current_user: User = Depends(auth_dependency)):
+    """
+    Полученные диапазоны файла, чтобы продолжить прерванную загрузку
+    :param upload_id: ID сессии загрузки
+    :param current_user: Аутентифицированный пользователь
+    :return: Состояние загрузки
+    """
+    return chunked_uploads.get(upload_id, current_user.id).status()
+
+
+@router.delete("/uploads/{upload_id}", summary="Отмена загрузки файла")
+async def abort_upload(upload_id: str, current_user: User = Depends(auth_dependency)):
+    await chunked_uploads.abort(chunked_uploads.get(upload_id, current_user.id))
+    return {"message": "Загрузка отменена"}
+
+
+@router.post("/uploads/{upload_id}/complete", response_model=FileRead, summary="Завершение загрузки файла",
+             dependencies=[Depends(admit_interactive)])
+async def complete_upload(upload_id: str, upload_complete: UploadComplete,
+                          current_user: User = Depends(auth_dependency)):
+    """
+    Проверка контрольной суммы и отправка файла сообщением в чат
+    :param upload_id: ID сессии загрузки
+    :param upload_complete: Контрольная сумма файла
+    :param current_user: Аутентифицированный пользователь
+    :return: Информация о файле
+    """
+    upload = chunked_uploads.get(upload_id, current_user.id)
+    file_location = await chunked_uploads.finish(upload, upload_complete.sha256)
+    message = await MessagesDAO.add_message(
+        chat_id=upload.chat_id,
+        sender_id=current_user.id,
+        recipient_id=upload.recipient_id,
+        content='',
+        status=MessageStatus.SENT,
+        is_file=True
+    )
+    session_maker = await shard_map.session_maker(upload.chat_id)
+    async with session_maker() as session:
+        file_entity = await FilesDAO.add_file(session, upload.filename, file_location,
+                                              upload.chat_id, message.id)
+    file_read = FileRead(
+        id=file_entity.id,
+        filename=file_entity.filename,
+        file_path=file_entity.file_path,
+        chat_id=upload.chat_id
+    )
+    message_read = MessageRead(
+        id=message.id,
+        chat_id=message.chat_id,
+        sender_id=message.sender_id,
+        recipient_id=message.recipient_id,
+        content=message.content,
+        status=message.status,
+    )
+    await notify_user(upload.chat_id, {
+        "action": "new_message",
+        "seq": message.seq,
+        "message": {**message_read.dict(), "files": [file_read.dict()]}
+    })
+    return file_read
+
+
 @router.delete("/messages/{message_id}", summary="Удаление сообщения")
 async def delete_message(message_id: int, current_user: User = Depends(auth_dependency)):
     message = await MessagesDAO.delete_message(message_id, current_user.id)
     if message:
-        chat_id = await MessagesDAO.get_chat_id_for_message(message_id)
-        await notify_user(chat_id, {
+        await notify_user(message.chat_id, {
             "action": "delete_message",
+            "seq": message.seq,
             "message_id": message_id
         })
         return {"message": "Сообщение успешно удалено"}
@@ -362,6 +836,7 @@ async def edit_message(message_id: int, message_create: MessageCreate, current_u
 
     await notify_user(chat_id, {
         "action": "edit_message",
+        "seq": updated_message.seq,
         "message": message_read.dict()
     })
     return message_read
@@ -378,6 +853,7 @@ async def forward_message(
         raise HTTPException(status_code=404, detail="Сообщение не найдено")
     if current_user.id not in [original_message.sender_id, original_message.recipient_id]:
         raise HTTPException(status_code=403, detail="Вы не можете пересылать это сообщение")
+    await membership.require_member(target_chat_id, current_user.id)
     forwarded_message = await MessagesDAO.add_message(
         chat_id=target_chat_id,
         sender_id=current_user.id,
@@ -387,6 +863,7 @@ async def forward_message(
     )
     await notify_user(target_chat_id, {
         "action": "new_message",
+        "seq": forwarded_message.seq,
         "message": {
             "id": forwarded_message.id,
             "chat_id": forwarded_message.chat_id,
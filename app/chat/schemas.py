@@ -1,7 +1,7 @@
-from typing import List
+from typing import List, Dict, Literal, Union, Annotated
 
 from fastapi import UploadFile
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
 from enum import Enum
 
 
@@ -34,6 +34,8 @@ class MessageCreate(MessageBase):
     sender_id: int = Field(..., description="ID отправителя сообщения")
     recipient_id: int = Field(..., description="ID получателя сообщения")
     files: List[UploadFile] = []
+    client_id: str | None = Field(default=None, max_length=64,
+                                  description="ID сообщения, сгенерированный клиентом, для безопасных повторов")
 
 
 class ChatCreate(BaseModel):
@@ -69,4 +71,100 @@ class FileRead(BaseModel):
     chat_id: int
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+
+class UploadCreate(BaseModel):
+    filename: str = Field(..., description="Имя файла")
+    size: int = Field(..., ge=0, description="Размер файла в байтах")
+    recipient_id: int = Field(..., description="ID получателя сообщения")
+    chat_id: int | None = Field(default=None, description="ID чата, по умолчанию личный чат с получателем")
+
+
+class UploadComplete(BaseModel):
+    sha256: str = Field(..., description="Контрольная сумма SHA-256 всего файла в hex")
+
+
+class ChangesRequest(BaseModel):
+    cursors: Dict[int, int] = Field(
+        default={},
+        description="Последние известные клиенту номера событий по чатам"
+    )
+
+
+
+# Схемы действий, приходящих по вебсокету
+class SocketMessage(MessageRead):
+    id: int | None = Field(default=None, description="ID сообщения, если клиент уже сохранил его через REST")
+    chat_id: int | None = Field(default=None, description="ID чата, сервер подставляет чат соединения")
+    files: List[FileRead] = []
+    # Длину не ограничиваем: ключ приводится к единому виду normalize_client_id
+    client_id: str | None = Field(default=None,
+                                  description="ID сообщения, сгенерированный клиентом, для безопасных повторов")
+
+
+class NewMessageAction(BaseModel):
+    action: Literal["new_message"]
+    chat_id: int | None = None
+    message: SocketMessage
+
+
+class NewFileAction(BaseModel):
+    action: Literal["new_file"]
+    chat_id: int | None = None
+    message: SocketMessage
+
+
+class ForwardMessageAction(BaseModel):
+    action: Literal["forward_message"]
+    chat_id: int | None = None
+    message_id: int
+    target_chat_id: int
+
+
+class ReadMessageAction(BaseModel):
+    action: Literal["read_message"]
+    chat_id: int | None = None
+    message_id: int
+
+
+class ResumeAction(BaseModel):
+    action: Literal["resume"]
+    chat_id: int | None = None
+    cursor: int = 0
+
+
+class TypingAction(BaseModel):
+    action: Literal["typing"]
+    chat_id: int | None = None
+    is_typing: bool = True
+
+
+class AckAction(BaseModel):
+    action: Literal["ack"]
+    chat_id: int | None = None
+    message_ids: List[int]
+
+
+class PingAction(BaseModel):
+    action: Literal["ping"]
+
+
+class SubscribeAction(BaseModel):
+    action: Literal["subscribe"]
+    chat_ids: List[int]
+
+
+class UnsubscribeAction(BaseModel):
+    action: Literal["unsubscribe"]
+    chat_ids: List[int]
+
+
+SocketAction = Annotated[
+    Union[NewMessageAction, NewFileAction, ForwardMessageAction, ReadMessageAction,
+          ResumeAction, TypingAction, AckAction, PingAction, SubscribeAction, UnsubscribeAction],
+    Field(discriminator="action")
+]
+
+# Валидатор собирается один раз при импорте и переиспользуется для каждого кадра
+socket_action_adapter = TypeAdapter(SocketAction)
@@ -0,0 +1,548 @@
+"""
+Шардирование сообщений и файлов по chat_id.
+
+Таблицы messages, files и message_idempotency_keys хранятся на шардах, всё остальное
+(пользователи, чаты, участники, журнал событий) - в основной БД. Шард default - это
+основная БД; дополнительные шарды перечисляются в MESSAGES_SHARDS. Новый чат
+размещается по согласованному хешированию chat_id и запоминает шард в chats.shard,
+поэтому добавление шарда не перемещает существующие чаты само по себе: их переносит
+команда rebalance без остановки записи.
+
+Атомарной фиксации двух БД нет, поэтому изменение сообщения на шарде фиксируется первым,
+а событие журнала вместе с chats.last_seq - следом в основной БД (ChatEventsDAO.commit):
+событие без сообщения не появляется, номера событий идут без пропусков.
+
+ID строк шардированных таблиц выдаёт основная БД (последовательности таблиц в PostgreSQL,
+таблица shard_id_counters в остальных СУБД), поэтому они уникальны и растут
+независимо от шарда: история, курсоры и секции по id не ломаются после переноса чата.
+
+    python -m app.chat.shards init                  # однократно после добавления шарда
+    python -m app.chat.shards status
+    python -m app.chat.shards move CHAT_ID SHARD
+    python -m app.chat.shards rebalance [--batch-size 100] [--dry-run]
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import time
+from datetime import timedelta
+
+from sqlalchemy import select, update, delete, func, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+from app.chat.models import Message, File, MessageIdempotencyKey, Chat, shard_id_counters
+from app.config import settings
+from app.database import engine, make_engine, async_session_maker, read_session_maker, PrimarySession
+
+DEFAULT_SHARD = "default"
+# Модели, строки которых живут на шарде чата
+SHARDED_MODELS = (Message, File, MessageIdempotencyKey)
+
+
+def parse_shards(value: str) -> dict[str, str]:
+    """
+    Разбор списка шардов из настроек
+    :param value: Строка вида "имя=адрес,имя=адрес"
+    :return: Имя шарда -> адрес БД в порядке перечисления
+    """
+    shards = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, url = item.partition("=")
+        if not url or name == DEFAULT_SHARD:
+            raise ValueError(f"Некорректный шард в MESSAGES_SHARDS: {item!r}")
+        shards[name.strip()] = url.strip()
+    return shards
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Кольцо согласованного хеширования: при добавлении шарда на него
+    переезжает только примерно 1/N чатов
+    """
+
+    def __init__(self, names: list[str], virtual_nodes: int):
+        points = sorted(
+            (_hash(f"{name}#{node}"), name)
+            for name in names
+            for node in range(virtual_nodes)
+        )
+        self._keys = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def get(self, chat_id: int) -> str:
+        index = bisect.bisect(self._keys, _hash(str(chat_id))) % len(self._keys)
+        return self._names[index]
+
+
+class ShardMap:
+    """
+    Карта chat_id -> шард: фабрики сессий по шардам и кэш размещения чатов.
+    Сессии шарда пишут модели SHARDED_MODELS в шард, остальные - в основную БД.
+    """
+
+    def __init__(self, shard_urls: dict[str, str], placement_ttl: float, virtual_nodes: int,
+                 max_cached: int = 100_000):
+        self.placement_ttl = placement_ttl
+        self.max_cached = max_cached
+        self.engines = {DEFAULT_SHARD: engine}
+        self.engines.update({name: make_engine(url) for name, url in shard_urls.items()})
+        self.ring = HashRing(list(self.engines), virtual_nodes)
+        self._makers = {DEFAULT_SHARD: async_session_maker}
+        for name, shard_engine in self.engines.items():
+            if name != DEFAULT_SHARD:
+                self._makers[name] = async_sessionmaker(
+                    engine, class_=PrimarySession, expire_on_commit=False,
+                    binds={model: shard_engine for model in SHARDED_MODELS},
+                )
+        # chat_id -> (шард, момент устаревания)
+        self._placement: dict[int, tuple[str, float]] = {}
+
+    @property
+    def sharded(self) -> bool:
+        return len(self.engines) > 1
+
+    def place(self, chat_id: int) -> str | None:
+        """
+        Шард для нового чата
+        :return: Имя шарда, None без шардирования
+        """
+        return self.ring.get(chat_id) if self.sharded else None
+
+    def remember(self, chat_id: int, shard: str | None):
+        if self.sharded:
+            self._placement[chat_id] = (shard or DEFAULT_SHARD, time.monotonic() + self.placement_ttl)
+
+    def forget(self, chat_id: int):
+        self._placement.pop(chat_id, None)
+
+    async def shards_for(self, chat_ids) -> dict[int, str]:
+        """
+        Шарды чатов; неизвестные размещения загружаются одним запросом
+        :param chat_ids: ID чатов
+        :return: chat_id -> имя шарда
+        """
+        if not self.sharded:
+            return {chat_id: DEFAULT_SHARD for chat_id in chat_ids}
+        now = time.monotonic()
+        placement = {}
+        missing = []
+        for chat_id in chat_ids:
+            cached = self._placement.get(chat_id)
+            if cached is not None and cached[1] > now:
+                placement[chat_id] = cached[0]
+            else:
+                missing.append(chat_id)
+        if missing:
+            if len(self._placement) >= self.max_cached:
+                self._placement = {k: v for k, v in self._placement.items() if v[1] > now}
+            # Размещение читаем с основной БД: реплика могла ещё не получить новый чат
+            async with async_session_maker() as session:
+                result = await session.execute(
+                    select(Chat.id, Chat.shard).where(Chat.id.in_(missing)))
+                loaded = dict(result.all())
+            for chat_id in missing:
+                shard = loaded.get(chat_id) or DEFAULT_SHARD
+                if shard not in self.engines:
+                    raise RuntimeError(f"Чат {chat_id} размещён на неизвестном шарде {shard}")
+                self.remember(chat_id, shard)
+                placement[chat_id] = shard
+        return placement
+
+    async def shard_for(self, chat_id: int) -> str:
+        return (await self.shards_for([chat_id]))[chat_id]
+
+    def maker(self, shard: str, read: bool = False):
+        """
+        Фабрика сессий шарда; чтение шарда default может уйти на реплику
+        """
+        if shard == DEFAULT_SHARD and read:
+            return read_session_maker
+        return self._makers[shard]
+
+    async def session_maker(self, chat_id: int, read: bool = False):
+        """
+        Фабрика сессий для работы с сообщениями и файлами чата
+        :param chat_id: ID чата
+        :param read: Сессия только для чтения
+        """
+        if not self.sharded:
+            return read_session_maker if read else async_session_maker
+        return self.maker(await self.shard_for(chat_id), read)
+
+    def makers(self) -> dict:
+        """
+        Фабрики сессий всех шардов для запросов без chat_id
+        """
+        return dict(self._makers)
+
+    async def shard_for_message(self, message_id: int, chat_id: int | None = None) -> str | None:
+        """
+        Шард сообщения. Если чат сообщения известен, шард берётся из размещения чата
+        без обращения к шардам, иначе все шарды опрашиваются параллельно.
+        Во время переноса чата сообщение есть на двух шардах, тогда выбирается текущий шард чата.
+        :param message_id: ID сообщения
+        :param chat_id: ID чата сообщения, если он известен вызывающему
+        :return: Имя шарда или None, если сообщения нет
+        """
+        if not self.sharded:
+            return DEFAULT_SHARD
+        if chat_id is not None:
+            return await self.shard_for(chat_id)
+
+        async def probe(name: str):
+            async with self.engines[name].connect() as conn:
+                result = await conn.execute(select(Message.chat_id).where(Message.id == message_id))
+                return name, result.scalar()
+
+        found = {name: chat_id for name, chat_id in await asyncio.gather(*map(probe, self.engines))
+                 if chat_id is not None}
+        if not found:
+            return None
+        current = await self.shard_for(next(iter(found.values())))
+        return current if current in found else next(iter(found))
+
+    async def session_maker_for_message(self, message_id: int, chat_id: int | None = None):
+        """
+        Фабрика сессий шарда, на котором лежит сообщение.
+        Если сообщение не найдено, отдаётся основная БД, где поиск вернёт пустой результат.
+        :param chat_id: ID чата сообщения, если он известен: тогда шарды не опрашиваются
+        """
+        if not self.sharded:
+            return async_session_maker
+        return self._makers[await self.shard_for_message(message_id, chat_id) or DEFAULT_SHARD]
+
+    async def allocate_ids(self, model, count: int = 1) -> list[int] | None:
+        """
+        Выдача ID для новых строк шардированной таблицы из основной БД.
+        Блоки ID не кэшируются в процессе, чтобы ID сообщений росли в порядке вставки.
+        :param model: Модель из SHARDED_MODELS
+        :param count: Количество ID
+        :return: Список ID по возрастанию, None без шардирования (ID выдаёт сама таблица)
+        """
+        if not self.sharded:
+            return None
+        table = model.__table__
+        async with engine.begin() as conn:
+            if engine.dialect.name == "postgresql":
+                result = await conn.execute(
+                    text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+                    {"table": table.name, "count": count},
+                )
+                return sorted(result.scalars().all())
+            last_id = (await conn.execute(
+                update(shard_id_counters)
+                .where(shard_id_counters.c.table_name == table.name)
+                .values(last_id=shard_id_counters.c.last_id + count)
+                .returning(shard_id_counters.c.last_id)
+            )).scalar()
+        if last_id is None:
+            raise RuntimeError(f"Нет счётчика ID для {table.name}: выполните python -m app.chat.shards init")
+        return list(range(last_id - count + 1, last_id + 1))
+
+    async def next_id(self, model) -> int | None:
+        ids = await self.allocate_ids(model)
+        return ids[0] if ids else None
+
+    async def dispose(self):
+        for name, shard_engine in self.engines.items():
+            if name != DEFAULT_SHARD:
+                await shard_engine.dispose()
+
+
+shard_map = ShardMap(parse_shards(settings.MESSAGES_SHARDS), settings.SHARD_PLACEMENT_TTL,
+                     settings.SHARD_VIRTUAL_NODES)
+
+
+# Перенос чатов между шардами
+
+def _upsert(shard_engine, table):
+    dialect = postgresql if shard_engine.dialect.name == "postgresql" else sqlite
+    statement = dialect.insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.id],
+        set_={c.name: statement.excluded[c.name] for c in table.c if c.name != "id"},
+    )
+
+
+def _chat_rows(table, chat_ids: list[int]):
+    """
+    Запрос строк таблицы шарда, относящихся к чатам
+    """
+    if table is MessageIdempotencyKey.__table__:
+        messages = Message.__table__
+        return (select(table)
+                .join(messages, messages.c.id == table.c.message_id)
+                .where(messages.c.chat_id.in_(chat_ids)))
+    return select(table).where(table.c.chat_id.in_(chat_ids))
+
+
+SHARDED_TABLES = [model.__table__ for model in SHARDED_MODELS]
+
+
+def _fingerprint(row) -> int:
+    return hash(tuple(row.values()))
+
+
+async def _copy_rows(source, target, chat_ids: list[int], batch_size: int = 5000) -> dict[str, dict[int, int]]:
+    """
+    Копирование строк чатов с шарда на шард пачками по возрастанию id.
+    Вставка идемпотентна, поэтому прерванный перенос можно запустить снова.
+    :return: Отпечатки скопированных строк по таблицам: {имя таблицы: {id: отпечаток}}
+    """
+    copied = {}
+    for table in SHARDED_TABLES:
+        versions = copied[table.name] = {}
+        query = _chat_rows(table, chat_ids)
+        after_id = 0
+        while True:
+            async with source.connect() as conn:
+                rows = (await conn.execute(
+                    query.where(table.c.id > after_id).order_by(table.c.id).limit(batch_size)
+                )).mappings().all()
+            if not rows:
+                break
+            async with target.begin() as conn:
+                await conn.execute(_upsert(target, table), [dict(row) for row in rows])
+            versions.update((row["id"], _fingerprint(row)) for row in rows)
+            after_id = rows[-1]["id"]
+    return copied
+
+
+async def _catch_up(source, target, chat_ids: list[int], since, copied: dict[str, dict[int, int]],
+                    batch_size: int = 5000) -> int:
+    """
+    Докопирование строк, изменённых на исходном шарде после копирования.
+    Строки, которые уже изменили или удалили на целевом шарде процессы с новым размещением,
+    не перезаписываются: при правке с обеих сторон побеждает более поздняя.
+    :param since: Строки, изменённые раньше, не проверяются
+    :param copied: Результат _copy_rows
+    :return: Количество записанных строк
+    """
+    written = 0
+    for table in SHARDED_TABLES:
+        versions = copied[table.name]
+        query = _chat_rows(table, chat_ids).where(table.c.updated_at >= since)
+        after_id = 0
+        while True:
+            async with source.connect() as conn:
+                rows = (await conn.execute(
+                    query.where(table.c.id > after_id).order_by(table.c.id).limit(batch_size)
+                )).mappings().all()
+            if not rows:
+                break
+            after_id = rows[-1]["id"]
+            async with target.begin() as conn:
+                current = {row["id"]: row for row in (await conn.execute(
+                    select(table).where(table.c.id.in_([row["id"] for row in rows]))
+                )).mappings().all()}
+                changed = []
+                for row in rows:
+                    copied_version = versions.get(row["id"])
+                    target_row = current.get(row["id"])
+                    if copied_version is None:
+                        # Строка появилась на исходном шарде после копирования
+                        if target_row is None or row["updated_at"] > target_row["updated_at"]:
+                            changed.append(dict(row))
+                    elif target_row is None or _fingerprint(row) == copied_version:
+                        # Удалена на целевом шарде или не менялась на исходном
+                        continue
+                    elif (_fingerprint(target_row) == copied_version
+                          or row["updated_at"] > target_row["updated_at"]):
+                        changed.append(dict(row))
+                if changed:
+                    await conn.execute(_upsert(target, table), changed)
+                    written += len(changed)
+    return written
+
+
+async def _drop_deleted(source, target, chat_ids: list[int], copied: dict[str, dict[int, int]]) -> int:
+    """
+    Удаление с целевого шарда скопированных строк, удалённых на исходном во время переноса.
+    Строки, записанные сразу на целевой шард, не трогаются.
+    """
+    dropped = 0
+    for table in SHARDED_TABLES:
+        ids_query = _chat_rows(table, chat_ids).with_only_columns(table.c.id)
+        async with source.connect() as conn:
+            source_ids = set((await conn.execute(ids_query)).scalars().all())
+        stale = [row_id for row_id in copied[table.name] if row_id not in source_ids]
+        if stale:
+            async with target.begin() as conn:
+                await conn.execute(delete(table).where(table.c.id.in_(stale)))
+            dropped += len(stale)
+    return dropped
+
+
+async def _delete_chats(shard_engine, chat_ids: list[int]):
+    messages = Message.__table__
+    keys = MessageIdempotencyKey.__table__
+    async with shard_engine.begin() as conn:
+        await conn.execute(delete(keys).where(keys.c.message_id.in_(
+            select(messages.c.id).where(messages.c.chat_id.in_(chat_ids)))))
+        await conn.execute(delete(File.__table__).where(File.__table__.c.chat_id.in_(chat_ids)))
+        await conn.execute(delete(messages).where(messages.c.chat_id.in_(chat_ids)))
+
+
+async def move_chats(source: str, target: str, chat_ids: list[int], pause: float | None = None) -> int:
+    """
+    Перенос чатов с шарда на шард без остановки записи:
+    1. копирование строк на целевой шард;
+    2. переключение chats.shard;
+    3. ожидание, пока все процессы забудут старое размещение;
+    4. докопирование строк, изменённых на исходном шарде за это время, и удаление удалённых
+       (правки и новые строки на целевом шарде при этом сохраняются);
+    5. удаление строк с исходного шарда.
+    До шага 4 новые сообщения, записанные процессами со старым размещением,
+    могут быть не видны при чтении с целевого шарда.
+    :param pause: Ожидание на шаге 3, по умолчанию SHARD_PLACEMENT_TTL
+    :return: Количество скопированных строк
+    """
+    source_engine = shard_map.engines[source]
+    target_engine = shard_map.engines[target]
+    async with source_engine.connect() as conn:
+        started = (await conn.execute(select(func.now()))).scalar_one()
+    copied = await _copy_rows(source_engine, target_engine, chat_ids)
+    total = sum(len(versions) for versions in copied.values())
+
+    async with engine.begin() as conn:
+        await conn.execute(
+            update(Chat.__table__).where(Chat.__table__.c.id.in_(chat_ids))
+            .values(shard=None if target == DEFAULT_SHARD else target)
+        )
+    for chat_id in chat_ids:
+        shard_map.forget(chat_id)
+    await asyncio.sleep(shard_map.placement_ttl if pause is None else pause)
+
+    # Запас на транзакции, начатые до копирования: now() в них меньше started
+    since = started - timedelta(seconds=shard_map.placement_ttl)
+    total += await _catch_up(source_engine, target_engine, chat_ids, since, copied)
+    await _drop_deleted(source_engine, target_engine, chat_ids, copied)
+    await _delete_chats(source_engine, chat_ids)
+    return total
+
+
+async def _placements() -> list[tuple[int, str]]:
+    async with engine.connect() as conn:
+        result = await conn.execute(select(Chat.__table__.c.id, Chat.__table__.c.shard))
+        return [(chat_id, shard or DEFAULT_SHARD) for chat_id, shard in result.all()]
+
+
+async def rebalance(batch_size: int, dry_run: bool = False, pause: float | None = None) -> int:
+    """
+    Перенос чатов, размещение которых не совпадает с кольцом хеширования,
+    пачками по парам (исходный шард, целевой шард)
+    :return: Количество перенесённых (в dry-run - найденных) чатов
+    """
+    moves: dict[tuple[str, str], list[int]] = {}
+    for chat_id, shard in await _placements():
+        target = shard_map.ring.get(chat_id)
+        if target != shard:
+            moves.setdefault((shard, target), []).append(chat_id)
+
+    total = 0
+    for (source, target), chat_ids in moves.items():
+        if dry_run:
+            print(f"{source} -> {target}: {len(chat_ids)} чатов")
+            total += len(chat_ids)
+            continue
+        for start in range(0, len(chat_ids), batch_size):
+            batch = chat_ids[start:start + batch_size]
+            copied = await move_chats(source, target, batch, pause)
+            total += len(batch)
+            print(f"{source} -> {target}: перенесено {len(batch)} чатов, {copied} строк")
+    return total
+
+
+async def init_shards():
+    """
+    Создание таблиц на дополнительных шардах (без внешних ключей на глобальные таблицы)
+    и выравнивание источника ID в основной БД по максимальному ID всех шардов
+    """
+    from app.chat.partitions import ensure_partitions
+
+    max_ids = {table.name: 0 for table in SHARDED_TABLES}
+    for name, shard_engine in shard_map.engines.items():
+        async with shard_engine.begin() as conn:
+            if name != DEFAULT_SHARD:
+                for table in SHARDED_TABLES:
+                    await conn.execute(CreateTable(table, if_not_exists=True,
+                                                   include_foreign_key_constraints=[]))
+                    for index in table.indexes:
+                        await conn.execute(CreateIndex(index, if_not_exists=True))
+                if shard_engine.dialect.name == "postgresql":
+                    await ensure_partitions(conn, ahead=3)
+            for table in SHARDED_TABLES:
+                current = (await conn.execute(select(func.max(table.c.id)))).scalar() or 0
+                max_ids[table.name] = max(max_ids[table.name], current)
+
+    async with engine.begin() as conn:
+        for table in SHARDED_TABLES:
+            if engine.dialect.name == "postgresql":
+                # Последовательность только продвигается вперёд
+                await conn.execute(text(
+                    "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                    "greatest(:max_id, (SELECT last_value FROM pg_sequences "
+                    "WHERE schemaname || '.' || sequencename = pg_get_serial_sequence(:table, 'id'))), true)"
+                ), {"table": table.name, "max_id": max(max_ids[table.name], 1)})
+            else:
+                await conn.run_sync(shard_id_counters.create, checkfirst=True)
+                current = (await conn.execute(
+                    select(shard_id_counters.c.last_id).where(shard_id_counters.c.table_name == table.name)
+                )).scalar()
+                if current is None:
+                    await conn.execute(shard_id_counters.insert().values(
+                        table_name=table.name, last_id=max_ids[table.name]))
+                elif current < max_ids[table.name]:
+                    await conn.execute(
+                        update(shard_id_counters).where(shard_id_counters.c.table_name == table.name)
+                        .values(last_id=max_ids[table.name]))
+            print(f"{table.name}: ID выдаются начиная после {max_ids[table.name]}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("init", help="создать таблицы на шардах и настроить ID")
+    commands.add_parser("status", help="распределение чатов по шардам")
+    move_parser = commands.add_parser("move", help="перенести чат на шард")
+    move_parser.add_argument("chat_id", type=int)
+    move_parser.add_argument("shard")
+    rebalance_parser = commands.add_parser("rebalance", help="перенести чаты по кольцу хеширования")
+    rebalance_parser.add_argument("--batch-size", type=int, default=100)
+    rebalance_parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "init":
+        await init_shards()
+    elif args.command == "status":
+        counts: dict[str, list[int]] = {name: [0, 0] for name in shard_map.engines}
+        for chat_id, shard in await _placements():
+            counts[shard][0] += 1
+            counts[shard_map.ring.get(chat_id)][1] += 1
+        for name, (placed, expected) in counts.items():
+            print(f"{name}: чатов {placed}, по кольцу {expected}")
+    elif args.command == "move":
+        if args.shard not in shard_map.engines:
+            parser.error(f"неизвестный шард {args.shard}")
+        source = await shard_map.shard_for(args.chat_id)
+        if source == args.shard:
+            print(f"Чат {args.chat_id} уже на шарде {args.shard}")
+        else:
+            copied = await move_chats(source, args.shard, [args.chat_id])
+            print(f"Чат {args.chat_id}: {source} -> {args.shard}, {copied} строк")
+    else:
+        moved = await rebalance(args.batch_size, args.dry_run)
+        print(f"Чатов: {moved}")
+    await shard_map.dispose()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,86 @@
+import asyncio
+import time
+from typing import Dict, Set
+
+from app.chat.connections import manager
+from app.config import settings
+from app.jobs import job_runner, PRIORITY_NORMAL
+
+
+class TypingTracker:
+    """
+    Индикаторы набора текста, полностью в памяти процесса.
+    Повторные события typing только продлевают срок жизни записи; рассылка
+    идёт не чаще раза в interval на чат и только если состав печатающих изменился.
+    """
+
+    def __init__(self, ttl: float, interval: float):
+        self.ttl = ttl
+        self.interval = interval
+        # chat_id -> {user_id: момент истечения}
+        self._typing: Dict[int, Dict[int, float]] = {}
+        # Чаты, состав печатающих в которых изменился с последней рассылки
+        self._dirty: Set[int] = set()
+        self.stats = {"events": 0, "broadcasts": 0}
+
+    def update(self, chat_id: int, user_id: int, is_typing: bool = True):
+        """
+        Обработка события набора текста
+        :param chat_id: ID чата
+        :param user_id: ID пользователя
+        :param is_typing: False, если пользователь перестал печатать
+        """
+        self.stats["events"] += 1
+        users = self._typing.setdefault(chat_id, {})
+        if is_typing:
+            if user_id not in users:
+                self._dirty.add(chat_id)
+            users[user_id] = time.monotonic() + self.ttl
+        else:
+            self.stop(chat_id, user_id)
+
+    def stop(self, chat_id: int, user_id: int):
+        """
+        Сброс индикатора, например после отправки сообщения
+        """
+        users = self._typing.get(chat_id)
+        if users and users.pop(user_id, None) is not None:
+            self._dirty.add(chat_id)
+
+    def typing_users(self, chat_id: int) -> list[int]:
+        return sorted(self._typing.get(chat_id, ()))
+
+    def _expire(self):
+        now = time.monotonic()
+        for chat_id, users in list(self._typing.items()):
+            expired = [user_id for user_id, expires_at in users.items() if expires_at <= now]
+            for user_id in expired:
+                del users[user_id]
+            if expired:
+                self._dirty.add(chat_id)
+            if not users:
+                del self._typing[chat_id]
+
+    def flush(self):
+        """
+        Рассылка накопленных изменений: одно событие на изменившийся чат
+        """
+        self._expire()
+        dirty, self._dirty = self._dirty, set()
+        for chat_id in dirty:
+            self.stats["broadcasts"] += 1
+            # Ключ чата сохраняет порядок относительно новых сообщений
+            job_runner.submit(manager.broadcast, chat_id, {
+                "action": "typing",
+                "chat_id": chat_id,
+                "user_ids": self.typing_users(chat_id),
+            }, priority=PRIORITY_NORMAL, key=("chat", chat_id))
+
+    async def run_periodically(self):
+        # Запускается из lifespan приложения
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+
+typing_tracker = TypingTracker(ttl=settings.TYPING_TTL, interval=settings.TYPING_INTERVAL)
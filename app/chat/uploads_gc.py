@@ -0,0 +1,168 @@
+"""
+Сборщик мусора для вложений: удаляет записи files, не привязанные к сообщению,
+и файлы в uploads, на которые не ссылается ни одна запись.
+
+Работает периодически из lifespan приложения, либо вручную:
+    python -m app.chat.uploads_gc [--dry-run]
+
+До первого запуска без dry-run нужно привязать старые записи files к сообщениям,
+иначе все они будут считаться осиротевшими:
+    python -m app.chat.uploads_gc --backfill
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+
+from app.chat.chunked_uploads import chunked_uploads
+from app.chat.dao import FilesDAO
+from app.config import settings
+
+UPLOAD_DIR = "uploads"
+
+
+class UploadsCollector:
+    """
+    Пакетное удаление осиротевших записей и файлов с паузами между пачками
+    """
+
+    def __init__(self, upload_dir: str, grace: timedelta, batch_size: int,
+                 pause: float = 0.5, dry_run: bool = False):
+        self.upload_dir = upload_dir
+        self.grace = grace
+        self.batch_size = batch_size
+        self.pause = pause
+        self.dry_run = dry_run
+        self.stats = {
+            "dry_run": dry_run,
+            "runs": 0,
+            "rows_deleted": 0,
+            "blobs_deleted": 0,
+            "bytes_freed": 0,
+            "last_run_at": None,
+            "last_run_seconds": None,
+        }
+
+    async def collect_rows(self) -> int:
+        """
+        Удаление записей files без сообщения, созданных раньше grace-периода
+        :return: Количество удалённых (в dry-run - найденных) записей
+        """
+        cutoff = datetime.utcnow() - self.grace
+        after_id = 0
+        total = 0
+        while True:
+            orphans = await FilesDAO.find_orphans(cutoff, after_id, self.batch_size)
+            if not orphans:
+                break
+            after_id = orphans[-1][0]
+            if self.dry_run:
+                for file_id, file_path in orphans:
+                    print(f"[dry-run] запись files {file_id}: {file_path}")
+                total += len(orphans)
+            else:
+                total += await FilesDAO.delete_by_ids([file_id for file_id, _ in orphans])
+            await asyncio.sleep(self.pause)
+        return total
+
+    def _old_blobs(self) -> list[tuple[str, int]]:
+        cutoff = time.time() - self.grace.total_seconds()
+        with os.scandir(self.upload_dir) as entries:
+            return [
+                (os.path.join(self.upload_dir, entry.name), entry.stat().st_size)
+                for entry in entries
+                if entry.is_file() and entry.stat().st_mtime < cutoff
+            ]
+
+    async def collect_blobs(self) -> tuple[int, int]:
+        """
+        Удаление файлов в каталоге загрузок, на которые нет записей files
+        :return: Количество удалённых файлов и освобождённые байты
+        """
+        if not os.path.isdir(self.upload_dir):
+            return 0, 0
+        blobs = await asyncio.to_thread(self._old_blobs)
+        deleted = freed = 0
+        for start in range(0, len(blobs), self.batch_size):
+            batch = blobs[start:start + self.batch_size]
+            referenced = await FilesDAO.find_referenced_paths([path for path, _ in batch])
+            for path, size in batch:
+                if path in referenced:
+                    continue
+                if self.dry_run:
+                    print(f"[dry-run] файл {path}, {size} байт")
+                else:
+                    try:
+                        await asyncio.to_thread(os.remove, path)
+                    except FileNotFoundError:
+                        continue
+                deleted += 1
+                freed += size
+            await asyncio.sleep(self.pause)
+        return deleted, freed
+
+    async def run_once(self) -> dict:
+        """
+        Один проход сборщика: сначала записи, затем освободившиеся файлы
+        :return: Накопленная статистика
+        """
+        started = time.perf_counter()
+        rows = await self.collect_rows()
+        blobs, freed = await self.collect_blobs()
+        # Брошенные загрузки частями лежат в подкаталоге и не попадают в collect_blobs
+        if not self.dry_run:
+            await chunked_uploads.cleanup_expired()
+        self.stats["runs"] += 1
+        self.stats["rows_deleted"] += rows
+        self.stats["blobs_deleted"] += blobs
+        self.stats["bytes_freed"] += freed
+        self.stats["last_run_at"] = datetime.utcnow().isoformat()
+        self.stats["last_run_seconds"] = round(time.perf_counter() - started, 3)
+        print(f"GC вложений: записей {rows}, файлов {blobs}, освобождено {freed} байт"
+              + (" (dry-run)" if self.dry_run else ""))
+        return self.stats
+
+    async def run_periodically(self, interval: float):
+        """
+        Периодический запуск сборщика до отмены задачи
+        :param interval: Интервал между проходами в секундах
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Ошибка сборщика вложений: {e!r}")
+
+
+uploads_collector = UploadsCollector(
+    upload_dir=UPLOAD_DIR,
+    grace=timedelta(hours=settings.UPLOADS_GC_GRACE_HOURS),
+    batch_size=settings.UPLOADS_GC_BATCH_SIZE,
+    dry_run=settings.UPLOADS_GC_DRY_RUN,
+)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--grace-hours", type=int, default=settings.UPLOADS_GC_GRACE_HOURS)
+    parser.add_argument("--backfill", action="store_true",
+                        help="привязать старые записи files к сообщениям и выйти")
+    args = parser.parse_args()
+
+    from app.database import engine
+    if args.backfill:
+        linked = await FilesDAO.link_to_messages()
+        print(f"Привязано записей files: {linked}")
+        await engine.dispose()
+        return
+    collector = UploadsCollector(UPLOAD_DIR, timedelta(hours=args.grace_hours),
+                                 settings.UPLOADS_GC_BATCH_SIZE, pause=0, dry_run=args.dry_run)
+    await collector.run_once()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
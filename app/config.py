@@ -13,6 +13,80 @@ class Settings(BaseSettings):
     GITLAB_CLIENT_SECRET: str
     REDIRECT_URI: str
     DATABASE_URL: str
+    # Кэши запросов: скомпилированных SQLAlchemy и подготовленных asyncpg на соединение
+    DB_QUERY_CACHE_SIZE: int = 1000
+    DB_PREPARED_STATEMENT_CACHE_SIZE: int = 500
+    # Реплика для чтения: без адреса все запросы идут в основную БД
+    DATABASE_REPLICA_URL: str | None = None
+    REPLICA_MAX_LAG: float = 5.0
+    REPLICA_LAG_CHECK_INTERVAL: float = 1.0
+    # GitLab OAuth: адрес инстанса можно подменить на локальную заглушку
+    GITLAB_URL: str = "https://git.66bit.ru"
+    GITLAB_TIMEOUT: float = 10.0
+    GITLAB_RETRIES: int = 2
+    # Адреса почты администраторов через запятую: им доступны служебные /stats/*
+    ADMIN_EMAILS: str = ""
+    # Срок жизни кэша участников чатов в памяти процесса в секундах:
+    # изменения состава в других процессах видны не позже чем через это время
+    MEMBERSHIP_CACHE_TTL: float = 30.0
+    # Кэш последних сообщений чатов
+    HOT_TAIL_SIZE: int = 50
+    HOT_TAIL_MAX_BYTES: int = 64 * 1024 * 1024
+    # Срок жизни записи кэша в секундах: изменения без события в журнале чата
+    # (доставка, вложения) из других процессов видны не позже чем через это время
+    HOT_TAIL_TTL: float = 30.0
+    # Секционирование таблицы messages
+    MESSAGES_PARTITION_SIZE: int = 1_000_000
+    MESSAGES_ARCHIVE_DIR: str = "archive"
+    # Шарды сообщений и файлов: "имя=адрес,имя=адрес". Шард default - основная БД,
+    # без списка всё хранится в ней
+    MESSAGES_SHARDS: str = ""
+    # Сколько секунд процесс помнит шард чата; перенос чата ждёт столько же
+    SHARD_PLACEMENT_TTL: float = 30.0
+    SHARD_VIRTUAL_NODES: int = 128
+    # Сборка мусора в uploads: интервал в секундах (0 - выключено), возраст в часах.
+    # Пока старые записи files не привязаны к сообщениям (python -m app.chat.uploads_gc --backfill),
+    # сборщик только показывает, что удалил бы
+    UPLOADS_GC_INTERVAL: int = 3600
+    UPLOADS_GC_GRACE_HOURS: int = 24
+    UPLOADS_GC_BATCH_SIZE: int = 500
+    UPLOADS_GC_DRY_RUN: bool = True
+    # Загрузка частями: максимальный размер, рекомендуемый размер части, срок жизни сессии в секундах
+    UPLOAD_MAX_SIZE: int = 4 * 1024 ** 3
+    UPLOAD_CHUNK_SIZE: int = 8 * 1024 ** 2
+    UPLOAD_SESSION_TTL: int = 24 * 3600
+    # Ключи идемпотентности отправки: срок жизни в секундах и размер кэша в памяти
+    IDEMPOTENCY_TTL: int = 24 * 3600
+    IDEMPOTENCY_CACHE_SIZE: int = 100_000
+    IDEMPOTENCY_CLEANUP_INTERVAL: float = 3600.0
+    # Фоновые задачи
+    JOBS_WORKERS: int = 4
+    JOBS_THREAD_WORKERS: int = 4
+    JOBS_PROCESS_WORKERS: int = 2
+    JOBS_DRAIN_TIMEOUT: float = 10.0
+    # Готовность и плавная остановка
+    READY_DB_TIMEOUT: float = 2.0
+    DRAIN_MAX_JITTER: float = 10.0
+    DRAIN_GRACE: float = 2.0
+    # Индикаторы набора текста: срок жизни и интервал рассылки в секундах
+    TYPING_TTL: float = 5.0
+    TYPING_INTERVAL: float = 1.0
+    # Присутствие: интервал рассылки и таймаут соединения без кадров в секундах
+    # (таймаут действует только для соединений, приславших хотя бы один ping)
+    PRESENCE_INTERVAL: float = 2.0
+    HEARTBEAT_TIMEOUT: float = 60.0
+    # Сколько секунд рассылка ждёт отправки одному соединению, прежде чем отключить его
+    WS_SEND_TIMEOUT: float = 5.0
+    # Подтверждения доставки: интервал записи в секундах и размер пачки
+    DELIVERY_FLUSH_INTERVAL: float = 0.5
+    DELIVERY_BATCH_SIZE: int = 5000
+    # Уведомления для пользователей не в сети: через сколько секунд сворачивать в сводку
+    NOTIFICATIONS_DIGEST_AFTER: int = 600
+    NOTIFICATIONS_DIGEST_INTERVAL: float = 300.0
+    # Ограничение нагрузки на БД: 0 - по размеру пула
+    ADMISSION_LIMIT: int = 0
+    ADMISSION_TARGET_WAIT: float = 0.5
+    ADMISSION_MAX_QUEUE: int = 200
 
     model_config = SettingsConfigDict(
         env_file=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".env")
@@ -1,7 +1,8 @@
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.future import select
-from sqlalchemy import update as sqlalchemy_update, delete as sqlalchemy_delete
-from app.database import async_session_maker
+from sqlalchemy import values, column, update as sqlalchemy_update, delete as sqlalchemy_delete, insert as sqlalchemy_insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.database import async_session_maker, read_session_maker
 
 
 # Класс для доступа к данным, используемый в других модулях
@@ -16,7 +17,7 @@ class BaseDAO:
         :param data_id: Идентификатор экземпляра
         :return: Экземпляр модели или None
         """
-        async with async_session_maker() as session:
+        async with read_session_maker() as session:
             query = select(cls.model).filter_by(id=data_id)
             result = await session.execute(query)
             return result.scalar_one_or_none()
@@ -29,7 +30,7 @@ class BaseDAO:
         :param filter_by: Фильтры для выборки
         :return: Экземпляр модели или None
          """
-        async with async_session_maker() as session:
+        async with read_session_maker() as session:
             query = select(cls.model).filter_by(**filter_by)
             result = await session.execute(query)
             return result.scalar_one_or_none()
@@ -119,3 +120,117 @@ class BaseDAO:
                     await session.rollback()
                     raise e
                 return result.rowcount
+
+    @classmethod
+    async def iter_batches(cls, *where, batch_size: int = 1000, after_id: int = 0, columns: tuple = ()):
+        """
+        Постраничный обход таблицы по первичному ключу (keyset).
+        Каждая пачка читается отдельным коротким запросом, соединение
+        не удерживается, пока вызывающий код обрабатывает пачку.
+        :param where: Условия выборки
+        :param batch_size: Размер пачки
+        :param after_id: ID, после которого начать обход
+        :param columns: Выбираемые столбцы (должны включать id), по умолчанию объекты модели
+        :return: Асинхронный генератор списков объектов или строк
+        """
+        while True:
+            async with read_session_maker() as session:
+                query = (
+                    (select(*columns) if columns else select(cls.model))
+                    .where(cls.model.id > after_id, *where)
+                    .order_by(cls.model.id)
+                    .limit(batch_size)
+                )
+                result = await session.execute(query)
+                batch = result.all() if columns else result.scalars().all()
+            if not batch:
+                return
+            yield batch
+            if len(batch) < batch_size:
+                return
+            after_id = batch[-1].id
+
+    @classmethod
+    async def insert_many(cls, rows: list[dict], returning: tuple = ()):
+        """
+        Вставка строк одним execute на уровне Core, без создания ORM-объектов.
+        С returning на PostgreSQL строки уходят многострочными INSERT ... VALUES страницами
+        по 1000 строк (ceil(n / 1000) запросов), на SQLite - по запросу на строку, так как
+        порядок RETURNING там не гарантирован. Без returning - один executemany драйвера.
+        :param rows: Список словарей со значениями полей (одинаковый набор ключей)
+        :param returning: Столбцы, возвращаемые для каждой вставленной строки
+        :return: Список строк returning или количество вставленных строк
+        """
+        if not rows:
+            return [] if returning else 0
+        query = sqlalchemy_insert(cls.model)
+        if returning:
+            query = query.returning(*returning, sort_by_parameter_order=True)
+        async with async_session_maker() as session:
+            async with session.begin():
+                result = await session.execute(query, rows)
+                return result.all() if returning else len(rows)
+
+    @classmethod
+    async def upsert_many(cls, rows: list[dict], index_elements: list[str],
+                          update_fields: list[str] | None = None, returning: tuple = ()):
+        """
+        Вставка или обновление строк через INSERT ... ON CONFLICT.
+        С returning - страницами по 1000 строк, без него - один executemany драйвера
+        :param rows: Список словарей со значениями полей (одинаковый набор ключей)
+        :param index_elements: Столбцы уникального ограничения, по которому ищется конфликт
+        :param update_fields: Обновляемые при конфликте поля, по умолчанию все остальные
+        :param returning: Столбцы, возвращаемые для каждой строки
+        :return: Список строк returning или количество обработанных строк
+        """
+        if not rows:
+            return [] if returning else 0
+        query = pg_insert(cls.model)
+        if update_fields is None:
+            update_fields = [key for key in rows[0] if key not in index_elements]
+        if update_fields:
+            query = query.on_conflict_do_update(
+                index_elements=index_elements,
+                set_={field: query.excluded[field] for field in update_fields},
+            )
+        else:
+            query = query.on_conflict_do_nothing(index_elements=index_elements)
+        if returning:
+            query = query.returning(*returning)
+        async with async_session_maker() as session:
+            async with session.begin():
+                result = await session.execute(query, rows)
+                return result.all() if returning else len(rows)
+
+    @classmethod
+    async def update_many(cls, rows: list[dict], batch_size: int = 1000) -> int:
+        """
+        Массовое обновление по первичному ключу: строки передаются пачками по batch_size,
+        каждая пачка - один UPDATE ... FROM (VALUES ...) AS rows (id, ...) WHERE id = rows.id.
+        Число запросов к БД - ceil(n / batch_size), все пачки в одной транзакции.
+        Пачка дополнительно ограничена числом параметров (на строку - по одному на поле),
+        чтобы не превысить предел PostgreSQL в 32767 параметров
+        :param rows: Список словарей с id и обновляемыми полями (одинаковый набор ключей)
+        :param batch_size: Количество строк в одном запросе
+        :return: Количество обновлённых строк
+        """
+        if not rows:
+            return 0
+        table = cls.model.__table__
+        keys = list(rows[0])
+        batch_size = max(1, min(batch_size, 32767 // len(keys)))
+        updated = 0
+        async with async_session_maker() as session:
+            async with session.begin():
+                for start in range(0, len(rows), batch_size):
+                    batch = values(*(column(key, table.c[key].type) for key in keys), name="rows").data(
+                        [tuple(row[key] for key in keys) for row in rows[start:start + batch_size]]
+                    )
+                    result = await session.execute(
+                        sqlalchemy_update(cls.model)
+                        .where(table.c.id == batch.c.id)
+                        .values({key: batch.c[key] for key in keys if key != "id"})
+                        .execution_options(synchronize_session=False)
+                    )
+                    updated += result.rowcount
+        return updated
@@ -1,24 +1,217 @@
-from sqlalchemy import func, Integer
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import func, Integer, text, event
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Values
 from datetime import datetime
-from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase
+from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, Session
 from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from dotenv import load_dotenv
+from app.config import settings
 import os
 
 load_dotenv()
 
 database_url = os.getenv('DATABASE_URL')
-engine = create_async_engine(
-    url=database_url,
-    echo=True,
-    pool_size = 10,  # Размер пула
-    max_overflow = 10,  # Дополнительное количество соединений
-    pool_timeout = 5  # Время ожидания для нового соединения
-)
-async_session_maker = async_sessionmaker(engine, class_=AsyncSession,
+
+
+def _connect_args(url: str | None) -> dict:
+    # Кэш подготовленных выражений драйвера на каждое соединение: повторный запрос
+    # с тем же SQL не готовится на сервере заново
+    if url and url.startswith("postgresql+asyncpg"):
+        return {"prepared_statement_cache_size": settings.DB_PREPARED_STATEMENT_CACHE_SIZE}
+    return {}
+
+
+# Попадания в кэш компиляции SQLAlchemy по всем движкам
+statement_cache_stats = {"hit": 0, "miss": 0, "uncached": 0}
+
+
+def _count_cache_hit(conn, cursor, statement, parameters, context, executemany):
+    if context is None:
+        return
+    if context.cache_hit == context.dialect.CACHE_HIT:
+        statement_cache_stats["hit"] += 1
+    elif context.cache_hit == context.dialect.CACHE_MISS:
+        statement_cache_stats["miss"] += 1
+    else:
+        # Текстовые запросы и конструкции без ключа кэша
+        statement_cache_stats["uncached"] += 1
+
+
+def statement_cache_hit_rate() -> float | None:
+    cached = statement_cache_stats["hit"] + statement_cache_stats["miss"]
+    return statement_cache_stats["hit"] / cached if cached else None
+
+
+@compiles(Values, "sqlite")
+def _sqlite_values(element, compiler, asfrom=False, **kw):
+    # SQLite (локальные шарды и тесты) не принимает список столбцов у подзапроса
+    # "(VALUES ...) AS name (a, b)": столбцы VALUES там называются column1, column2, ...
+    if not asfrom or element._unnamed:
+        return compiler.visit_values(element, asfrom=asfrom, **kw)
+    kw.pop("from_linter", None)
+    rows = compiler.visit_values(element, **kw)
+    names = ", ".join(
+        f"column{n} AS {compiler.preparer.quote(col.name)}"
+        for n, col in enumerate(element.columns, start=1)
+    )
+    return f"(SELECT {names} FROM ({rows})) AS {compiler.preparer.quote(element.name)}"
+
+
+def _pool_args(url: str | None) -> dict:
+    # SQLite (локальные шарды и тесты) работает без пула соединений
+    if url and url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": 10,  # Размер пула
+        "max_overflow": 10,  # Дополнительное количество соединений
+        "pool_timeout": 5,  # Время ожидания для нового соединения
+    }
+
+
+def make_engine(url: str):
+    """
+    Создание движка БД с общими настройками пула и кэшей
+    :param url: Адрес БД
+    """
+    new_engine = create_async_engine(
+        url=url,
+        echo=True,
+        query_cache_size = settings.DB_QUERY_CACHE_SIZE,  # Кэш скомпилированных запросов SQLAlchemy
+        connect_args = _connect_args(url),
+        **_pool_args(url)
+    )
+    event.listen(new_engine.sync_engine, "after_cursor_execute", _count_cache_hit)
+    return new_engine
+
+
+engine = make_engine(database_url)
+
+# Момент последней записи в текущем запросе (контексте задачи)
+_last_write: ContextVar[float | None] = ContextVar("last_write", default=None)
+# Явное требование читать с основной БД
+_force_primary: ContextVar[bool] = ContextVar("force_primary", default=False)
+
+
+class PrimarySyncSession(Session):
+    pass
+
+
+@event.listens_for(PrimarySyncSession, "after_flush")
+def _mark_flush(session, flush_context):
+    session.info["wrote"] = True
+
+
+@event.listens_for(PrimarySyncSession, "do_orm_execute")
+def _mark_dml(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["wrote"] = True
+
+
+@event.listens_for(PrimarySyncSession, "after_commit")
+def _remember_write(session):
+    # Событие срабатывает и при commit(), и при выходе из session.begin();
+    # фиксация транзакции, в которой только читали, записью не считается
+    if session.info.pop("wrote", False):
+        _last_write.set(time.monotonic())
+
+
+@event.listens_for(PrimarySyncSession, "after_rollback")
+def _forget_write(session):
+    session.info.pop("wrote", None)
+
+
+class PrimarySession(AsyncSession):
+    # Сессия основной БД запоминает запись, чтобы следующие чтения
+    # этого же запроса не ушли на отстающую реплику
+    sync_session_class = PrimarySyncSession
+
+
+async_session_maker = async_sessionmaker(engine, class_=PrimarySession,
                                          expire_on_commit=False)
 
+replica_engine = make_engine(settings.DATABASE_REPLICA_URL) if settings.DATABASE_REPLICA_URL else None
+
+# Запрос отставания реплики в секундах; на основной БД или догнавшей реплике - 0
+REPLICA_LAG_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() "
+    "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class RoutingSessionMaker:
+    """
+    Фабрика сессий для чтения: отдаёт сессию реплики, если она настроена,
+    не отстаёт больше допустимого и текущий запрос недавно ничего не записывал.
+    Иначе отдаёт сессию основной БД.
+    """
+
+    def __init__(self, primary: async_sessionmaker, replica_engine, max_lag: float):
+        self.primary = primary
+        self.replica = async_sessionmaker(replica_engine, class_=AsyncSession,
+                                          expire_on_commit=False) if replica_engine else None
+        self.replica_engine = replica_engine
+        self.max_lag = max_lag
+        # None - отставание неизвестно (ещё не проверяли или реплика недоступна)
+        self.lag: float | None = None
+        self.stats = {"replica": 0, "primary": 0}
+
+    def use_replica(self) -> bool:
+        if self.replica is None or _force_primary.get():
+            return False
+        if self.lag is None or self.lag > self.max_lag:
+            return False
+        written = _last_write.get()
+        # После записи реплика гарантированно догонит её не позже чем через max_lag
+        return written is None or time.monotonic() - written > self.max_lag
+
+    def __call__(self) -> AsyncSession:
+        if self.use_replica():
+            self.stats["replica"] += 1
+            return self.replica()
+        self.stats["primary"] += 1
+        return self.primary()
+
+    async def check_lag(self) -> float | None:
+        """
+        Обновление отставания реплики
+        :return: Отставание в секундах или None, если реплика недоступна
+        """
+        try:
+            async with self.replica_engine.connect() as conn:
+                self.lag = float((await conn.execute(REPLICA_LAG_QUERY)).scalar() or 0)
+        except Exception as e:
+            if self.lag is not None:
+                print(f"Реплика недоступна, чтение переключено на основную БД: {e!r}")
+            self.lag = None
+        return self.lag
+
+    async def monitor(self, interval: float):
+        # Периодическая проверка отставания, запускается из lifespan приложения
+        while True:
+            await self.check_lag()
+            await asyncio.sleep(interval)
+
+
+read_session_maker = RoutingSessionMaker(async_session_maker, replica_engine, settings.REPLICA_MAX_LAG)
+
+
+@contextmanager
+def use_primary():
+    """
+    Чтение с основной БД внутри блока, например сразу после записи в другом процессе
+    """
+    token = _force_primary.set(True)
+    try:
+        yield
+    finally:
+        _force_primary.reset(token)
+
 
 class Base(AsyncAttrs, DeclarativeBase):
     # Определяем столбец id, который будет хранить в себе id пользователя
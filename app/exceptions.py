@@ -18,6 +18,15 @@ class TokenNoFoundException(HTTPException):
         )
 
 
+class ServiceOverloadedException(HTTPException):
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Сервис перегружен, повторите запрос позже",
+            headers={"Retry-After": str(retry_after)}
+        )
+
+
 UserAlreadyExistsException = HTTPException(
     status_code=status.HTTP_409_CONFLICT,
     detail='Пользователь уже существует'
@@ -0,0 +1,115 @@
+import asyncio
+import signal
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+
+from app.chat.connections import manager
+from app.chat.dao import MessagesDAO, ChatDAO, ChatEventsDAO
+from app.chat.membership import membership
+from app.chat.uploads_gc import uploads_collector
+from app.config import settings
+from app.database import async_session_maker, engine, statement_cache_stats, statement_cache_hit_rate
+from app.users.dao import UsersDAO
+from app.users.dependencies import admin_dependency
+
+router = APIRouter(tags=["health"])
+
+
+async def _ping():
+    async with async_session_maker() as session:
+        await session.execute(text("SELECT 1"))
+
+
+async def warmup():
+    """
+    Прогрев процесса перед приёмом трафика: открытие соединений пула
+    и компиляция горячих запросов, чтобы первые клиенты не платили за это
+    """
+    pool_size = getattr(engine.sync_engine.pool, "size", lambda: 1)()
+    try:
+        # Параллельные запросы заставляют пул открыть сразу все постоянные соединения
+        await asyncio.gather(*(_ping() for _ in range(pool_size)))
+        # Запросы с заведомо несуществующими ID заполняют кэш компиляции SQLAlchemy
+        await MessagesDAO.get_history_rows(chat_id=0, limit=settings.HOT_TAIL_SIZE)
+        await MessagesDAO.get_history_rows(chat_id=0)
+        await ChatEventsDAO.get_changes(chat_id=0, since=0)
+        await ChatDAO.get_last_message_for_chat(0)
+        await UsersDAO.find_one_or_none("")
+        await membership.members(0)
+        await membership.user_chats(0)
+        # Пустой результат по пользователю 0 не должен остаться в индексе
+        membership.invalidate_user(0)
+    except Exception as e:
+        print(f"Прогрев не выполнен: {e!r}")
+
+
+async def drain():
+    """
+    Переход в режим остановки: /ready начинает отвечать 503,
+    клиенты вебсокетов получают подсказку переподключиться с разбросом по времени
+    """
+    if manager.draining:
+        return
+    await manager.drain(settings.DRAIN_MAX_JITTER, settings.DRAIN_GRACE)
+
+
+def install_drain_on_sigterm():
+    """
+    Перехват SIGTERM: сначала плавно отключаем клиентов, затем передаём сигнал
+    прежнему обработчику (uvicorn), который закрывает сервер
+    """
+    loop = asyncio.get_running_loop()
+    previous = signal.getsignal(signal.SIGTERM)
+
+    async def drain_and_exit():
+        await drain()
+        loop.remove_signal_handler(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, previous)
+        if callable(previous):
+            previous(signal.SIGTERM, None)
+
+    try:
+        loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(drain_and_exit()))
+    except (NotImplementedError, RuntimeError):
+        # Платформа или поток без поддержки обработчиков сигналов в цикле событий
+        pass
+
+
+@router.get("/ready", summary="Готовность процесса принимать трафик")
+async def ready():
+    """
+    Проверка готовности для балансировщика
+    :return: 200, если БД доступна и процесс не останавливается, иначе 503
+    """
+    if manager.draining:
+        return JSONResponse(status_code=503, content={"status": "draining", "db": None})
+    try:
+        await asyncio.wait_for(_ping(), timeout=settings.READY_DB_TIMEOUT)
+    except Exception:
+        return JSONResponse(status_code=503, content={"status": "unavailable", "db": False})
+    return {"status": "ready", "db": True}
+
+
+@router.get("/stats/db", summary="Статистика кэша запросов и пула соединений",
+            dependencies=[Depends(admin_dependency)])
+async def db_stats():
+    """
+    Счётчики попаданий в кэш компиляции SQLAlchemy и состояние пула
+    :return: Счётчики, доля попаданий и описание пула
+    """
+    return {
+        "statement_cache": {**statement_cache_stats, "hit_rate": statement_cache_hit_rate()},
+        "pool": engine.sync_engine.pool.status(),
+    }
+
+
+@router.get("/stats/uploads-gc", summary="Статистика сборщика мусора вложений",
+            dependencies=[Depends(admin_dependency)])
+async def uploads_gc_stats():
+    """
+    Накопленные счётчики сборщика мусора в uploads
+    :return: Режим dry-run, количество проходов, удалённые записи и файлы
+    """
+    return uploads_collector.stats
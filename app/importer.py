@@ -0,0 +1,253 @@
+"""
+Импорт истории из предыдущего мессенджера.
+
+На вход подаётся NDJSON, по одной записи на строку. Записи, на которые ссылаются
+другие, должны идти раньше (пользователи и чаты до участников и сообщений):
+
+    {"type": "user", "id": "u1", "name": "Иван", "email": "ivan@example.com"}
+    {"type": "chat", "id": "c1", "name": "Общий"}
+    {"type": "member", "chat_id": "c1", "user_id": "u1"}
+    {"type": "message", "id": "m1", "chat_id": "c1", "sender_id": "u1",
+     "recipient_id": "u2", "content": "...", "created_at": "2021-03-01T10:00:00Z"}
+
+Запуск:
+    python -m app.importer history.ndjson [--source old-messenger] [--batch-size 20000] [--defer-indexes]
+
+Перед импортом в секционированную таблицу messages нужно создать секции
+под весь объём (python -m app.chat.partitions ensure --ahead N).
+
+Данные пачки, соответствие внешних ID локальным и контрольная точка записываются
+одной транзакцией, поэтому прерванный импорт можно просто запустить повторно.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+from app.chat.schemas import MessageStatus
+from app.database import engine
+
+# Неуникальные индексы, которые безопасно пересоздать после загрузки
+DEFERRABLE_INDEXES = {
+    "ix_messages_chat_id_id": "CREATE INDEX IF NOT EXISTS ix_messages_chat_id_id ON messages (chat_id, id)",
+}
+
+
+def _parse_datetime(value: str | None) -> datetime | None:
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+class HistoryImporter:
+    """
+    Загрузка пачек записей через COPY с сопоставлением внешних ID локальным
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        # (тип, внешний ID) -> локальный ID для пользователей и чатов
+        self.id_map: dict[tuple[str, str], int] = {}
+        self.rows = 0
+
+    async def prepare(self, conn) -> int:
+        """
+        Создание служебных таблиц и загрузка состояния прошлого запуска
+        :return: Номер последней загруженной строки входного файла
+        """
+        await conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS import_id_map ("
+            "source text, kind text, external_id text, local_id integer, "
+            "PRIMARY KEY (source, kind, external_id))"
+        ))
+        await conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS import_checkpoints (source text PRIMARY KEY, line bigint)"
+        ))
+        result = await conn.execute(
+            text("SELECT kind, external_id, local_id FROM import_id_map WHERE source = :source"),
+            {"source": self.source}
+        )
+        self.id_map = {(kind, external_id): local_id for kind, external_id, local_id in result.all()}
+        checkpoint = await conn.execute(
+            text("SELECT line FROM import_checkpoints WHERE source = :source"),
+            {"source": self.source}
+        )
+        return checkpoint.scalar() or 0
+
+    @staticmethod
+    async def _allocate_ids(driver_conn, sequence: str, count: int) -> list[int]:
+        rows = await driver_conn.fetch(
+            f"SELECT nextval('{sequence}') FROM generate_series(1, $1)", count
+        )
+        return [row[0] for row in rows]
+
+    def _resolve(self, kind: str, external_id) -> int:
+        return self.id_map[(kind, str(external_id))]
+
+    async def load_batch(self, driver_conn, records: list[dict], last_line: int):
+        """
+        Загрузка пачки записей; вызывается внутри транзакции
+        :param driver_conn: Соединение asyncpg
+        :param records: Записи входного файла
+        :param last_line: Номер последней строки пачки для контрольной точки
+        """
+        by_type: dict[str, list[dict]] = {}
+        for record in records:
+            by_type.setdefault(record["type"], []).append(record)
+        new_mappings = []
+
+        users = [u for u in by_type.get("user", []) if ("user", str(u["id"])) not in self.id_map]
+        if users:
+            # Пользователи, уже вошедшие через GitLab, сопоставляются по email
+            existing = dict(await driver_conn.fetch(
+                "SELECT email, id FROM users WHERE email = ANY($1::text[])",
+                [u["email"] for u in users]
+            ))
+            to_insert = list({u["email"]: u for u in users if u["email"] not in existing}.values())
+            ids = await self._allocate_ids(driver_conn, "users_id_seq", len(to_insert))
+            await driver_conn.copy_records_to_table(
+                "users", columns=["id", "name", "email"],
+                records=[(local_id, u["name"], u["email"]) for local_id, u in zip(ids, to_insert)]
+            )
+            existing.update({u["email"]: local_id for local_id, u in zip(ids, to_insert)})
+            for u in users:
+                self.id_map[("user", str(u["id"]))] = existing[u["email"]]
+                new_mappings.append((self.source, "user", str(u["id"]), existing[u["email"]]))
+            self.rows += len(to_insert)
+
+        chats = [c for c in by_type.get("chat", []) if ("chat", str(c["id"])) not in self.id_map]
+        if chats:
+            ids = await self._allocate_ids(driver_conn, "chats_id_seq", len(chats))
+            await driver_conn.copy_records_to_table(
+                "chats", columns=["id", "name"],
+                records=[(local_id, c["name"]) for local_id, c in zip(ids, chats)]
+            )
+            for local_id, c in zip(ids, chats):
+                self.id_map[("chat", str(c["id"]))] = local_id
+                new_mappings.append((self.source, "chat", str(c["id"]), local_id))
+            self.rows += len(chats)
+
+        members = {
+            (self._resolve("user", m["user_id"]), self._resolve("chat", m["chat_id"]))
+            for m in by_type.get("member", [])
+        }
+        if members:
+            # Участник может повториться в разных пачках или уже состоять в чате:
+            # COPY во временную таблицу, затем вставка без конфликтов по первичному ключу
+            await driver_conn.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS import_members (user_id integer, chat_id integer) "
+                "ON COMMIT DELETE ROWS"
+            )
+            await driver_conn.copy_records_to_table(
+                "import_members", columns=["user_id", "chat_id"], records=list(members)
+            )
+            status = await driver_conn.execute(
+                "INSERT INTO chat_user_association (user_id, chat_id) "
+                "SELECT user_id, chat_id FROM import_members ON CONFLICT DO NOTHING"
+            )
+            self.rows += int(status.split()[-1])
+
+        messages = by_type.get("message", [])
+        if messages:
+            ids = await self._allocate_ids(driver_conn, "messages_id_seq", len(messages))
+            await driver_conn.copy_records_to_table(
+                "messages",
+                columns=["id", "chat_id", "sender_id", "recipient_id", "content", "status",
+                         "read_by", "is_file", "edited_at", "created_at", "updated_at"],
+                records=[
+                    (
+                        local_id,
+                        self._resolve("chat", m["chat_id"]),
+                        self._resolve("user", m["sender_id"]),
+                        self._resolve("user", m["recipient_id"]) if m.get("recipient_id") is not None else None,
+                        m.get("content", ""),
+                        m.get("status", MessageStatus.SENT.value),
+                        "",
+                        False,
+                        _parse_datetime(m.get("edited_at")),
+                        created_at,
+                        created_at,
+                    )
+                    for local_id, m in zip(ids, messages)
+                    for created_at in [_parse_datetime(m.get("created_at")) or datetime.utcnow()]
+                ]
+            )
+            self.rows += len(messages)
+
+        if new_mappings:
+            await driver_conn.copy_records_to_table(
+                "import_id_map", columns=["source", "kind", "external_id", "local_id"],
+                records=new_mappings
+            )
+        await driver_conn.execute(
+            "INSERT INTO import_checkpoints (source, line) VALUES ($1, $2) "
+            "ON CONFLICT (source) DO UPDATE SET line = EXCLUDED.line",
+            self.source, last_line
+        )
+
+
+def read_batches(path: str, skip_lines: int, batch_size: int):
+    """
+    Чтение входного файла пачками, начиная после контрольной точки
+    :return: Генератор пар (записи, номер последней строки)
+    """
+    batch = []
+    line_number = 0
+    with open(path, encoding="utf-8") as source:
+        for line_number, line in enumerate(source, start=1):
+            if line_number <= skip_lines or not line.strip():
+                continue
+            batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                yield batch, line_number
+                batch = []
+    if batch:
+        yield batch, line_number
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--source", help="имя источника для контрольных точек, по умолчанию имя файла")
+    parser.add_argument("--batch-size", type=int, default=20000)
+    parser.add_argument("--defer-indexes", action="store_true",
+                        help="удалить неуникальные индексы на время загрузки")
+    args = parser.parse_args()
+
+    importer = HistoryImporter(args.source or os.path.basename(args.path))
+    async with engine.begin() as conn:
+        skip_lines = await importer.prepare(conn)
+        if args.defer_indexes:
+            for name in DEFERRABLE_INDEXES:
+                await conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    if skip_lines:
+        print(f"Продолжение с контрольной точки: строка {skip_lines}")
+
+    started = time.perf_counter()
+    try:
+        for records, last_line in read_batches(args.path, skip_lines, args.batch_size):
+            async with engine.begin() as conn:
+                raw = await conn.get_raw_connection()
+                await importer.load_batch(raw.driver_connection, records, last_line)
+            elapsed = time.perf_counter() - started
+            print(f"строка {last_line}: загружено {importer.rows} строк, "
+                  f"{importer.rows / elapsed:,.0f} строк/с")
+    finally:
+        if args.defer_indexes:
+            index_started = time.perf_counter()
+            async with engine.begin() as conn:
+                for statement in DEFERRABLE_INDEXES.values():
+                    await conn.execute(text(statement))
+            print(f"Индексы пересозданы за {time.perf_counter() - index_started:.1f} с")
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
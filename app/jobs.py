@@ -0,0 +1,185 @@
+import asyncio
+import functools
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from app.config import settings
+
+# Приоритеты задач: меньше - важнее
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 10
+
+
+@dataclass
+class Job:
+    func: Callable
+    args: tuple
+    kwargs: dict
+    priority: int = PRIORITY_NORMAL
+    executor: str | None = None
+    retries: int = 0
+    backoff: float = 0.5
+    key: Any = None
+    attempt: int = field(default=0)
+
+
+class JobRunner:
+    """
+    Очередь фоновых задач внутри процесса: приоритеты, пулы потоков и процессов,
+    повторы с экспоненциальной задержкой и дожидание задач при остановке.
+    Задачи с одинаковым key выполняются строго по очереди постановки.
+    """
+
+    def __init__(self, workers: int, thread_workers: int, process_workers: int):
+        self.workers = workers
+        self.thread_workers = thread_workers
+        self.process_workers = process_workers
+        self._queue: asyncio.PriorityQueue | None = None
+        self._counter = itertools.count()
+        self._tasks: list[asyncio.Task] = []
+        self._thread_pool: ThreadPoolExecutor | None = None
+        self._process_pool: ProcessPoolExecutor | None = None
+        # key -> задачи, ожидающие завершения предыдущей задачи с тем же key
+        self._serial: dict[Any, deque] = {}
+        # Задачи, ожидающие повтора, и задачи, запущенные до старта воркеров
+        self._detached: set[asyncio.Task] = set()
+        self.stats = {"done": 0, "failed": 0, "retried": 0}
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self):
+        """
+        Запуск воркеров, вызывается из lifespan приложения
+        """
+        if self.running:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._thread_pool = ThreadPoolExecutor(self.thread_workers, thread_name_prefix="jobs")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float):
+        """
+        Остановка с дожиданием поставленных задач
+        :param timeout: Сколько секунд ждать опустошения очереди
+        """
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Фоновые задачи не завершены за {timeout} с: {self._queue.qsize()} в очереди")
+        for task in [*self._tasks, *self._detached]:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._detached, return_exceptions=True)
+        self._tasks = []
+        self._serial.clear()
+        self._thread_pool.shutdown(wait=True)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=True)
+            self._process_pool = None
+
+    async def _drain(self):
+        # Задачи, ожидающие повтора, вернутся в очередь, поэтому ждём и их
+        while True:
+            await self._queue.join()
+            if not self._detached:
+                return
+            await asyncio.gather(*self._detached, return_exceptions=True)
+
+    def submit(self, func: Callable, *args, priority: int = PRIORITY_NORMAL, executor: str | None = None,
+               retries: int = 0, backoff: float = 0.5, key: Any = None, **kwargs):
+        """
+        Постановка задачи в очередь
+        :param func: Корутинная функция или обычная функция для executor
+        :param priority: Приоритет задачи
+        :param executor: None для корутин, "thread" или "process" для блокирующих функций
+        :param retries: Количество повторов при ошибке
+        :param backoff: Начальная задержка перед повтором в секундах
+        :param key: Ключ упорядочивания, задачи с одним ключом не выполняются параллельно
+        """
+        job = Job(func, args, kwargs, priority, executor, retries, backoff, key)
+        if not self.running:
+            # Вне приложения (скрипты, консоль) выполняем задачу сразу
+            task = asyncio.get_running_loop().create_task(self._run_detached(job))
+            self._detached.add(task)
+            task.add_done_callback(self._detached.discard)
+            return
+        if key is not None:
+            if key in self._serial:
+                self._serial[key].append(job)
+                return
+            self._serial[key] = deque()
+        self._put(job)
+
+    def _put(self, job: Job):
+        self._queue.put_nowait((job.priority, next(self._counter), job))
+
+    async def _run(self, job: Job):
+        if job.executor is None:
+            return await job.func(*job.args, **job.kwargs)
+        call = functools.partial(job.func, *job.args, **job.kwargs)
+        if job.executor == "process":
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(self.process_workers)
+            pool = self._process_pool
+        else:
+            pool = self._thread_pool
+        return await asyncio.get_running_loop().run_in_executor(pool, call)
+
+    async def _run_detached(self, job: Job):
+        try:
+            await self._run(job)
+        except Exception as e:
+            print(f"Фоновая задача {getattr(job.func, '__name__', job.func)} "
+                  f"завершилась ошибкой: {e!r}")
+
+    async def _retry_later(self, job: Job, delay: float):
+        await asyncio.sleep(delay)
+        self._put(job)
+
+    def _release(self, job: Job):
+        # Запускаем следующую задачу с тем же ключом
+        if job.key is None:
+            return
+        pending = self._serial.get(job.key)
+        if pending:
+            self._put(pending.popleft())
+        else:
+            self._serial.pop(job.key, None)
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                await self._run(job)
+            except Exception as e:
+                if job.attempt < job.retries:
+                    delay = job.backoff * 2 ** job.attempt
+                    job.attempt += 1
+                    self.stats["retried"] += 1
+                    task = asyncio.create_task(self._retry_later(job, delay))
+                    self._detached.add(task)
+                    task.add_done_callback(self._detached.discard)
+                else:
+                    self.stats["failed"] += 1
+                    print(f"Фоновая задача {getattr(job.func, '__name__', job.func)} "
+                          f"завершилась ошибкой: {e!r}")
+                    self._release(job)
+            else:
+                self.stats["done"] += 1
+                self._release(job)
+            finally:
+                self._queue.task_done()
+
+
+job_runner = JobRunner(
+    workers=settings.JOBS_WORKERS,
+    thread_workers=settings.JOBS_THREAD_WORKERS,
+    process_workers=settings.JOBS_PROCESS_WORKERS,
+)
@@ -1,3 +1,5 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.responses import RedirectResponse
 from fastapi.exceptions import HTTPException
@@ -6,8 +8,58 @@ from fastapi.staticfiles import StaticFiles
 from app.exceptions import TokenExpiredException, TokenNoFoundException
 from app.users.router import router as users_router
 from app.chat.router import router as chat_router
+from app.chat.uploads_gc import uploads_collector
+from app.chat.typing_indicators import typing_tracker
+from app.chat.presence import presence
+from app.chat.delivery import delivery_tracker
+from app.chat.notifications import notifications
+from app.chat.idempotency import recent_sends
+from app.chat.shards import shard_map
+from app.config import settings
+from app.database import read_session_maker
+from app.health import router as health_router, warmup, drain, install_drain_on_sigterm
+from app.jobs import job_runner
+from app.users.auth import close_gitlab_client
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Запуск и остановка фоновых ресурсов приложения
+    await warmup()
+    await job_runner.start()
+    install_drain_on_sigterm()
+    background_tasks = [
+        asyncio.create_task(typing_tracker.run_periodically()),
+        asyncio.create_task(presence.run_periodically()),
+        asyncio.create_task(delivery_tracker.run_periodically()),
+        asyncio.create_task(notifications.run_periodically()),
+        asyncio.create_task(recent_sends.run_cleanup_periodically(settings.IDEMPOTENCY_CLEANUP_INTERVAL)),
+    ]
+    if read_session_maker.replica is not None:
+        # Пока отставание не проверено, чтение идёт с основной БД
+        await read_session_maker.check_lag()
+        background_tasks.append(asyncio.create_task(
+            read_session_maker.monitor(settings.REPLICA_LAG_CHECK_INTERVAL)))
+    if settings.UPLOADS_GC_INTERVAL:
+        background_tasks.append(asyncio.create_task(
+            uploads_collector.run_periodically(settings.UPLOADS_GC_INTERVAL)))
+    yield
+    await drain()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    # Записываем подтверждения доставки, полученные до отключения клиентов
+    try:
+        await delivery_tracker.flush()
+    except Exception as e:
+        print(f"Подтверждения доставки не записаны: {e!r}")
+    # Дожидаемся отложенных рассылок и записи файлов
+    await job_runner.stop(settings.JOBS_DRAIN_TIMEOUT)
+    await close_gitlab_client()
+    await shard_map.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     'http://localhost:8000',
@@ -26,6 +78,7 @@ app.add_middleware(
 # Маршруты
 app.include_router(users_router)
 app.include_router(chat_router)
+app.include_router(health_router)
 
 
 @app.get("/")
@@ -1,23 +1,85 @@
+import asyncio
 from passlib.context import CryptContext
 from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
 from fastapi.security import OAuth2AuthorizationCodeBearer
+import httpx
 import jwt
 from app.config import get_auth_data, settings
-import requests
 
 # Создание объекта pwd_context для хеширования паролей
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # Создание объекта для реализации авторизации через OAuth 2.0
 oauth2_scheme = OAuth2AuthorizationCodeBearer(
-    authorizationUrl="https://git.66bit.ru/oauth/authorize",
-    tokenUrl="https://git.66bit.ru/oauth/token"
+    authorizationUrl=f"{settings.GITLAB_URL}/oauth/authorize",
+    tokenUrl=f"{settings.GITLAB_URL}/oauth/token"
 )
 
 # Идентификатор и секретный ключ для авторизации пользователя в GitLab API
 GITLAB_CLIENT_ID = settings.GITLAB_CLIENT_ID
 GITLAB_CLIENT_SECRET = settings.GITLAB_CLIENT_SECRET
 
+# Адреса GitLab API, вынесены на уровень модуля, чтобы их можно было
+# подменить на локальную заглушку в тестах
+GITLAB_TOKEN_URL = f"{settings.GITLAB_URL}/oauth/token"
+GITLAB_USER_URL = f"{settings.GITLAB_URL}/api/v4/user"
+
+# Общий асинхронный клиент с пулом соединений к GitLab
+_gitlab_client: httpx.AsyncClient | None = None
+
+
+def get_gitlab_client() -> httpx.AsyncClient:
+    """
+    Возвращает общий HTTP-клиент для GitLab, создавая его при первом вызове
+    :return: Асинхронный HTTP-клиент
+    """
+    global _gitlab_client
+    if _gitlab_client is None or _gitlab_client.is_closed:
+        _gitlab_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.GITLAB_TIMEOUT),
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            # Повтор установки соединения при сетевых ошибках: запрос ещё не отправлен,
+            # поэтому это безопасно и для POST
+            transport=httpx.AsyncHTTPTransport(retries=settings.GITLAB_RETRIES),
+        )
+    return _gitlab_client
+
+
+async def close_gitlab_client():
+    """
+    Закрывает общий HTTP-клиент GitLab при остановке приложения
+    """
+    global _gitlab_client
+    if _gitlab_client is not None:
+        await _gitlab_client.aclose()
+        _gitlab_client = None
+
+
+async def _gitlab_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    Выполняет запрос к GitLab с повторами при таймаутах и ответах 5xx.
+    Повторяются только идемпотентные GET: код авторизации одноразовый,
+    и повтор обмена, уже выполненного GitLab, вернул бы ошибку вместо токена
+    :param method: HTTP-метод
+    :param url: Адрес запроса
+    :param kwargs: Параметры запроса httpx
+    :return: Ответ GitLab
+    """
+    client = get_gitlab_client()
+    attempts = settings.GITLAB_RETRIES + 1 if method in ("GET", "HEAD") else 1
+    for attempt in range(attempts):
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError:
+            if attempt == attempts - 1:
+                raise
+        else:
+            if response.status_code < 500 or attempt == attempts - 1:
+                return response
+        # Экспоненциальная задержка перед следующей попыткой
+        await asyncio.sleep(0.2 * 2 ** attempt)
+
 
 def create_access_token(data: dict, expires_delta: timedelta = None) -> str:
     """
@@ -46,7 +108,6 @@ async def authenticate_user_in_gitlab(code: str):
     :param code: Код авторизации
     :return: Токен доступа и токен обновления
      """
-    token_url = "https://git.66bit.ru/oauth/token"
     data = {
         "client_id": GITLAB_CLIENT_ID,
         "client_secret": GITLAB_CLIENT_SECRET,
@@ -54,8 +115,33 @@ async def authenticate_user_in_gitlab(code: str):
         "grant_type": "authorization_code",
         "redirect_uri": "http://localhost:8000/auth/login"
     }
-    response = requests.post(token_url, data=data)
+    try:
+        response = await _gitlab_request("POST", GITLAB_TOKEN_URL, data=data)
+    except httpx.HTTPError as e:
+        print("Ошибка соединения с GitLab:", repr(e))
+        return None
     if response.status_code != 200:
         print("Ошибка авторизации:", response.status_code, response.text)
         return None
-    return response.json().get("access_token")
\ No newline at end of file
+    return response.json().get("access_token")
+
+
+async def get_gitlab_user(token: str) -> dict:
+    """
+    Получение профиля пользователя GitLab.
+    Профиль запрашивается один раз на вход со свежим токеном, поэтому не кэшируется
+    :param token: Токен доступа GitLab
+    :return: Профиль пользователя
+    :raises HTTPException: Если GitLab вернул ошибку
+    """
+    response = await _gitlab_request(
+        "GET", GITLAB_USER_URL,
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=response.json()
+        )
+
+    return response.json()
\ No newline at end of file
@@ -1,9 +1,11 @@
-from app.database import async_session_maker
+from app.dao.base import BaseDAO
+from app.database import async_session_maker, read_session_maker
 from app.users.models import User
+from sqlalchemy import lambda_stmt
 from sqlalchemy.future import select
 
 
-class UsersDAO:
+class UsersDAO(BaseDAO):
     model = User
 
     @staticmethod
@@ -14,7 +16,8 @@ class UsersDAO:
         :return: пользователь или None, если такой пользователь не найден
          """
         async with async_session_maker() as session:
-            result = await session.execute(select(User).filter_by(email=email))
+            # Запрос выполняется при каждой авторизации, поэтому не строится заново
+            result = await session.execute(lambda_stmt(lambda: select(User).where(User.email == email)))
             return result.scalar_one_or_none()
 
     @staticmethod
@@ -39,7 +42,7 @@ class UsersDAO:
         Возвращает всех пользователей из бд
         :return: список пользователей
         """
-        async with async_session_maker() as session:
+        async with read_session_maker() as session:
             query = select(cls.model)
             result = await session.execute(query)
             return result.scalars().all()
@@ -51,7 +54,7 @@ class UsersDAO:
         :param query: искомое имя
         :return: список пользователей
         """
-        async with async_session_maker() as session:
+        async with read_session_maker() as session:
             search_query = f"%{query}%"
             result = await session.execute(
                 select(cls.model)
@@ -1,14 +1,15 @@
 from fastapi import Request
+from fastapi.requests import HTTPConnection
 from app.exceptions import TokenExpiredException, NoJwtException
-from app.exceptions import NoUserIdException, TokenNoFoundException
+from app.exceptions import NoUserIdException, TokenNoFoundException, ForbiddenException
 import jwt
-from app.config import get_auth_data
+from app.config import get_auth_data, settings
 from app.users.dao import UsersDAO
 
 
 class Auth:
-    def __init__(self, request: Request):
-        # Получение токена из запроса
+    def __init__(self, request: HTTPConnection):
+        # Получение токена из запроса или вебсокет-соединения
         self.request = request
         self.token = self.get_token()
 
@@ -51,3 +52,12 @@ async def auth_dependency(request: Request):
     # Вызов зависимости для получения текущего пользователя
     auth = Auth(request)
     return await auth.check_authenticated_user()
+
+
+async def admin_dependency(request: Request):
+    # Служебные эндпоинты доступны только адресам из ADMIN_EMAILS
+    user = await auth_dependency(request)
+    admins = {email.strip().lower() for email in settings.ADMIN_EMAILS.split(",") if email.strip()}
+    if user.email.lower() not in admins:
+        raise ForbiddenException
+    return user
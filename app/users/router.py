@@ -1,10 +1,10 @@
 from fastapi import APIRouter, Response, Depends, HTTPException, Request, Query
-import requests
 from app.config import settings
 from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
 from app.users.auth import create_access_token
-from app.users.auth import authenticate_user_in_gitlab
+from app.users.auth import authenticate_user_in_gitlab, get_gitlab_user
 from app.users.dao import UsersDAO
+from app.admission import admit_bulk
 from app.users.dependencies import auth_dependency
 from app.users.models import User
 from app.users.schemas import UserRead
@@ -28,19 +28,7 @@ async def login_in_gitlab(code: str, response: Response):
         raise HTTPException(status_code=400, detail='Неверный код авторизации')
 
     # Получение информации о пользователе
-    user_info_url = "https://git.66bit.ru/api/v4/user"
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
-    user_response = requests.get(user_info_url, headers=headers)
-
-    if user_response.status_code != 200:
-        raise HTTPException(
-            status_code=user_response.status_code,
-            detail=user_response.json()
-        )
-
-    user_info = user_response.json()
+    user_info = await get_gitlab_user(token)
     user = await UsersDAO.find_one_or_none(email=user_info['email'])
 
     # Регистрация пользователя, если он не существует
@@ -76,7 +64,7 @@ async def logout_user(response: Response):
     return {'message': 'Пользователь вышел из аккаунта'}
 
 
-@router.get("/search", summary="Поиск пользователей")
+@router.get("/search", summary="Поиск пользователей", dependencies=[Depends(admit_bulk)])
 async def search_users(query: str, current_user: User = Depends(auth_dependency)):
     if not query:
         return []
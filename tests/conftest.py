@@ -0,0 +1,56 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Настройки читаются при импорте приложения, поэтому окружение задаём до него:
+# основная БД и два шарда - отдельные файлы SQLite
+DB_DIR = tempfile.mkdtemp(prefix="messenger-tests-")
+os.environ.update(
+    SECRET_KEY="test-secret",
+    ALGORITHM="HS256",
+    GITLAB_CLIENT_ID="test",
+    GITLAB_CLIENT_SECRET="test",
+    REDIRECT_URI="http://localhost/callback",
+    DATABASE_URL=f"sqlite+aiosqlite:///{DB_DIR}/main.db",
+    MESSAGES_SHARDS=f"s1=sqlite+aiosqlite:///{DB_DIR}/s1.db,s2=sqlite+aiosqlite:///{DB_DIR}/s2.db",
+    SHARD_PLACEMENT_TTL="1",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.chat.cache import hot_tail_cache  # noqa: E402
+from app.chat.membership import membership  # noqa: E402
+from app.chat.shards import shard_map, init_shards, SHARDED_TABLES, DEFAULT_SHARD  # noqa: E402
+from app.database import Base, engine  # noqa: E402
+import app.users.models  # noqa: E402,F401
+import app.chat.models  # noqa: E402,F401
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def databases():
+    """
+    Чистые основная БД и шарды для каждого теста
+    """
+    for name, shard_engine in shard_map.engines.items():
+        if name != DEFAULT_SHARD:
+            async with shard_engine.begin() as conn:
+                for table in SHARDED_TABLES:
+                    await conn.run_sync(table.drop, checkfirst=True)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    await init_shards()
+    shard_map._placement.clear()
+    hot_tail_cache._chats.clear()
+    hot_tail_cache.size_bytes = 0
+    membership._chat_members.clear()
+    membership._user_chats.clear()
+    yield shard_map
+    for shard_engine in shard_map.engines.values():
+        await shard_engine.dispose()
@@ -0,0 +1,55 @@
+import httpx
+import pytest
+from fastapi import HTTPException, status
+from starlette.requests import Request
+
+from app.config import settings
+from app.users import auth
+from app.users.dao import UsersDAO
+from app.users.dependencies import admin_dependency
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def gitlab(monkeypatch):
+    requests = []
+    responses = []
+
+    def handler(request: httpx.Request):
+        requests.append(request.method)
+        return responses.pop(0)
+
+    monkeypatch.setattr(auth, "_gitlab_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return requests, responses
+
+
+async def test_token_exchange_is_not_retried(gitlab):
+    requests, responses = gitlab
+    responses.extend([httpx.Response(502), httpx.Response(200, json={"access_token": "token"})])
+
+    assert await auth.authenticate_user_in_gitlab("code") is None
+    assert requests == ["POST"]
+
+
+async def test_profile_request_is_retried(gitlab):
+    requests, responses = gitlab
+    responses.extend([httpx.Response(502), httpx.Response(200, json={"id": 1})])
+
+    assert await auth.get_gitlab_user("token") == {"id": 1}
+    assert requests == ["GET", "GET"]
+
+
+async def test_stats_require_admin(databases, monkeypatch):
+    admin = await UsersDAO.add(name="Админ", email="admin@example.com")
+    user = await UsersDAO.add(name="Пользователь", email="user@example.com")
+    monkeypatch.setattr(settings, "ADMIN_EMAILS", "Admin@example.com, ops@example.com")
+
+    def request_for(email: str) -> Request:
+        token = auth.create_access_token({"sub": email})
+        return Request({"type": "http", "headers": [(b"cookie", f"access_token={token}".encode())]})
+
+    assert (await admin_dependency(request_for(admin.email))).id == admin.id
+    with pytest.raises(HTTPException) as denied:
+        await admin_dependency(request_for(user.email))
+    assert denied.value.status_code == status.HTTP_403_FORBIDDEN
@@ -0,0 +1,60 @@
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event, select
+
+from app.database import async_session_maker, engine
+from app.users.dao import UsersDAO
+from app.users.models import User
+
+pytestmark = pytest.mark.anyio
+
+
+@contextmanager
+def statements():
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append((statement.split()[0], executemany))
+
+    event.listen(engine.sync_engine, "after_cursor_execute", record)
+    try:
+        yield executed
+    finally:
+        event.remove(engine.sync_engine, "after_cursor_execute", record)
+
+
+def users(count: int, start: int = 0) -> list[dict]:
+    return [{"name": f"Пользователь {n}", "email": f"user{n}@example.com"} for n in range(start, start + count)]
+
+
+async def test_insert_many_with_returning_pages_by_thousand_rows(databases):
+    with statements() as executed:
+        ids = await UsersDAO.insert_many(users(2500), returning=(User.id,))
+
+    assert len(ids) == 2500
+    assert [row.id for row in ids] == sorted(row.id for row in ids)
+    # PostgreSQL сохраняет порядок строк в многострочном INSERT, SQLite - нет,
+    # поэтому на нём строки с RETURNING вставляются по одной
+    expected = 3 if engine.dialect.name == "postgresql" else 2500
+    assert [name for name, _ in executed if name == "INSERT"] == ["INSERT"] * expected
+
+
+async def test_insert_many_without_returning_is_one_executemany(databases):
+    with statements() as executed:
+        assert await UsersDAO.insert_many(users(2500)) == 2500
+
+    assert [(name, many) for name, many in executed if name == "INSERT"] == [("INSERT", True)]
+
+
+async def test_update_many_is_one_update_per_batch(databases):
+    ids = await UsersDAO.insert_many(users(2500), returning=(User.id,))
+
+    with statements() as executed:
+        updated = await UsersDAO.update_many([{"id": row.id, "name": f"Переименован {row.id}"} for row in ids])
+
+    assert updated == 2500
+    assert [(name, many) for name, many in executed if name == "UPDATE"] == [("UPDATE", False)] * 3
+    async with async_session_maker() as session:
+        names = dict((await session.execute(select(User.id, User.name))).all())
+    assert names == {row.id: f"Переименован {row.id}" for row in ids}
@@ -0,0 +1,91 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from app.chat.chunked_uploads import ChunkedUploads, _write_meta
+
+pytestmark = pytest.mark.anyio
+
+
+async def body(data: bytes):
+    yield data
+
+
+async def uploaded(uploads: ChunkedUploads, data: bytes, filename: str = "отчёт.txt"):
+    session = await uploads.create(1, 1, 2, filename, len(data))
+    await uploads.write_chunk(session, 0, body(data))
+    return session
+
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("uploads")
+    return ChunkedUploads(max_size=1024, ttl=60)
+
+
+async def test_same_name_uploads_do_not_overwrite_each_other(uploads):
+    first = await uploaded(uploads, b"first")
+    second = await uploaded(uploads, b"second")
+
+    first_path = await uploads.finish(first, hashlib.sha256(b"first").hexdigest())
+    second_path = await uploads.finish(second, hashlib.sha256(b"second").hexdigest())
+
+    assert first_path != second_path
+    with open(first_path, "rb") as f:
+        assert f.read() == b"first"
+    with open(second_path, "rb") as f:
+        assert f.read() == b"second"
+
+
+async def test_stored_name_is_sanitized(uploads):
+    session = await uploaded(uploads, b"data", filename="..a b?.txt")
+    path = await uploads.finish(session, hashlib.sha256(b"data").hexdigest())
+    assert path == f"uploads/{session.id}_a_b_.txt"
+
+
+async def test_concurrent_finish_completes_once(uploads):
+    session = await uploaded(uploads, b"data")
+    checksum = hashlib.sha256(b"data").hexdigest()
+
+    results = await asyncio.gather(uploads.finish(session, checksum), uploads.finish(session, checksum),
+                                   return_exceptions=True)
+
+    paths = [result for result in results if isinstance(result, str)]
+    errors = [result for result in results if isinstance(result, HTTPException)]
+    assert len(paths) == 1 and os.path.exists(paths[0])
+    assert [error.status_code for error in errors] == [409]
+
+
+async def test_chunks_received_by_different_processes_are_merged(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("uploads")
+    first, second = ChunkedUploads(max_size=1024, ttl=60), ChunkedUploads(max_size=1024, ttl=60)
+    session = await first.create(1, 1, 2, "файл.bin", 8)
+
+    await first.write_chunk(first.get(session.id, 1), 0, body(b"abcd"))
+    await second.write_chunk(second.get(session.id, 1), 4, body(b"efgh"))
+
+    merged = first.get(session.id, 1)
+    assert merged.received == [[0, 8]]
+    await first.finish(merged, hashlib.sha256(b"abcdefgh").hexdigest())
+    with pytest.raises(HTTPException) as error:
+        second.get(session.id, 1)
+    assert error.value.status_code == 404
+
+
+async def test_cleanup_keeps_sessions_with_recent_chunks(uploads, monkeypatch):
+    active = await uploads.create(1, 1, 2, "идёт.bin", 8)
+    abandoned = await uploads.create(1, 1, 2, "брошен.bin", 8)
+    for session in (active, abandoned):
+        session.created_at = session.updated_at = 0
+        await asyncio.to_thread(_write_meta, session)
+
+    await uploads.write_chunk(active, 0, body(b"abcd"))
+
+    assert await uploads.cleanup_expired() == 1
+    assert os.path.exists(active.meta_path)
+    assert not os.path.exists(abandoned.meta_path)
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+from fastapi import WebSocket, WebSocketDisconnect
+
+from app.chat.codec import JsonCodec
+from app.chat.router import receive_action
+
+pytestmark = pytest.mark.anyio
+
+
+def connected_socket(frames: list[dict]):
+    incoming = iter([{"type": "websocket.connect"}, *frames])
+    sent = []
+
+    async def receive():
+        return next(incoming)
+
+    async def send(message):
+        sent.append(message)
+
+    websocket = WebSocket({"type": "websocket", "path": "/", "headers": []}, receive, send)
+    return websocket, sent
+
+
+async def test_wrong_frame_type_gets_error_and_loop_continues():
+    websocket, sent = connected_socket([
+        {"type": "websocket.receive", "bytes": b"\x81"},
+        {"type": "websocket.receive", "text": json.dumps({"action": "typing", "is_typing": True})},
+    ])
+    await websocket.accept()
+
+    action = await receive_action(websocket, JsonCodec)
+
+    assert action.action == "typing"
+    errors = [json.loads(message["text"]) for message in sent if message["type"] == "websocket.send"]
+    assert errors == [{"action": "error", "detail": "Ожидался текстовый кадр"}]
+
+
+async def test_disconnect_is_still_raised():
+    websocket, _ = connected_socket([{"type": "websocket.disconnect", "code": 1001}])
+    await websocket.accept()
+
+    with pytest.raises(WebSocketDisconnect):
+        await receive_action(websocket, JsonCodec)
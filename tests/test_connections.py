@@ -0,0 +1,40 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import status
+
+from app.chat.connections import ConnectionManager
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeSocket:
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.sent = []
+        self.close_code = None
+
+    async def send_text(self, data: str):
+        await asyncio.sleep(self.delay)
+        self.sent.append(data)
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+async def test_slow_consumer_is_dropped_without_delaying_others():
+    connections = ConnectionManager(send_timeout=0.05)
+    sockets = [FakeSocket(), FakeSocket(delay=60), FakeSocket()]
+    for user_id, websocket in enumerate(sockets, start=1):
+        connections.connect(websocket, user_id)
+        connections.subscribe(websocket, 1)
+
+    started = time.monotonic()
+    await connections.broadcast(1, {"action": "new_message"})
+
+    assert time.monotonic() - started < 1
+    assert [len(websocket.sent) for websocket in sockets] == [1, 0, 1]
+    assert sockets[1].close_code == status.WS_1013_TRY_AGAIN_LATER
+    assert set(connections.chat_connections(1)) == {sockets[0], sockets[2]}
+    assert connections.stats["slow_dropped"] == 1
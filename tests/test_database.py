@@ -0,0 +1,34 @@
+import pytest
+from sqlalchemy import update
+
+from app.database import _last_write, async_session_maker
+from app.users.models import User
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_write_in_begin_block_is_remembered(databases):
+    _last_write.set(None)
+    async with async_session_maker() as session:
+        async with session.begin():
+            session.add(User(name="Первый", email="first@example.com"))
+
+    assert _last_write.get() is not None
+
+
+async def test_bulk_update_is_remembered(databases):
+    _last_write.set(None)
+    async with async_session_maker() as session:
+        await session.execute(update(User).values(name="Второй"))
+        await session.commit()
+
+    assert _last_write.get() is not None
+
+
+async def test_read_only_session_is_not_a_write(databases):
+    _last_write.set(None)
+    async with async_session_maker() as session:
+        await session.get(User, 1)
+        await session.commit()
+
+    assert _last_write.get() is None
@@ -0,0 +1,76 @@
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from app.chat.dao import ChatDAO, MessagesDAO
+from app.chat.delivery import DeliveryTracker
+from app.chat.models import Message
+from app.chat.schemas import MessageStatus
+from app.users.dao import UsersDAO
+
+pytestmark = pytest.mark.anyio
+
+
+async def statuses(shard_map, chat_id: int) -> list[str]:
+    async with (await shard_map.session_maker(chat_id))() as session:
+        result = await session.execute(select(Message.status).where(Message.chat_id == chat_id).order_by(Message.id))
+        return result.scalars().all()
+
+
+async def test_out_of_order_ack_does_not_mark_skipped_messages(databases):
+    if any(engine.dialect.name != "postgresql" for engine in databases.engines.values()):
+        pytest.skip("UPDATE ... FROM (VALUES ...) AS name (columns) требует PostgreSQL")
+    sender = await UsersDAO.add(name="Отправитель", email="sender@example.com")
+    recipient = await UsersDAO.add(name="Получатель", email="recipient@example.com")
+    chat = await ChatDAO.create_chat("Чат", [sender.id, recipient.id])
+    ids = [(await MessagesDAO.add_message(chat.id, sender.id, recipient.id, f"{n}", MessageStatus.SENT.value)).id
+           for n in range(3)]
+    tracker = DeliveryTracker(interval=60, batch_size=100)
+
+    tracker.ack(chat.id, recipient.id, [ids[2]])
+    await tracker.flush()
+
+    sent, delivered = MessageStatus.SENT.value, MessageStatus.DELIVERED.value
+    assert await statuses(databases, chat.id) == [sent, sent, delivered]
+    assert tracker._persisted[(chat.id, recipient.id)] < ids[0]
+
+    tracker.ack(chat.id, recipient.id, [ids[0], ids[1]])
+    await tracker.flush()
+
+    assert await statuses(databases, chat.id) == [delivered] * 3
+    assert tracker._persisted[(chat.id, recipient.id)] == ids[2]
+
+
+async def test_acks_below_watermark_are_dropped_and_failed_flush_is_retried(monkeypatch):
+    calls = []
+
+    async def mark_delivered(acks):
+        calls.append(acks)
+        if len(calls) == 1:
+            raise RuntimeError("БД недоступна")
+        return [], {(1, 2): 5}
+
+    monkeypatch.setattr(MessagesDAO, "mark_delivered", mark_delivered)
+    tracker = DeliveryTracker(interval=60, batch_size=100)
+
+    tracker.ack(1, 2, [5, 3])
+    with pytest.raises(RuntimeError):
+        await tracker.flush()
+    await tracker.flush()
+    tracker.ack(1, 2, [4, 5])
+
+    assert calls == [[(1, 2, 0, [3, 5])], [(1, 2, 0, [3, 5])]]
+    assert tracker._persisted == {(1, 2): 5}
+    assert tracker._pending == {}
+
+
+def test_delivered_queries_bind_arrays_not_rows():
+    # 20 000 пар по 3 ID - 60 000 строк: в VALUES это 180 000 параметров при пределе 32767
+    acks = [(chat_id, 1, 0, [chat_id * 10 + n for n in range(3)]) for chat_id in range(20_000)]
+
+    for query in MessagesDAO._delivered_queries(acks):
+        compiled = query.compile(dialect=postgresql.asyncpg.dialect())
+        arrays = [value for value in compiled.params.values() if isinstance(value, list)]
+        assert len(compiled.params) <= 6
+        assert {len(array) for array in arrays} <= {20_000, 60_000}
+        assert "unnest(" in str(compiled)
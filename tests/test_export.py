@@ -0,0 +1,30 @@
+import pytest
+
+from app.admission import admission, PRIORITY_BULK
+from app.chat.router import SlotStreamingResponse
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_export_slot_is_released_when_client_leaves_before_streaming():
+    started = []
+
+    async def content():
+        started.append(True)
+        yield b"{}\n"
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        raise OSError("клиент ушёл")
+
+    in_flight = admission.in_flight
+    acquired_at = await admission.acquire(PRIORITY_BULK)
+    response = SlotStreamingResponse(content(), acquired_at, media_type="application/x-ndjson")
+
+    with pytest.raises(BaseException):
+        await response({"type": "http"}, receive, send)
+
+    assert not started
+    assert admission.in_flight == in_flight
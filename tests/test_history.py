@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+from app.chat.cache import HotTailCache, hot_tail_cache
+from app.chat.dao import ChatDAO, MessagesDAO
+from app.chat.router import get_messages
+from app.chat.schemas import MessageStatus
+from app.config import settings
+from app.users.dao import UsersDAO
+
+pytestmark = pytest.mark.anyio
+
+
+async def make_chat():
+    first = await UsersDAO.add(name="Первый", email="first@example.com")
+    second = await UsersDAO.add(name="Второй", email="second@example.com")
+    chat = await ChatDAO.create_chat("Чат", [first.id, second.id])
+    return first, second, chat
+
+
+def ids(response) -> list[int]:
+    return [row["id"] for row in json.loads(response.body)]
+
+
+async def test_default_history_request_is_served_from_cache(databases, monkeypatch):
+    first, second, chat = await make_chat()
+    for n in range(settings.HOT_TAIL_SIZE + 5):
+        await MessagesDAO.add_message(chat.id, first.id, second.id, f"{n}", MessageStatus.SENT.value)
+
+    await get_messages(chat.id, limit=settings.HOT_TAIL_SIZE, before_id=None, current_user=second)
+
+    async def no_db(*args, **kwargs):
+        raise AssertionError("запрос ушёл в БД")
+
+    monkeypatch.setattr(MessagesDAO, "get_history_rows", no_db)
+    response = await get_messages(chat.id, limit=settings.HOT_TAIL_SIZE, before_id=None, current_user=second)
+    assert len(ids(response)) == settings.HOT_TAIL_SIZE
+    assert hot_tail_cache.get(chat.id) is None  # вся история в кэше не хранится
+
+
+async def test_history_defaults_to_whole_chat_and_pages_back(databases):
+    first, second, chat = await make_chat()
+    sent = [
+        (await MessagesDAO.add_message(chat.id, first.id, second.id, f"{n}", MessageStatus.SENT.value)).id
+        for n in range(settings.HOT_TAIL_SIZE + 5)
+    ]
+
+    assert ids(await get_messages(chat.id, limit=None, before_id=None, current_user=second)) == sent
+
+    tail = ids(await get_messages(chat.id, limit=10, before_id=None, current_user=second))
+    page = ids(await get_messages(chat.id, limit=10, before_id=tail[0], current_user=second))
+    assert tail == sent[-10:]
+    assert page == sent[-20:-10]
+
+
+async def test_history_sees_writes_from_another_process(databases, monkeypatch):
+    first, second, chat = await make_chat()
+    await MessagesDAO.add_message(chat.id, first.id, second.id, "раз", MessageStatus.SENT.value)
+    before = ids(await get_messages(chat.id, limit=None, before_id=None, current_user=second))
+
+    # Другой процесс пишет в ту же БД, но в свой кэш - этот о записи не узнаёт
+    other_process = HotTailCache(settings.HOT_TAIL_SIZE, settings.HOT_TAIL_MAX_BYTES, settings.HOT_TAIL_TTL)
+    monkeypatch.setattr("app.chat.dao.hot_tail_cache", other_process)
+    message = await MessagesDAO.add_message(chat.id, first.id, second.id, "два", MessageStatus.SENT.value)
+    await MessagesDAO.update_message(before[0], "раз, исправлено")
+    monkeypatch.setattr("app.chat.dao.hot_tail_cache", hot_tail_cache)
+
+    response = json.loads((await get_messages(chat.id, limit=None, before_id=None, current_user=second)).body)
+    assert [row["id"] for row in response] == before + [message.id]
+    assert response[0]["content"] == "раз, исправлено"
+
+
+async def test_own_writes_keep_cache_entry(databases, monkeypatch):
+    first, second, chat = await make_chat()
+    await MessagesDAO.add_message(chat.id, first.id, second.id, "раз", MessageStatus.SENT.value)
+    await get_messages(chat.id, limit=None, before_id=None, current_user=second)
+    message = await MessagesDAO.add_message(chat.id, first.id, second.id, "два", MessageStatus.SENT.value)
+    await MessagesDAO.mark_message_as_read(message.id, second.id)
+
+    async def no_db(*args, **kwargs):
+        raise AssertionError("запрос ушёл в БД")
+
+    monkeypatch.setattr(MessagesDAO, "get_history_rows", no_db)
+    response = await get_messages(chat.id, limit=None, before_id=None, current_user=second)
+    assert ids(response)[-1] == message.id
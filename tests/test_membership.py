@@ -0,0 +1,40 @@
+import pytest
+from sqlalchemy import insert
+
+from app.chat.dao import ChatDAO
+from app.chat.membership import membership
+from app.chat.models import chat_user_association
+from app.database import engine
+from app.users.dao import UsersDAO
+
+pytestmark = pytest.mark.anyio
+
+
+async def add_member_elsewhere(chat_id: int, user_id: int):
+    # Изменение состава другим процессом: кэш этого процесса о нём не знает
+    async with engine.begin() as conn:
+        await conn.execute(insert(chat_user_association).values(chat_id=chat_id, user_id=user_id))
+
+
+async def test_empty_user_chats_are_not_cached(databases):
+    first = await UsersDAO.add(name="Первый", email="first@example.com")
+    second = await UsersDAO.add(name="Второй", email="second@example.com")
+    chat = await ChatDAO.create_chat("Чат", [first.id])
+    assert await membership.user_chats(second.id) == set()
+
+    await add_member_elsewhere(chat.id, second.id)
+
+    assert await membership.user_chats(second.id) == {chat.id}
+
+
+async def test_cached_membership_expires_after_ttl(databases, monkeypatch):
+    first = await UsersDAO.add(name="Первый", email="first@example.com")
+    second = await UsersDAO.add(name="Второй", email="second@example.com")
+    chat = await ChatDAO.create_chat("Чат", [first.id])
+    assert not await membership.is_member(chat.id, second.id)
+
+    await add_member_elsewhere(chat.id, second.id)
+    assert not await membership.is_member(chat.id, second.id)
+
+    monkeypatch.setattr(membership, "ttl", 0)
+    assert await membership.is_member(chat.id, second.id)
@@ -0,0 +1,64 @@
+import pytest
+
+from app.chat import notifications as notifications_module
+from app.chat.connections import manager
+from app.chat.dao import ChatDAO, NotificationsDAO
+from app.chat.notifications import notifications
+from app.users.dao import UsersDAO
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeSocket:
+    pass
+
+
+async def test_online_but_unsubscribed_members_are_queued(databases, monkeypatch):
+    queued = []
+    monkeypatch.setattr(notifications_module.job_runner, "submit",
+                        lambda func, rows, **kwargs: queued.extend(row["user_id"] for row in rows))
+    sender = await UsersDAO.add(name="Отправитель", email="sender@example.com")
+    subscribed = await UsersDAO.add(name="Подписан", email="subscribed@example.com")
+    unsubscribed = await UsersDAO.add(name="Не подписан", email="unsubscribed@example.com")
+    chat = await ChatDAO.create_chat("Чат", [sender.id, subscribed.id, unsubscribed.id])
+    sockets = [FakeSocket(), FakeSocket()]
+    manager.connect(sockets[0], subscribed.id)
+    manager.subscribe(sockets[0], chat.id)
+    manager.connect(sockets[1], unsubscribed.id)
+    try:
+        await notifications.enqueue(chat.id, {"action": "new_message", "message": {"sender_id": sender.id}})
+    finally:
+        for websocket in sockets:
+            manager.disconnect(websocket)
+
+    assert queued == [unsubscribed.id]
+
+
+class SendingSocket:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.sent = []
+
+    async def send_text(self, data: str):
+        if self.fail:
+            raise RuntimeError("соединение оборвалось")
+        self.sent.append(data)
+
+
+async def test_drain_keeps_queue_until_send_succeeds(databases):
+    sender = await UsersDAO.add(name="Отправитель", email="sender@example.com")
+    recipient = await UsersDAO.add(name="Получатель", email="recipient@example.com")
+    chat = await ChatDAO.create_chat("Чат", [sender.id, recipient.id])
+    await NotificationsDAO.insert_many([
+        {"user_id": recipient.id, "chat_id": chat.id, "kind": "new_message", "payload": f'{{"n": {n}}}'}
+        for n in range(2)
+    ])
+
+    with pytest.raises(RuntimeError):
+        await notifications.drain(SendingSocket(fail=True), recipient.id)
+    assert len((await NotificationsDAO.get_for_user(recipient.id))[1]) == 2
+
+    websocket = SendingSocket()
+    await notifications.drain(websocket, recipient.id)
+    assert len(websocket.sent) == 1
+    assert await NotificationsDAO.get_for_user(recipient.id) == ([], [])
@@ -0,0 +1,17 @@
+import os
+
+from app.chat.partitions import _copy_blobs
+
+
+def test_copy_blobs_keeps_relative_paths_and_skips_missing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("uploads")
+    with open("uploads/a.txt", "wb") as f:
+        f.write(b"data")
+
+    copied = _copy_blobs(["uploads/a.txt", "uploads/missing.txt", "../outside.txt"], "archive/messages_p0_files")
+
+    assert copied == 1
+    with open("archive/messages_p0_files/uploads/a.txt", "rb") as f:
+        assert f.read() == b"data"
+    assert os.path.exists("uploads/a.txt")
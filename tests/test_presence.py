@@ -0,0 +1,36 @@
+import pytest
+
+from app.chat.connections import ConnectionManager
+from app.chat.presence import PresenceService
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeSocket:
+    def __init__(self):
+        self.closed = False
+
+    async def close(self, code=1000):
+        self.closed = True
+
+
+def subscribed(connections: ConnectionManager, user_id: int) -> FakeSocket:
+    websocket = FakeSocket()
+    connections.connect(websocket, user_id)
+    connections.subscribe(websocket, 1)
+    return websocket
+
+
+async def test_only_clients_that_ping_are_reaped():
+    connections = ConnectionManager()
+    presence = PresenceService(connections, interval=1, heartbeat_timeout=0)
+    legacy = subscribed(connections, 1)
+    pinging = subscribed(connections, 2)
+    presence.touch(legacy)
+    presence.touch(pinging, ping=True)
+
+    await presence.reap()
+
+    assert not legacy.closed
+    assert pinging.closed
+    assert presence.stats["reaped"] == 1
@@ -0,0 +1,140 @@
+import io
+import os
+
+import pytest
+from fastapi import HTTPException, UploadFile
+from pydantic import ValidationError
+from sqlalchemy import select, func
+
+from app.chat.dao import ChatDAO, MessagesDAO
+from app.chat.idempotency import recent_sends
+from app.chat.models import Message, File
+from app.chat.router import handle_socket_action, send_message
+from app.chat.schemas import MessageCreate, MessageStatus, socket_action_adapter
+from app.users.dao import UsersDAO
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def clear_recent_sends():
+    recent_sends._entries.clear()
+
+
+async def users_and_chat():
+    first = await UsersDAO.add(name="Первый", email="first@example.com")
+    second = await UsersDAO.add(name="Второй", email="second@example.com")
+    outsider = await UsersDAO.add(name="Чужой", email="outsider@example.com")
+    chat = await ChatDAO.create_chat("Чат", [first.id, second.id])
+    return first, second, outsider, chat
+
+
+def message_from(user, chat, recipient, content: str, client_id: str | None = None) -> MessageCreate:
+    return MessageCreate(chat_id=chat.id, sender_id=user.id, recipient_id=recipient.id,
+                         content=content, client_id=client_id)
+
+
+async def message_count(shard_map, chat_id: int) -> int:
+    async with (await shard_map.session_maker(chat_id, read=True))() as session:
+        return (await session.execute(
+            select(func.count()).select_from(Message).where(Message.chat_id == chat_id))).scalar()
+
+
+async def test_retry_returns_original_message_once(databases):
+    first, second, _, chat = await users_and_chat()
+
+    sent = await send_message(message_from(first, chat, second, "привет", "c-1"), first)
+    recent_sends._entries.clear()  # повтор в другой процесс: только уникальный индекс
+    retried = await send_message(message_from(first, chat, second, "привет", "c-1"), first)
+
+    assert retried.id == sent.id
+    assert await message_count(databases, chat.id) == 1
+
+
+async def test_non_member_is_rejected_before_cache_lookup(databases):
+    first, second, outsider, chat = await users_and_chat()
+    await send_message(message_from(first, chat, second, "секрет", "c-1"), first)
+
+    # Чужой пользователь подставляет sender_id и client_id участника
+    with pytest.raises(HTTPException) as error:
+        await send_message(message_from(first, chat, second, "секрет", "c-1"), outsider)
+    assert error.value.status_code == 403
+
+
+async def test_client_id_is_scoped_to_authenticated_sender(databases):
+    first, second, _, chat = await users_and_chat()
+    original = await send_message(message_from(first, chat, second, "от первого", "c-1"), first)
+
+    # Тот же client_id и чужой sender_id в теле не возвращают сообщение первого участника
+    other = await send_message(message_from(first, chat, first, "от второго", "c-1"), second)
+
+    assert other.id != original.id
+    assert other.sender_id == second.id
+    assert await message_count(databases, chat.id) == 2
+
+
+async def test_socket_relay_claim_is_shared_across_processes(databases):
+    first, _, _, chat = await users_and_chat()
+
+    assert await MessagesDAO.claim_client_id(chat.id, first.id, "ws-1")
+    assert not await MessagesDAO.claim_client_id(chat.id, first.id, "ws-1")
+    assert await MessagesDAO.claim_client_id(chat.id, first.id, "ws-2")
+
+
+async def test_attachment_is_on_disk_when_message_is_returned(databases, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("uploads")
+    first, second, _, chat = await users_and_chat()
+    message = message_from(first, chat, second, "", "c-1")
+    message.files = [UploadFile(io.BytesIO(b"data"), filename="a.txt")]
+
+    sent = await send_message(message, first)
+
+    async with (await databases.session_maker(chat.id, read=True))() as session:
+        path = (await session.execute(select(File.file_path).where(File.message_id == sent.id))).scalar_one()
+    with open(path, "rb") as f:
+        assert f.read() == b"data"
+
+
+async def relay(chat, user, recipient, message: dict):
+    data = socket_action_adapter.validate_python({
+        "action": "new_message",
+        "message": {"sender_id": user.id, "recipient_id": recipient.id, **message},
+    })
+    await handle_socket_action(None, chat.id, user.id, data)
+
+
+async def test_socket_relay_does_not_answer_rest_retry_from_its_payload(databases):
+    first, second, _, chat = await users_and_chat()
+
+    await relay(chat, first, second, {"client_id": "c-1", "content": "только рассылка"})
+    # Повтор через REST не собирает ответ из присланного по вебсокету
+    with pytest.raises(HTTPException) as error:
+        await send_message(message_from(first, chat, second, "только рассылка", "c-1"), first)
+    assert error.value.status_code == 409
+
+
+async def test_socket_relay_records_real_message_id(databases):
+    first, second, _, chat = await users_and_chat()
+    saved = await MessagesDAO.add_message(chat.id, first.id, second.id, "сохранено", MessageStatus.SENT.value)
+    long_id = "x" * 100
+
+    await relay(chat, first, second, {"client_id": long_id, "id": saved.id, "content": "сохранено"})
+    await relay(chat, first, second, {"client_id": long_id[:64], "id": saved.id, "content": "сохранено"})
+    recent_sends._entries.clear()
+    retried = await send_message(message_from(first, chat, second, "сохранено", long_id[:64]), first)
+
+    assert retried.id == saved.id
+    assert await message_count(databases, chat.id) == 1
+
+
+def test_socket_message_payload_is_validated():
+    with pytest.raises(ValidationError):
+        socket_action_adapter.validate_python({"action": "new_message", "message": {"client_id": "c-1"}})
+
+    data = socket_action_adapter.validate_python({
+        "action": "new_message",
+        "message": {"sender_id": 1, "recipient_id": 2, "content": "текст", "extra": "лишнее"},
+    })
+    assert data.message.content == "текст"
+    assert "extra" not in data.message.model_dump()
@@ -0,0 +1,262 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event, select, update, delete, func
+
+from app.chat.dao import MessagesDAO, ChatDAO, FilesDAO
+from app.chat.models import Message, File, Chat, ChatEvent
+from app.chat.schemas import MessageStatus
+from app.chat.shards import HashRing, DEFAULT_SHARD, move_chats, _copy_rows
+from app.database import engine
+from app.users.dao import UsersDAO
+
+pytestmark = pytest.mark.anyio
+
+
+async def make_users():
+    first = await UsersDAO.add(name="Первый", email="first@example.com")
+    second = await UsersDAO.add(name="Второй", email="second@example.com")
+    return first, second
+
+
+async def chat_on(shard_map, shard: str, users) -> Chat:
+    # Размещение детерминировано кольцом, поэтому нужный шард находится за несколько попыток
+    for attempt in range(100):
+        chat = await ChatDAO.create_chat(f"Чат {attempt}", [user.id for user in users])
+        if chat.shard == shard:
+            return chat
+    raise AssertionError(f"Кольцо не разместило ни одного чата на {shard}")
+
+
+async def stored_rows(shard_map, shard: str, chat_id: int):
+    async with shard_map.engines[shard].connect() as conn:
+        result = await conn.execute(
+            select(Message.id, Message.content).where(Message.chat_id == chat_id).order_by(Message.id))
+        return result.all()
+
+
+async def stored_files(shard_map, shard: str, chat_id: int):
+    async with shard_map.engines[shard].connect() as conn:
+        result = await conn.execute(select(File.id).where(File.chat_id == chat_id).order_by(File.id))
+        return result.scalars().all()
+
+
+async def add_message(chat: Chat, sender, recipient, content: str) -> Message:
+    return await MessagesDAO.add_message(chat.id, sender.id, recipient.id, content, MessageStatus.SENT.value)
+
+
+async def wait_for_placement(chat_id: int, shard: str):
+    # Перенос переключает chats.shard перед паузой
+    for _ in range(200):
+        async with engine.connect() as conn:
+            current = (await conn.execute(select(Chat.shard).where(Chat.id == chat_id))).scalar()
+        if current == shard:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"Чат {chat_id} не переключён на {shard}")
+
+
+def test_hash_ring_moves_only_keys_of_new_shard():
+    before = HashRing([DEFAULT_SHARD, "s1"], 128)
+    after = HashRing([DEFAULT_SHARD, "s1", "s2"], 128)
+    moved = [chat_id for chat_id in range(10_000) if before.get(chat_id) != after.get(chat_id)]
+    assert all(after.get(chat_id) == "s2" for chat_id in moved)
+    assert 0.2 < len(moved) / 10_000 < 0.5
+
+
+async def test_chat_rows_live_on_its_shard_and_events_stay_global(databases):
+    first, second = await make_users()
+    chat = await chat_on(databases, "s1", [first, second])
+    assert databases.ring.get(chat.id) == "s1"
+
+    message = await add_message(chat, first, second, "привет")
+
+    assert await stored_rows(databases, "s1", chat.id) == [(message.id, "привет")]
+    assert await stored_rows(databases, DEFAULT_SHARD, chat.id) == []
+    assert await stored_rows(databases, "s2", chat.id) == []
+    async with engine.connect() as conn:
+        events = (await conn.execute(
+            select(func.count()).select_from(ChatEvent).where(ChatEvent.chat_id == chat.id))).scalar()
+    assert events == 1
+    rows = await MessagesDAO.get_history_rows(chat.id, replica=False)
+    assert [row["content"] for row in rows] == ["привет"]
+
+
+async def test_message_id_operations_reach_chat_shard(databases):
+    first, second = await make_users()
+    chat = await chat_on(databases, "s2", [first, second])
+    message = await add_message(chat, first, second, "исходный")
+
+    read = await MessagesDAO.mark_message_as_read(message.id, second.id)
+    assert read.read_by == str(second.id)
+    assert await MessagesDAO.get_chat_id_for_message(message.id) == chat.id
+    await MessagesDAO.update_message(message.id, "изменённый")
+    assert await stored_rows(databases, "s2", chat.id) == [(message.id, "изменённый")]
+
+    await MessagesDAO.delete_message(message.id, first.id)
+    assert await stored_rows(databases, "s2", chat.id) == []
+
+
+async def test_ids_keep_growing_after_move_to_empty_shard(databases):
+    first, second = await make_users()
+    chat = await chat_on(databases, "s1", [first, second])
+    old_ids = [(await add_message(chat, first, second, f"старое {n}")).id for n in range(3)]
+
+    await move_chats("s1", "s2", [chat.id], pause=0)
+    new_message = await add_message(chat, second, first, "новое")
+
+    assert new_message.id > max(old_ids)
+    rows = await MessagesDAO.get_history_rows(chat.id, replica=False)
+    assert [row["id"] for row in rows] == [*old_ids, new_message.id]
+    last = await ChatDAO.get_last_message_for_chat(chat.id)
+    assert last.content == "новое"
+
+
+async def test_move_copies_rows_and_purges_source(databases):
+    first, second = await make_users()
+    chat = await chat_on(databases, "s1", [first, second])
+    messages = [await add_message(chat, first, second, f"сообщение {n}") for n in range(3)]
+    async with (await databases.session_maker(chat.id))() as session:
+        attachment = await FilesDAO.add_file(session, "a.txt", "uploads/a.txt", chat.id, messages[0].id)
+
+    await move_chats("s1", "s2", [chat.id], pause=0)
+
+    assert await stored_rows(databases, "s1", chat.id) == []
+    assert await stored_files(databases, "s1", chat.id) == []
+    assert [row[0] for row in await stored_rows(databases, "s2", chat.id)] == [m.id for m in messages]
+    assert await stored_files(databases, "s2", chat.id) == [attachment.id]
+    assert await databases.shard_for(chat.id) == "s2"
+    rows = await MessagesDAO.get_history_rows(chat.id, replica=False)
+    assert rows[0]["files"][0]["id"] == attachment.id
+
+
+async def test_move_catches_up_writes_and_deletes_during_pause(databases):
+    first, second = await make_users()
+    chat = await chat_on(databases, "s1", [first, second])
+    edited = await add_message(chat, first, second, "до правки")
+    deleted = await add_message(chat, first, second, "будет удалено")
+
+    move = asyncio.create_task(move_chats("s1", "s2", [chat.id], pause=0.5))
+    await wait_for_placement(chat.id, "s2")
+
+    # Процесс со старым размещением продолжает писать в исходный шард
+    stale = databases.maker("s1")
+    late_id = await databases.next_id(Message)
+    async with stale() as session:
+        async with session.begin():
+            session.add(Message(id=late_id, chat_id=chat.id, sender_id=second.id, recipient_id=first.id,
+                                content="опоздавшее", status=MessageStatus.SENT.value, read_by=""))
+            await session.execute(update(Message).where(Message.id == edited.id).values(content="после правки"))
+            await session.execute(delete(Message).where(Message.id == deleted.id))
+    await move
+
+    assert await stored_rows(databases, "s2", chat.id) == [(edited.id, "после правки"), (late_id, "опоздавшее")]
+    assert await stored_rows(databases, "s1", chat.id) == []
+
+
+async def test_shard_for_message_prefers_current_placement_during_move(databases):
+    first, second = await make_users()
+    chat = await chat_on(databases, "s1", [first, second])
+    message = await add_message(chat, first, second, "копия")
+
+    # Строки уже скопированы, но размещение ещё старое
+    await _copy_rows(databases.engines["s1"], databases.engines["s2"], [chat.id])
+    assert await databases.shard_for_message(message.id) == "s1"
+
+    move = asyncio.create_task(move_chats("s1", "s2", [chat.id], pause=0.3))
+    await wait_for_placement(chat.id, "s2")
+    databases.forget(chat.id)
+    # Сообщение есть на обоих шардах, выбирается текущий шард чата
+    assert await databases.shard_for_message(message.id) == "s2"
+    await MessagesDAO.update_message(message.id, "правка во время переноса")
+    fresh = await add_message(chat, second, first, "сразу на новом шарде")
+    await move
+
+    # Докопирование не затирает правку и не удаляет новое сообщение целевого шарда
+    assert await stored_rows(databases, "s2", chat.id) == [
+        (message.id, "правка во время переноса"), (fresh.id, "сразу на новом шарде")]
+    assert await databases.shard_for_message(message.id) == "s2"
+
+
+async def test_known_chat_resolves_message_shard_without_probing(databases):
+    first, second = await make_users()
+    chat = await chat_on(databases, "s2", [first, second])
+
+    # Сообщения с таким ID нет ни на одном шарде: ответ взят из размещения чата
+    assert await databases.shard_for_message(10 ** 9, chat.id) == "s2"
+    assert await databases.shard_for_message(10 ** 9) is None
+
+
+async def test_sharded_event_is_written_after_message_commit(databases):
+    first, second = await make_users()
+    chat = await chat_on(databases, "s1", [first, second])
+    message = await add_message(chat, first, second, "раз")
+
+    async with engine.connect() as conn:
+        events = (await conn.execute(select(ChatEvent.seq, ChatEvent.message_id)
+                                     .where(ChatEvent.chat_id == chat.id))).all()
+        last_seq = (await conn.execute(select(Chat.last_seq).where(Chat.id == chat.id))).scalar()
+    async with databases.engines["s1"].connect() as conn:
+        stored_seq = (await conn.execute(select(Message.seq).where(Message.id == message.id))).scalar()
+    assert events == [(message.seq, message.id)]
+    assert last_seq == message.seq == stored_seq
+
+    def fail(conn):
+        raise RuntimeError("шард недоступен")
+
+    event.listen(databases.engines["s1"].sync_engine, "commit", fail)
+    try:
+        with pytest.raises(RuntimeError):
+            await add_message(chat, first, second, "два")
+    finally:
+        event.remove(databases.engines["s1"].sync_engine, "commit", fail)
+
+    # Сообщение не сохранилось - события о нём и нового номера тоже нет
+    async with engine.connect() as conn:
+        assert (await conn.execute(select(func.count()).select_from(ChatEvent)
+                                   .where(ChatEvent.chat_id == chat.id))).scalar() == 1
+        assert (await conn.execute(select(Chat.last_seq).where(Chat.id == chat.id))).scalar() == last_seq
+
+
+async def test_file_queries_cover_all_shards(databases):
+    first, second = await make_users()
+    chats = [await chat_on(databases, shard, [first, second]) for shard in ("s1", "s2")]
+    orphans = []
+    for chat in chats:
+        async with (await databases.session_maker(chat.id))() as session:
+            orphans.append(await FilesDAO.add_file(session, f"{chat.id}.txt", f"uploads/{chat.id}.txt", chat.id))
+
+    found = await FilesDAO.find_orphans(datetime.utcnow() + timedelta(days=1))
+    assert [file_id for file_id, _ in found] == sorted(orphan.id for orphan in orphans)
+    paths = {orphan.file_path for orphan in orphans}
+    assert await FilesDAO.find_referenced_paths([*paths, "uploads/missing.txt"]) == paths
+    assert await FilesDAO.delete_by_ids([orphan.id for orphan in orphans]) == 2
+    assert await FilesDAO.find_orphans(datetime.utcnow() + timedelta(days=1)) == []
+
+
+async def test_inbox_stats_merge_shards(databases):
+    first, second = await make_users()
+    chats = [await chat_on(databases, shard, [first, second]) for shard in ("s1", "s2", DEFAULT_SHARD)]
+    last_ids = {}
+    for chat in chats:
+        await add_message(chat, first, second, "от первого")
+        last_ids[chat.id] = (await add_message(chat, second, first, "от второго")).id
+
+    stats = await MessagesDAO.get_inbox_stats([chat.id for chat in chats], first.id)
+
+    assert stats == {chat.id: (last_ids[chat.id], "от второго", 1) for chat in chats}
+
+
+async def test_unread_counts_messages_after_read_mark(databases):
+    first, second = await make_users()
+    chat = await chat_on(databases, "s1", [first, second])
+    received = [(await add_message(chat, second, first, f"{n}")).id for n in range(4)]
+
+    await MessagesDAO.mark_message_as_read(received[2], first.id, chat.id)
+    # Прочтение более старого сообщения отметку назад не двигает
+    await MessagesDAO.mark_message_as_read(received[0], first.id, chat.id)
+
+    assert await ChatDAO.get_read_marks([chat.id], first.id) == {chat.id: received[2]}
+    stats = await MessagesDAO.get_inbox_stats([chat.id], first.id)
+    assert stats[chat.id][2] == 1
@@ -0,0 +1,40 @@
+import pytest
+from fastapi import status
+
+from app.chat.router import is_socket_user, user_websocket_endpoint, websocket_endpoint
+from app.chat.dao import ChatDAO
+from app.users.auth import create_access_token
+from app.users.dao import UsersDAO
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeSocket:
+    def __init__(self, cookies: dict):
+        self.cookies = cookies
+        self.close_code = None
+
+    async def accept(self, subprotocol=None):
+        raise AssertionError("соединение принято")
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+async def test_socket_rejects_missing_or_foreign_cookie(databases):
+    owner = await UsersDAO.add(name="Владелец", email="owner@example.com")
+    other = await UsersDAO.add(name="Другой", email="other@example.com")
+    chat = await ChatDAO.create_chat("Чат", [owner.id, other.id])
+    foreign = {"access_token": create_access_token({"sub": other.email})}
+
+    for cookies in ({}, {"access_token": "не токен"}, foreign):
+        websocket = FakeSocket(cookies)
+        await user_websocket_endpoint(websocket, owner.id)
+        assert websocket.close_code == status.WS_1008_POLICY_VIOLATION
+
+        websocket = FakeSocket(cookies)
+        await websocket_endpoint(websocket, chat.id, owner.id)
+        assert websocket.close_code == status.WS_1008_POLICY_VIOLATION
+
+    own = FakeSocket({"access_token": create_access_token({"sub": owner.email})})
+    assert await is_socket_user(own, owner.id)